@@ -1,70 +1,46 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
 import json
-import random
 import requests
+import socket
 import time
 import os
+from prompt_layout import PromptLayout
+from weight_queue import open_weight_queue
+
+# A pair the LLM keeps leaving out is given up on for this run after this many requests
+MAX_PAIR_ATTEMPTS = 3
+# Tag pairs per request
+CHUNK_SIZE = 20
+SERVER = 'bestiary:5000'
 
 # Path to the tag pairs JSON file
 tag_pairs_path = 'data/tag_pairs.json'
 weights_output_path = 'data/tag_pairs_with_weights.json'
 
-# Load tag pairs and prompt template
-def load_data():
-    with open(tag_pairs_path, 'r') as f:
-        tag_pairs = json.load(f)
-
-    # If there's already a file with weights, load it to update
-    if os.path.exists(weights_output_path):
-        with open(weights_output_path, 'r') as f:
-            tag_pairs_with_weights = json.load(f)
-    else:
-        tag_pairs_with_weights = {}
-
-    return tag_pairs, tag_pairs_with_weights
-
-# Save the tag pairs with updated weights
-def save_data(tag_pairs_with_weights):
-    with open(weights_output_path, 'w') as f:
-        json.dump(tag_pairs_with_weights, f, indent=2)
-    print(f"Data saved to {weights_output_path}")
-
-# Load the LLM prompt template
+# Load the LLM prompt template; the tag pairs go last so everything before them
+# stays in the server's prefix cache between requests
 def load_prompt_template():
     with open('tag_weights_prompt_template.txt', 'r') as f:
-        return f.read()
-
-# Function to check if a tag pair already has a weight assigned
-def has_weight(tag1, tag2, weighted_pairs):
-    return (tag1 in weighted_pairs and tag2 in weighted_pairs[tag1]) or (tag2 in weighted_pairs and tag1 in weighted_pairs[tag2])
-
-# Function to generate a prompt with random tag pairs
-def generate_prompt(tag_pairs, weighted_pairs, chunk_size=10):
-    unweighted_pairs = []
-    
-    # Iterate over the dictionary of tag pairs and collect the ones without weights
-    for tag1, pairs in tag_pairs.items():
-        for tag2 in pairs:
-            if not has_weight(tag1, tag2, weighted_pairs):
-                unweighted_pairs.append((tag1, tag2))
-
-    if not unweighted_pairs:
-        return None, None
-
-    # Select a random chunk of pairs
-    random_pairs = random.sample(unweighted_pairs, min(chunk_size, len(unweighted_pairs)))
-    tag_pairs_str = ',\n'.join([json.dumps({"tag1": p[0], "tag2": p[1]}) for p in random_pairs])
-    prompt_template = load_prompt_template()
-    prompt = prompt_template.replace('%TAG_PAIRS%', tag_pairs_str)
-    return prompt, random_pairs
-
-# Function to parse the response from the LLM
-def parse_response(response_text, selected_pairs, weighted_pairs_dict):
+        return PromptLayout(f.read(), '%TAG_PAIRS%')
+
+# Function to generate a prompt for a claimed chunk of tag pairs. The queue
+# hands out pairs in sorted order rather than at random: the same prompt is
+# rebuilt byte for byte on a retry, and consecutive chunks share their leading
+# tag, which extends the prefix the server can reuse
+def generate_prompt(selected_pairs, prompt_template):
+    tag_pairs_str = ',\n'.join([json.dumps({"tag1": p[0], "tag2": p[1]}) for p in selected_pairs])
+    return prompt_template.render(tag_pairs_str)
+
+# Function to parse the response from the LLM into [(tag1, tag2, weight), ...]
+def parse_response(response_text):
+    weights = []
     try:
         # Extract the JSON part from the response
         start_idx = response_text.find('[')
         end_idx = response_text.rfind(']') + 1  # Ensure it includes the closing bracket
-        if start_idx == -1 or end_idx == -1:
+        if start_idx == -1 or end_idx == 0:
             print("Error: Couldn't find JSON structure in response.")
             return []
 
@@ -72,45 +48,95 @@ def parse_response(response_text, selected_pairs, weighted_pairs_dict):
         parsed_weights = json.loads(json_part)
 
         for pw in parsed_weights:
-            tag1 = pw['tag1']
-            tag2 = pw['tag2']
-            weight = pw['weight']
-
-            # Update the dictionary
-            if tag1 not in weighted_pairs_dict:
-                weighted_pairs_dict[tag1] = {}
-            weighted_pairs_dict[tag1][tag2] = weight
+            weights.append((pw['tag1'], pw['tag2'], pw['weight']))
 
     except Exception as e:
         print(f"Error parsing response: {e}")
+    return weights
 
-# Main processing loop
-def main():
-    tag_pairs, tag_pairs_with_weights = load_data()
+def save_data(queue):
+    count = queue.export(weights_output_path)
+    print(f"Merged {count} weights into {weights_output_path}")
+
+# Sets a weighed batch in the queue. Chunks are deterministic, so a pair that keeps
+# failing would otherwise be resent forever; the queue gives up on it after MAX_PAIR_ATTEMPTS
+def complete_batch(queue, selected_pairs, response_text):
+    if response_text:
+        weights = parse_response(response_text)
+    else:
+        print("No response from LLM.")
+        weights = []
+    # One transaction per batch, so workers' results never interleave half-written
+    queue.complete(selected_pairs, weights, MAX_PAIR_ATTEMPTS)
 
-    # Continue looping until all pairs have weights
+def run_sync(queue, prompt_template, worker, in_flight):
     while True:
-        prompt, selected_pairs = generate_prompt(tag_pairs, tag_pairs_with_weights, chunk_size=20)
-        if not prompt:
-            print("All tag pairs have weights assigned.")
+        selected_pairs = queue.claim(worker, CHUNK_SIZE)
+        if not selected_pairs:
             break
+        in_flight.append(selected_pairs)
 
         print(f"Sending request for {len(selected_pairs)} pairs...")
-        response_text = send_request_to_llm(prompt)
+        response_text = send_request_to_llm(generate_prompt(selected_pairs, prompt_template))
+        complete_batch(queue, selected_pairs, response_text)
+        in_flight.remove(selected_pairs)
 
-        if response_text:
-            parse_response(response_text, selected_pairs, tag_pairs_with_weights)
-            save_data(tag_pairs_with_weights)
-        else:
-            print("No response from LLM.")
-        
         # Sleep to avoid overwhelming the LLM
         time.sleep(5)
 
+async def run_async(queue, prompt_template, worker, in_flight, concurrency, rate, adaptive):
+    # Imported here so the blocking mode works without aiohttp installed
+    from llm_client import LLMClient
+
+    async def worker_loop(client):
+        while True:
+            selected_pairs = queue.claim(worker, CHUNK_SIZE)
+            if not selected_pairs:
+                return
+            in_flight.append(selected_pairs)
+            print(f"Sending request for {len(selected_pairs)} pairs...")
+            response_text = await client.generate(build_payload(generate_prompt(selected_pairs, prompt_template)))
+            complete_batch(queue, selected_pairs, response_text)
+            in_flight.remove(selected_pairs)
+
+    # No fixed sleep: the client paces itself on 429/503 and, with adaptive, on latency
+    async with LLMClient(SERVER, concurrency=concurrency, rate=rate, adaptive=adaptive) as client:
+        await asyncio.gather(*(worker_loop(client) for _ in range(concurrency)))
+        print(f"LLM client: {client.stats()}")
+
+# Main processing loop
+def main(use_async=False, concurrency=4, rate=None, adaptive=True):
+    queue = open_weight_queue(tag_pairs_path, weights_output_path)
+    queue.retry_given_up()
+    prompt_template = load_prompt_template()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    # Weights are committed to the queue per batch; the JSON is rewritten once at
+    # the end (or with `python weight_queue.py export` after an interruption)
+    in_flight = []
+    try:
+        if use_async:
+            asyncio.run(run_async(queue, prompt_template, worker, in_flight, concurrency, rate, adaptive))
+        else:
+            run_sync(queue, prompt_template, worker, in_flight)
+    finally:
+        # Interrupted mid-request: let the next worker have those batches right away
+        for selected_pairs in in_flight:
+            queue.release(selected_pairs)
+        save_data(queue)
+        counts = queue.counts()
+        queue.close()
+
+    if counts['given_up']:
+        print(f"{counts['given_up']} tag pairs are still without weights after {MAX_PAIR_ATTEMPTS} attempts.")
+    elif counts['pending'] or counts['claimed']:
+        print(f"{counts['pending'] + counts['claimed']} tag pairs are pending or claimed by other workers.")
+    else:
+        print("All tag pairs have weights assigned.")
     print("All tag pairs have been processed.")
 
-def send_request_to_llm(prompt):
-    payload = {
+def build_payload(prompt):
+    return {
         "n": 1,
         "max_context_length": 8192,
         "max_length": 750,
@@ -142,8 +168,9 @@ def send_request_to_llm(prompt):
         "bypass_eos": False
     }
 
+def send_request_to_llm(prompt):
     try:
-        response = requests.post('http://bestiary:5000/api/v1/generate', headers={'Content-Type': 'application/json'}, json=payload)
+        response = requests.post(f'http://{SERVER}/api/v1/generate', headers={'Content-Type': 'application/json'}, json=build_payload(prompt))
         if response.status_code == 200:
             return response.json()['results'][0]['text']
         else:
@@ -154,4 +181,18 @@ def send_request_to_llm(prompt):
         return None
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Weigh tag pairs with the LLM")
+    parser.add_argument('--tag-pairs', default=tag_pairs_path,
+                        help="Pairs to weigh, e.g. the uncertain pairs from cooccurrence_weights.py --refine")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Send requests concurrently with aiohttp instead of one every 5 seconds")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Most requests in flight in --async mode")
+    parser.add_argument('--rate', type=float, default=None, help="Max requests per second in --async mode")
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help="Keep --concurrency requests in flight instead of adapting to server latency and 429/503")
+    parser.add_argument('--server', default=SERVER)
+    args = parser.parse_args()
+    tag_pairs_path = args.tag_pairs
+    SERVER = args.server
+    main(args.use_async, args.concurrency, args.rate, not args.fixed_concurrency)
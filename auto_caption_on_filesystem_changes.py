@@ -1,72 +1,298 @@
 #!/home/offipso/Programs/venvs/redpill_explorer_2/bin/python
+# auto_caption_on_filesystem_changes.py
+#
+# Watches a directory tree and captions new images in-process:
+#
+#   - watchdog events only note the path; a file is queued once its writes
+#     have settled (closed after writing, or no events for SETTLE_SECONDS with
+#     the same size and mtime), so half-copied files are never captioned
+#   - settled files go to a persistent queue (ingest_queue.py), so nothing
+#     seen is lost if the daemon stops
+#   - one thread claims them in batches and captions each batch in one
+#     run_pipeline pass, reusing the HTTP session, hash cache and caption store
+#   - at startup the tree is scanned for anything that arrived while the
+#     daemon wasn't running; files already captioned are skipped by hash
+#   - images_captioned.json, which the tagger reads, is rewritten at most every
+#     EXPORT_INTERVAL seconds while new captions arrive, and at shutdown
+#
+# Usage: python auto_caption_on_filesystem_changes.py <directory> [--batch-size 64] [--settle 2.0] [--export-interval 300]
+
+import argparse
 import os
+import signal
 import sys
+import threading
 import time
-import subprocess
+from pathlib import Path
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-CAPTION_SCRIPT = "/home/offipso/git/redpill_explorer_2/caption_images_with_cogvlm2.py"
-PIDFILE = "/tmp/caption_images.pid"
+import caption_images_with_cogvlm2 as captioner
+from hash_cache import HashCache, HASH_CACHE_PATH
+from ingest_queue import IngestQueue, INGEST_QUEUE_PATH
+
+# Seconds without events, and with an unchanged size and mtime, before a file counts as written
+SETTLE_SECONDS = 2.0
+SETTLE_POLL = 0.25
+# Files per captioning pass, and how long to let a burst gather before the first pass
+BATCH_SIZE = 64
+BATCH_WINDOW = 1.0
+MAX_ATTEMPTS = 3
+# Seconds before a failed file is retried, doubling each attempt
+RETRY_DELAY = 30.0
+RECONCILE_CHUNK = 1000
+# Seconds to pause after a pass fails as a whole (server down, database locked)
+ERROR_PAUSE = 5.0
+# Each export rewrites the whole JSON, so batch them rather than exporting per pass
+EXPORT_INTERVAL = 300.0
+
+def is_image(path):
+    return Path(path).suffix.lower() in captioner.SUPPORTED_EXTENSIONS
+
+def stat_key(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+class Debouncer:
+    """Holds paths with recent events until their writes have settled."""
+
+    def __init__(self, settle_seconds=SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        # path -> [first event, last event, (size, mtime_ns) at the last event, closed after writing]
+        self.waiting = {}
+
+    def touch(self, path, closed=False):
+        now = time.time()
+        try:
+            stat = stat_key(path)
+        except OSError:
+            stat = None
+        with self.lock:
+            entry = self.waiting.setdefault(path, [now, now, None, False])
+            entry[1:] = [now, stat, closed]
+
+    def settled(self):
+        """Removes and returns [(path, size, mtime_ns, first event), ...] for files done being written."""
+        now = time.time()
+        with self.lock:
+            due = [(path, entry) for path, entry in self.waiting.items()
+                   if entry[3] or now - entry[1] >= self.settle_seconds]
+        ready = []
+        for path, entry in due:
+            try:
+                stat = stat_key(path)
+            except OSError:
+                stat = None  # Deleted or renamed away
+            with self.lock:
+                if self.waiting.get(path) is not entry:
+                    continue
+                if stat is None:
+                    del self.waiting[path]
+                elif stat == entry[2]:
+                    del self.waiting[path]
+                    ready.append((path, stat[0], stat[1], entry[0]))
+                else:
+                    # Still growing without events (network mounts); wait another period
+                    entry[1:] = [now, stat, False]
+        return ready
 
 class NewFileHandler(FileSystemEventHandler):
-    """Handles events for new files created in the monitored directory."""
+    """Passes image paths from watchdog events to the debouncer; never blocks the observer."""
+
+    def __init__(self, debouncer):
+        self.debouncer = debouncer
 
     def on_created(self, event):
-        # Triggered when a new file or directory is created
-        if event.is_directory:
-            return
-
-        # If a new image file is created, start the caption script
-        if any(event.src_path.endswith(ext) for ext in ['.jpg', '.jpeg', '.png']):
-            print(f"New image file detected: {event.src_path}")
-            if not is_caption_script_running():
-                run_caption_script(event.src_path)
-            else:
-                print("Caption script is already running. Waiting for it to finish...")
-
-def is_caption_script_running():
-    """Checks if the caption script is already running by looking for the PID file."""
-    return os.path.exists(PIDFILE)
-
-def run_caption_script(file_path):
-    """Run the caption script with the new file as an argument."""
-    print(f"Starting caption script for file: {file_path}")
-    # Run the caption script with the new file as an argument
-    with open(PIDFILE, 'w') as f:
-        process = subprocess.Popen([sys.executable, CAPTION_SCRIPT, file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        f.write(str(process.pid))
-
-    # Wait for the caption script to complete
-    process.wait()
-    print(f"Caption script completed for file: {file_path}")
-
-    # Remove the PID file after completion
-    if os.path.exists(PIDFILE):
-        os.remove(PIDFILE)
-
-def monitor_directory(directory):
-    """Monitors the specified directory for new files and triggers the caption script."""
-    event_handler = NewFileHandler()
-    observer = Observer()
-    observer.schedule(event_handler, path=directory, recursive=True)
-    observer.start()
-    print(f"Monitoring directory: {directory}")
+        if not event.is_directory and is_image(event.src_path):
+            self.debouncer.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and is_image(event.src_path):
+            self.debouncer.touch(event.src_path)
+
+    def on_closed(self, event):
+        # Only reported on Linux (inotify IN_CLOSE_WRITE); elsewhere the quiet period decides
+        if not event.is_directory and is_image(event.src_path):
+            self.debouncer.touch(event.src_path, closed=True)
+
+    def on_moved(self, event):
+        # A file moved into the tree is already complete
+        if not event.is_directory and is_image(event.dest_path):
+            self.debouncer.touch(event.dest_path, closed=True)
+
+class IngestDaemon:
+    def __init__(self, directory, queue, endpoint=None, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW,
+                 settle_seconds=SETTLE_SECONDS, hash_cache=None, reconcile=True, export_interval=EXPORT_INTERVAL):
+        self.directory = directory
+        self.queue = queue
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.hash_cache = hash_cache
+        self.reconcile = reconcile
+        self.export_interval = export_interval
+        self.debouncer = Debouncer(settle_seconds)
+        self.observer = Observer()
+        self.observer.schedule(NewFileHandler(self.debouncer), path=directory, recursive=True)
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.threads = []
+        self.passes = 0
+        self.unexported = 0
+        self.last_export = time.time()
+
+    def start(self):
+        released = self.queue.release_claimed()
+        if released:
+            print(f"Requeued {released} files from an interrupted captioning pass.")
+        print(f"Monitoring directory: {self.directory} ({self.queue.counts()['pending']} files pending)")
+        # Watch before scanning, so a file arriving during the scan is caught by one or the other
+        self.observer.start()
+        targets = [self.settle_loop, self.caption_loop] + ([self.reconcile_scan] if self.reconcile else [])
+        for target in targets:
+            thread = threading.Thread(target=target, name=target.__name__, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def enqueue(self, files):
+        if files and self.queue.add(files):
+            self.wake.set()
+
+    def settle_loop(self):
+        while not self.stopping.wait(SETTLE_POLL):
+            self.enqueue(self.debouncer.settled())
+
+    def reconcile_scan(self):
+        """Offers every image in the tree to the queue, which keeps only new or changed files."""
+        start = time.time()
+        chunk, seen = [], 0
+        for path in captioner.iter_image_files(self.directory):
+            if self.stopping.is_set():
+                return
+            try:
+                size, mtime_ns = stat_key(path)
+            except OSError:
+                continue
+            seen += 1
+            if start - mtime_ns / 1e9 < self.debouncer.settle_seconds:
+                # Possibly still being written; let it settle like a new file
+                self.debouncer.touch(path)
+                continue
+            chunk.append((path, size, mtime_ns, start))
+            if len(chunk) >= RECONCILE_CHUNK:
+                self.enqueue(chunk)
+                chunk = []
+        self.enqueue(chunk)
+        print(f"Startup scan: {seen} images in {time.time() - start:.1f}s, "
+              f"{self.queue.counts()['pending']} pending")
+
+    def caption_loop(self):
+        while not self.stopping.is_set():
+            paths = []
+            try:
+                self.export_if_due()
+                due = self.queue.next_due()
+                if due is None or due > 0:
+                    self.wake.wait(min(due, 1.0) if due is not None else 1.0)
+                    if not self.wake.is_set():
+                        continue
+                    self.wake.clear()
+                    # Let a burst gather so the first pass is a full batch rather than one file
+                    if self.stopping.wait(self.batch_window):
+                        return
+                paths = self.queue.claim(self.batch_size)
+                if paths:
+                    self.caption_batch(paths)
+            except Exception as e:
+                # This is the only captioning thread; keep it alive and hand the batch back
+                print(f"Error in captioning pass: {e}")
+                try:
+                    self.queue.release_claimed(paths)
+                except Exception as release_error:
+                    print(f"Error releasing the batch; it is requeued on the next start: {release_error}")
+                self.stopping.wait(ERROR_PAUSE)
+
+    def caption_batch(self, paths):
+        outcomes = []
+        start = time.time()
+        new_captions = captioner.run_pipeline(paths, endpoint=self.endpoint, progress=False,
+                                              hash_cache=self.hash_cache,
+                                              on_result=lambda path, outcome: outcomes.append((path, outcome)))
+        gone = [path for path, outcome in outcomes if outcome == 'failed' and not os.path.exists(path)]
+        self.queue.complete([item for item in outcomes if item[0] not in gone], MAX_ATTEMPTS, RETRY_DELAY)
+        self.queue.remove(gone)
+        self.passes += 1
+        self.unexported += new_captions
+        failed = sum(outcome == 'failed' for _, outcome in outcomes) - len(gone)
+        print(f"Captioned {new_captions} new of {len(paths)} files in {time.time() - start:.1f}s"
+              f"{f', {failed} failed' if failed else ''} ({self.queue.counts()['pending']} pending)")
+
+    def export_if_due(self, force=False):
+        if self.unexported and (force or time.time() - self.last_export >= self.export_interval):
+            captioner.export_legacy_json()
+            self.unexported = 0
+            self.last_export = time.time()
+
+    def stop(self, timeout=10.0):
+        self.stopping.set()
+        self.wake.set()
+        self.observer.stop()
+        self.observer.join()
+        for thread in self.threads:
+            thread.join(timeout)
+        if any(thread.is_alive() for thread in self.threads):
+            # The rest of the batch stays claimed and is requeued on the next start
+            print("Stopped mid-pass; the unfinished batch will be captioned on the next start.")
+            return False
+        return True
+
+def monitor_directory(directory, endpoint=None, batch_size=BATCH_SIZE, settle_seconds=SETTLE_SECONDS,
+                      queue_path=INGEST_QUEUE_PATH, hash_cache_path=HASH_CACHE_PATH, reconcile=True,
+                      export_interval=EXPORT_INTERVAL):
+    """Monitors the specified directory and captions new images until interrupted."""
+    captioner.processed_files = captioner.load_local_db(captioner.LOCAL_DB_PATH)
+    hash_cache = HashCache(hash_cache_path) if hash_cache_path else None
+    queue = IngestQueue(queue_path)
+    daemon = IngestDaemon(directory, queue, endpoint=endpoint, batch_size=batch_size,
+                          settle_seconds=settle_seconds, hash_cache=hash_cache, reconcile=reconcile,
+                          export_interval=export_interval)
+    # The captioner's own SIGINT handler exits on the spot; stop the threads first
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    daemon.start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        print("\nStopping...")
+    stopped = daemon.stop()
+    daemon.export_if_due(force=True)
+    if stopped:
+        queue.close()
+        captioner.processed_files.close()
+        if hash_cache is not None:
+            hash_cache.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python auto_caption_on_filesystem_changes.py <directory>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Caption images as they arrive in a directory tree")
+    parser.add_argument("directory")
+    parser.add_argument("--endpoint", default=captioner.CAPTION_ENDPOINT, help="CogVLM2 /caption URL")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Files per captioning pass")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="Seconds a file must go unchanged before it is captioned")
+    parser.add_argument("--queue", default=INGEST_QUEUE_PATH, help="Pending queue database")
+    parser.add_argument("--hash-cache", default=HASH_CACHE_PATH, help="Stat -> hash cache database")
+    parser.add_argument("--no-hash-cache", action="store_true", help="Rehash every file")
+    parser.add_argument("--no-scan", action="store_true", help="Skip the startup scan for files missed while stopped")
+    parser.add_argument("--export-interval", type=float, default=EXPORT_INTERVAL,
+                        help="Seconds between rewrites of images_captioned.json while captions arrive")
+    args = parser.parse_args()
 
-    directory = sys.argv[1]
+    directory = args.directory
     if not os.path.isdir(directory):
         print(f"Error: {directory} is not a valid directory.")
         sys.exit(1)
 
-    monitor_directory(directory)
+    monitor_directory(os.path.abspath(directory), args.endpoint, args.batch_size, args.settle, args.queue,
+                      None if args.no_hash_cache else args.hash_cache, not args.no_scan, args.export_interval)
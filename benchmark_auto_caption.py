@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# benchmark_auto_caption.py
+#
+# Drops a burst of files into a directory watched by the auto-captioning
+# daemon (auto_caption_on_filesystem_changes.py) and measures, against the
+# stub /caption server from benchmark_caption_client.py:
+#
+#   - burst: latency from each file being written to its caption being stored
+#     (median, p95, max), throughput over the whole burst, passes used, and
+#     that every file got exactly one caption
+#   - restart: the daemon is stopped mid-burst, more files arrive while it is
+#     down, and a new daemon finishes the queue and picks them up by its scan
+#   - per-event spawn: the old handler's one caption_images_with_cogvlm2.py
+#     process per file, timed over --sample files and extrapolated
+#
+# Files are written in two chunks with a flush between, so the watcher sees a
+# half-written file first.
+#
+# Usage: python benchmark_auto_caption.py [--files 1000] [--size-kb 64] [--latency-ms 20] [--settle 0.5]
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import auto_caption_on_filesystem_changes as daemon_module
+import caption_images_with_cogvlm2 as captioner
+from benchmark_caption_client import StubCaptionHandler
+from caption_store import CaptionStore
+from ingest_queue import IngestQueue, DONE
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def drop_files(directory, start, count, size_kb, written):
+    for i in range(start, start + count):
+        subdir = os.path.join(directory, f'{i % 16:02d}')
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, f'{i}.jpg')
+        content = os.urandom(size_kb * 1024)
+        with open(path, 'wb') as f:
+            f.write(content[:len(content) // 2])
+            f.flush()
+            f.write(content[len(content) // 2:])
+        written[path] = time.time()
+
+
+def start_daemon(work, watched, endpoint, args, reconcile=True):
+    queue = IngestQueue(os.path.join(work, 'ingest_queue.db'))
+    daemon = daemon_module.IngestDaemon(watched, queue, endpoint=endpoint, batch_size=args.batch_size,
+                                        settle_seconds=args.settle, reconcile=reconcile)
+    daemon.start()
+    return daemon, queue
+
+
+def wait_for(queue, count, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if queue.counts()['done'] >= count:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def done_times(queue):
+    with queue.lock:
+        return dict(queue.conn.execute('SELECT path, done_at FROM files WHERE status=?', (DONE,)))
+
+
+def burst(work, endpoint, args):
+    watched = os.path.join(work, 'burst')
+    os.makedirs(watched)
+    captioner.processed_files = CaptionStore(os.path.join(work, 'burst_captions.db'))
+    daemon, queue = start_daemon(work, watched, endpoint, args)
+    written = {}
+    start = time.time()
+    drop_files(watched, 0, args.files, args.size_kb, written)
+    dropped = time.time() - start
+    finished = wait_for(queue, args.files, args.timeout)
+    done = done_times(queue)
+    daemon.stop()
+    captions = len(captioner.processed_files)
+    queue.close()
+    captioner.processed_files.close()
+
+    latencies = sorted(done[path] - written[path] for path in written if path in done)
+    end = max(done.values()) if done else time.time()
+    print(f"  burst: {args.files} files dropped in {dropped:.1f}s; {len(latencies)} captioned "
+          f"({captions} captions stored) in {daemon.passes} passes{'' if finished else ', TIMED OUT'}")
+    if latencies:
+        print(f"    {len(latencies) / (end - start):.1f} files/sec over the burst, latency median "
+              f"{statistics.median(latencies):.2f}s, p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f}s, "
+              f"max {latencies[-1]:.2f}s")
+
+
+def restart(work, endpoint, args):
+    watched = os.path.join(work, 'restart')
+    os.makedirs(watched)
+    os.remove(os.path.join(work, 'ingest_queue.db'))
+    captioner.processed_files = CaptionStore(os.path.join(work, 'restart_captions.db'))
+    daemon, queue = start_daemon(work, watched, endpoint, args)
+    written = {}
+    first = args.files // 2
+    drop_files(watched, 0, first, args.size_kb, written)
+    # Stop once a few passes are done, leaving part of the burst pending
+    while queue.counts()['done'] < first // 4:
+        time.sleep(0.05)
+    daemon.stop(timeout=0)
+    counts = queue.counts()
+    # A pass still running finishes on its own; wait so the next daemon starts from a quiet store
+    for thread in daemon.threads:
+        thread.join()
+    queue.close()
+    print(f"  restart: stopped with {counts['done']} done, {counts['pending'] + counts['claimed']} "
+          f"pending or claimed of {first}")
+
+    drop_files(watched, first, args.files // 4, args.size_kb, written)
+    start = time.time()
+    daemon, queue = start_daemon(work, watched, endpoint, args)
+    finished = wait_for(queue, len(written), args.timeout)
+    daemon.stop()
+    missing = [path for path in written if captioner.file_hash_for(path) not in captioner.processed_files]
+    print(f"    after restart and scan: {queue.counts()['done']}/{len(written)} done in "
+          f"{time.time() - start:.1f}s, {len(missing)} without a caption{'' if finished else ', TIMED OUT'}")
+    queue.close()
+    captioner.processed_files.close()
+
+
+def per_event_spawn(work, endpoint, args):
+    watched = os.path.join(work, 'spawn')
+    os.makedirs(watched)
+    written = {}
+    drop_files(watched, 0, args.sample, args.size_kb, written)
+    start = time.perf_counter()
+    for path in written:
+        # What NewFileHandler.on_created used to run, one file at a time
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'caption_images_with_cogvlm2.py'), path,
+                        '--endpoint', endpoint, '--no-hash-cache'],
+                       cwd=work, check=True, capture_output=True)
+    per_file = (time.perf_counter() - start) / args.sample
+    print(f"  per-event spawn: {per_file:.2f}s per file over {args.sample}, "
+          f"~{per_file * args.files / 60:.1f} min for {args.files}")
+
+
+def main(args):
+    StubCaptionHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCaptionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}/caption'
+    work = tempfile.mkdtemp(prefix='auto_caption_bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(work)
+        print(f"{args.files} files of {args.size_kb} KB, stub latency {args.latency_ms:.0f} ms, "
+              f"settle {args.settle}s, batches of {args.batch_size}")
+        burst(work, endpoint, args)
+        restart(work, endpoint, args)
+        per_event_spawn(work, endpoint, args)
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the auto-captioning daemon on a burst of new files")
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size-kb', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--settle', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=daemon_module.BATCH_SIZE)
+    parser.add_argument('--sample', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=600)
+    main(parser.parse_args())
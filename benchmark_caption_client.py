@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# benchmark_caption_client.py
+#
+# Runs the pipelined client in caption_images_with_cogvlm2.py against a local
+# stub /caption server and reports files/sec for a range of upload worker
+# counts. The stub sleeps a fixed time per request to stand in for the GPU and
+# answers with the SHA-256 of the uploaded file, like the real server.
+#
+# Usage: python benchmark_caption_client.py [--files 400] [--size-kb 512] [--latency-ms 50] [--workers 1 2 4 8 16]
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import caption_images_with_cogvlm2 as client
+from caption_store import CaptionStore
+
+
+class StubCaptionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        # Single-part multipart body: headers, blank line, file, CRLF, boundary
+        part = body.split(b'--' + boundary)[1]
+        headers, content = part.split(b'\r\n\r\n', 1)
+        content = content[:-2]
+        filename = headers.split(b'filename="')[1].split(b'"')[0].decode()
+        time.sleep(self.latency)
+        file_hash = hashlib.sha256(content).hexdigest()
+        payload = json.dumps({"results": {file_hash: {"filename": filename, "description": "A stub caption."}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_files(directory, count, size_kb):
+    # Nested directories so the streaming walk has something to recurse into
+    for i in range(count):
+        subdir = os.path.join(directory, f'{i % 16:02d}')
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f'{i}.jpg'), 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+
+
+def main(args):
+    StubCaptionHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCaptionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}/caption'
+
+    directory = tempfile.mkdtemp(prefix='caption_bench_')
+    try:
+        make_files(directory, args.files, args.size_kb)
+        print(f"{args.files} files of {args.size_kb} KB, stub latency {args.latency_ms} ms/request")
+        for workers in args.workers:
+            client.processed_files = CaptionStore(os.path.join(directory, f'captions_{workers}.db'))
+            start = time.perf_counter()
+            captioned = client.run_pipeline(client.iter_image_files(directory), endpoint=endpoint,
+                                            upload_workers=workers, max_in_flight=max(32, workers * 4),
+                                            progress=False)
+            client.processed_files.close()
+            elapsed = time.perf_counter() - start
+            print(f"  upload workers {workers:3d}: {captioned / elapsed:8.1f} files/sec ({captioned} in {elapsed:.2f}s)")
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the caption client against a stub /caption server")
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--size-kb', type=int, default=512)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    main(parser.parse_args())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# benchmark_caption_store.py
+#
+# Startup time, peak memory and the cost of recording one caption for the old
+# images_captioned.json dict against caption_store.py, at 1M entries. Each
+# variant runs in its own process so peak RSS is measured independently.
+#
+# Usage: python benchmark_caption_store.py [--entries 1000000] [--dir /tmp/caption_store_bench]
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+from caption_store import CaptionStore
+
+LOOKUPS = 10000
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so it would include the parent's peak from build()
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def build(directory, entries):
+    json_path = os.path.join(directory, 'images_captioned.json')
+    db_path = os.path.join(directory, 'images_captioned.db')
+    if not os.path.exists(json_path):
+        start = time.perf_counter()
+        data = {f'{i:064x}': {"filename": f"/archive/redpills/{i}.jpg",
+                              "description": f"A synthetic caption for image number {i}, about a hundred characters long."}
+                for i in range(entries)}
+        with open(json_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        del data
+        print(f"Wrote {json_path} in {time.perf_counter() - start:.1f}s.")
+    if not os.path.exists(db_path):
+        start = time.perf_counter()
+        store = CaptionStore(db_path)
+        store.import_json(json_path)
+        store.close()
+        print(f"Imported into {db_path} in {time.perf_counter() - start:.1f}s.")
+    return json_path, db_path
+
+
+def run_json(json_path, entries):
+    start = time.perf_counter()
+    with open(json_path, 'r') as f:
+        processed = json.load(f)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, entries, max(1, entries // LOOKUPS)):
+        f'{i:064x}' in processed
+    lookup = time.perf_counter() - start
+    # The old client rewrote the whole file on every save
+    processed['f' * 64] = {"filename": "new.jpg", "description": "new"}
+    start = time.perf_counter()
+    with open(json_path + '.save', 'w') as f:
+        json.dump(processed, f, indent=4)
+    save = time.perf_counter() - start
+    os.remove(json_path + '.save')
+    return startup, lookup, save
+
+
+def run_store(db_path, entries):
+    start = time.perf_counter()
+    store = CaptionStore(db_path)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, entries, max(1, entries // LOOKUPS)):
+        f'{i:064x}' in store
+    lookup = time.perf_counter() - start
+    start = time.perf_counter()
+    store.put('f' * 64, "new.jpg", "new")
+    save = time.perf_counter() - start
+    store.conn.execute('DELETE FROM captions WHERE hash=?', ('f' * 64,))
+    store.close()
+    return startup, lookup, save
+
+
+def child(kind, path, entries):
+    startup, lookup, save = (run_json if kind == 'json' else run_store)(path, entries)
+    print(json.dumps({"startup": startup, "lookup": lookup, "save": save, "rss": peak_rss_mb()}))
+
+
+def main(args):
+    os.makedirs(args.dir, exist_ok=True)
+    try:
+        json_path, db_path = build(args.dir, args.entries)
+        print(f"{args.entries} entries, JSON file {os.path.getsize(json_path) / 2**20:.0f} MB, "
+              f"SQLite file {os.path.getsize(db_path) / 2**20:.0f} MB")
+        for kind, path in (('json', json_path), ('store', db_path)):
+            output = subprocess.run([sys.executable, __file__, '--child', kind, path, '--entries', str(args.entries)],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"  {kind:5s}: startup {result['startup']:7.3f}s  {LOOKUPS} lookups {result['lookup'] * 1000:8.1f} ms  "
+                  f"record one caption {result['save'] * 1000:9.2f} ms  peak RSS {result['rss']:7.0f} MB")
+    finally:
+        if not args.keep:
+            shutil.rmtree(args.dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the JSON local DB against the SQLite caption store")
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--dir', default='/tmp/caption_store_bench')
+    parser.add_argument('--keep', action='store_true', help="Keep the generated files for the next run")
+    parser.add_argument('--child', nargs=2, metavar=('KIND', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.entries)
+    else:
+        main(args)
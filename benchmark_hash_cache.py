@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# benchmark_hash_cache.py
+#
+# Compares a cold scan (every file read and hashed) with a warm rescan through
+# hash_cache.py, where unchanged files only cost a stat() and one lookup. Then
+# touches a few files to show that only those are rehashed.
+#
+# Usage: python benchmark_hash_cache.py [--files 2000] [--size-kb 1024] [--directory DIR]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from hash_cache import HashCache
+
+
+def make_files(directory, count, size_kb):
+    for i in range(count):
+        subdir = os.path.join(directory, f'{i % 32:02d}')
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f'{i}.jpg'), 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+
+
+def scan(directory, db_path):
+    cache = HashCache(db_path)
+    start = time.perf_counter()
+    for root, _, files in os.walk(directory):
+        for file in files:
+            cache.hash_file(os.path.join(root, file))
+    cache.close()
+    return time.perf_counter() - start, cache.hits, cache.misses
+
+
+def main(args):
+    directory = args.directory or tempfile.mkdtemp(prefix='hash_cache_bench_')
+    db_path = os.path.join(tempfile.mkdtemp(prefix='hash_cache_db_'), 'file_hashes.db')
+    try:
+        if not args.directory:
+            make_files(directory, args.files, args.size_kb)
+        for label in ('cold', 'warm'):
+            elapsed, hits, misses = scan(directory, db_path)
+            total = hits + misses
+            print(f"{label} scan:   {elapsed:8.3f}s  {total / elapsed:10.1f} files/sec  ({hits} cached, {misses} hashed)")
+
+        if args.directory:
+            return
+        # Touching a file changes its mtime, so exactly those are rehashed
+        touched = 0
+        for root, _, files in os.walk(directory):
+            for file in files[:1]:
+                os.utime(os.path.join(root, file))
+                touched += 1
+        elapsed, hits, misses = scan(directory, db_path)
+        print(f"after touching {touched}: {elapsed:8.3f}s  ({hits} cached, {misses} hashed)")
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+        shutil.rmtree(os.path.dirname(db_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark warm vs cold rescans through the hash cache")
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size-kb', type=int, default=1024)
+    parser.add_argument('--directory', help="Scan an existing tree instead of generating files (read only)")
+    main(parser.parse_args())
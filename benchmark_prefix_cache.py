@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# benchmark_prefix_cache.py
+#
+# How much of each prompt a prefix-caching server can reuse, counted by the
+# slot model in fake_generate_server.py:
+#
+#   - tagging: tag_caption_output.py in file order vs caption order, run
+#     against the fake server
+#   - weighting: assign_weights.py prompts for random chunks in the old layout
+#     (format instructions after the pairs) vs sorted chunks in the current one
+#
+# Usage: python benchmark_prefix_cache.py [--items 96] [--concurrency 4] [--tags 60] [--requests 40]
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.request
+
+from fake_generate_server import PrefixCache, start_server, tokenize
+from prompt_layout import PromptLayout
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+OPENERS = ["The image is a photograph of", "The image is a screenshot of", "The image shows",
+           "The image is a meme featuring", "This is a black and white cartoon of"]
+SUBJECTS = ["a crowd at a protest", "a politician giving a speech", "a graph of election results",
+            "a news article headline", "a cat sitting on a windowsill", "a street at night"]
+
+
+def synthetic_captions(count, seed=0):
+    rng = random.Random(seed)
+    return {f'{rng.getrandbits(256):064x}': {
+        "filename": f"/archive/{i}.jpg",
+        "description": f"{rng.choice(OPENERS)} {rng.choice(SUBJECTS)}. Detail number {i} differs between images."}
+        for i in range(count)}
+
+
+def tagging_reuse(items, concurrency, order):
+    server, address = start_server(latency_ms=20, slots=concurrency)
+    directory = tempfile.mkdtemp(prefix='prefix_bench_')
+    try:
+        os.makedirs(os.path.join(directory, 'data'))
+        with open(os.path.join(directory, 'data', 'images_captioned.json'), 'w') as f:
+            json.dump(synthetic_captions(items), f)
+        with open(os.path.join(directory, 'available_tags.txt'), 'w') as f:
+            f.write(", ".join(SUBJECTS))
+        shutil.copy(os.path.join(REPO_DIR, 'tagging_prompt_template.txt'), directory)
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, 'tag_caption_output.py'), '--server', address,
+                        '--async', '--concurrency', str(concurrency), '--order', order],
+                       cwd=directory, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with urllib.request.urlopen(f'http://{address}/stats') as response:
+            return json.load(response)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def old_weights_layout(layout, tag_pairs_str):
+    # The layout before this change: intro, pairs, then the format instructions
+    intro_at = layout.prefix.rindex('You are an assistant')
+    examples, final = layout.prefix[:intro_at], layout.prefix[intro_at:]
+    intro, rest = final.split('\n\n', 1)
+    instructions = rest.rsplit('Here are the tag pairs:', 1)[0].strip()
+    return f"{examples}{intro}\n\nHere are the tag pairs:\n\n{tag_pairs_str}\n\n{instructions}"
+
+
+def weights_reuse(tags, requests, chunk_size, old):
+    with open(os.path.join(REPO_DIR, 'tag_weights_prompt_template.txt')) as f:
+        layout = PromptLayout(f.read(), '%TAG_PAIRS%')
+    pairs = list(itertools.combinations([f'Tag {i:03d}' for i in range(tags)], 2))
+    rng = random.Random(0)
+    cache = PrefixCache(1)
+    for _ in range(requests):
+        if old:
+            chunk = rng.sample(pairs, chunk_size)
+        else:
+            pairs.sort()
+            chunk = pairs[:chunk_size]
+        for pair in chunk:
+            pairs.remove(pair)
+        tag_pairs_str = ',\n'.join(json.dumps({"tag1": a, "tag2": b}) for a, b in chunk)
+        prompt = old_weights_layout(layout, tag_pairs_str) if old else layout.render(tag_pairs_str)
+        cache.release(cache.acquire(tokenize(prompt)))
+    return cache.stats()
+
+
+def show(label, stats):
+    new_tokens = stats['prompt_tokens'] - stats['reused_prefix_tokens']
+    print(f"  {label:34s} {stats['reuse_ratio']:7.2%} reused, {new_tokens:8d} tokens evaluated")
+
+
+def main(args):
+    print(f"Tagging {args.items} captions, {args.concurrency} slots")
+    for order in ('file', 'caption'):
+        show(f"{order} order", tagging_reuse(args.items, args.concurrency, order))
+    print(f"Weighting {args.requests} chunks of 20 pairs from {args.tags} tags, 1 slot")
+    show("random chunks, pairs mid-prompt", weights_reuse(args.tags, args.requests, 20, old=True))
+    show("sorted chunks, pairs last", weights_reuse(args.tags, args.requests, 20, old=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure prompt prefix reuse against the fake generate server")
+    parser.add_argument('--items', type=int, default=96)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--tags', type=int, default=60)
+    parser.add_argument('--requests', type=int, default=40)
+    main(parser.parse_args())
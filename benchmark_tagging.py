@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# benchmark_tagging.py
+#
+# Throughput of tag_caption_output.py against fake_generate_server.py: the
+# blocking mode, then --async at several concurrency levels. Each run tags the
+# same synthetic captions from scratch in a scratch directory. Then compares
+# prompt tokens per tagged image with and without --pack, and failed results
+# and wasted tokens with and without --grammar when the server sometimes sends
+# malformed output.
+#
+# Usage: python benchmark_tagging.py [--items 64] [--latency-ms 200] [--slots 16] [--concurrency 1 4 16] [--pack 1 8]
+#                                    [--malformed-rate 0.1]
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_generate_server import start_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def prepare(directory, items):
+    os.makedirs(os.path.join(directory, 'data'))
+    captions = {f'{i:064x}': {"filename": f"/archive/{i}.jpg",
+                              "description": f"The image is synthetic test picture number {i} showing a graph."}
+                for i in range(items)}
+    with open(os.path.join(directory, 'data', 'images_captioned.json'), 'w') as f:
+        json.dump(captions, f)
+    with open(os.path.join(directory, 'available_tags.txt'), 'w') as f:
+        f.write("Politics, Social Issues, Graph, USA, Controversy")
+    shutil.copy(os.path.join(REPO_DIR, 'tagging_prompt_template.txt'), directory)
+    shutil.copy(os.path.join(REPO_DIR, 'tagging_packed_prompt_template.txt'), directory)
+
+
+def run(directory, server, extra_args):
+    tagged_path = os.path.join(directory, 'data', 'images_captioned_tagged.json')
+    # Start from scratch: drop the tagged JSON and the results log it would resume from
+    for path in (tagged_path, tagged_path[:-len('.json')] + '.db'):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'tag_caption_output.py'), '--server', server] + extra_args,
+                            cwd=directory, check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - start
+    with open(tagged_path) as f:
+        tagged = sum(1 for item in json.load(f).values() if 'tags' in item)
+    report = re.search(r'^Prompt tokens: .*$', output, re.MULTILINE)
+    responses = re.search(r'^Responses: .*$', output, re.MULTILINE)
+    return tagged, elapsed, report.group(0) if report else '', responses.group(0) if responses else ''
+
+
+def main(args):
+    server, address = start_server(latency_ms=args.latency_ms, slots=args.slots, error_rate=args.error_rate,
+                                   drop_rate=args.drop_rate)
+    directory = tempfile.mkdtemp(prefix='tagging_bench_')
+    try:
+        prepare(directory, args.items)
+        print(f"{args.items} captions, fake server latency {args.latency_ms} ms, {args.slots} slots")
+        tagged, elapsed, _, _ = run(directory, address, [])
+        print(f"  blocking:              {tagged / elapsed:7.2f} items/sec ({tagged} in {elapsed:.1f}s)")
+        for concurrency in args.concurrency:
+            tagged, elapsed, _, _ = run(directory, address, ['--async', '--concurrency', str(concurrency)])
+            print(f"  async, {concurrency:3d} in flight: {tagged / elapsed:7.2f} items/sec ({tagged} in {elapsed:.1f}s)")
+        print(f"Packing, 4 in flight, {args.drop_rate:.0%} of packed sub-results dropped")
+        for pack in args.pack:
+            tagged, elapsed, report, _ = run(directory, address, ['--async', '--concurrency', '4', '--pack', str(pack),
+                                                               '--count-tokens'])
+            print(f"  pack {pack:3d}: {tagged / elapsed:7.2f} items/sec; {report}")
+        print(f"Constrained output, 4 in flight, {args.malformed_rate:.0%} of unconstrained responses malformed")
+        server.RequestHandlerClass.malformed_rate = args.malformed_rate
+        for label, extra in (('free-form', []), ('--grammar', ['--grammar'])):
+            tagged, elapsed, _, responses = run(directory, address, ['--async', '--concurrency', '4'] + extra)
+            print(f"  {label:9s}: {tagged}/{args.items} tagged; {responses}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark tagging throughput against the fake generate server")
+    parser.add_argument('--items', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--slots', type=int, default=16)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--pack', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--drop-rate', type=float, default=0.05)
+    parser.add_argument('--malformed-rate', type=float, default=0.1)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# benchmark_thumbnail_atlas.py
+#
+# What the 3D spicy view has to fetch to show every thumbnail of a slice, on a
+# synthetic corpus spread over the 11 spicy slices: one 400px JPEG per item as
+# before, one 64px or 128px file per item from the pyramid make_thumbnails.py
+# now writes, or the few sprite sheets thumbnail_atlas.py packs them into.
+# Also times the pyramid and atlas builds.
+#
+# Usage: python benchmark_thumbnail_atlas.py [--images 1000] [--width 1600] [--height 1200] [--format webp]
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmark_thumbnails import make_corpus
+
+
+def directory_bytes(path, suffix):
+    total = count = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(suffix):
+                total += os.path.getsize(os.path.join(root, name))
+                count += 1
+    return count, total
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix='atlas_bench_')
+    cwd = os.getcwd()
+    try:
+        make_corpus(directory, args.images, args.width, args.height)
+        os.chdir(directory)
+        import make_thumbnails
+        import thumbnail_atlas
+
+        # Spicy scores for the corpus, skewed towards the mild end like real tagging output
+        rng = random.Random(0)
+        tagged = {hashlib.sha256(str(i).encode()).hexdigest(): {"spicy": round(rng.betavariate(1.5, 4), 2)}
+                  for i in range(args.images)}
+        with open(thumbnail_atlas.TAGGED_PATH, 'w') as f:
+            json.dump(tagged, f)
+
+        start = time.perf_counter()
+        make_thumbnails.main(args.workers, pyramid_format=args.format)
+        pyramid_time = time.perf_counter() - start
+        start = time.perf_counter()
+        thumbnail_atlas.main(image_format=args.format, workers=args.workers)
+        atlas_time = time.perf_counter() - start
+
+        slices = thumbnail_atlas.group_by_slice(tagged)
+        largest = max(len(hashes) for hashes in slices.values())
+        with open(os.path.join(thumbnail_atlas.ATLAS_DIR, 'manifest.json')) as f:
+            manifest = json.load(f)
+        print(f"\n{args.images} images of {args.width}x{args.height} in {len(slices)} slices (largest {largest}); "
+              f"pyramid built in {pyramid_time:.1f}s, atlases in {atlas_time:.1f}s")
+        print("  fetching every thumbnail once:")
+        count, total = directory_bytes(make_thumbnails.THUMBNAIL_DIR, '.jpg')
+        print(f"    {'400px jpeg per item':22s}: {count:6d} requests, {total / 2**20:7.2f} MB")
+        for size in thumbnail_atlas.ATLAS_SIZES:
+            count, total = directory_bytes(os.path.join(make_thumbnails.THUMBNAIL_DIR, str(size)), f'.{args.format}')
+            print(f"    {f'{size}px {args.format} per item':22s}: {count:6d} requests, {total / 2**20:7.2f} MB")
+            count, total = directory_bytes(os.path.join(thumbnail_atlas.ATLAS_DIR, str(size)), f'.{args.format}')
+            total += os.path.getsize(os.path.join(thumbnail_atlas.ATLAS_DIR, 'manifest.json'))
+            sheets_per_slice = max(len(sheets) for sheets in manifest['sizes'][str(size)]['slices'].values())
+            print(f"    {f'{size}px {args.format} atlases':22s}: {count + 1:6d} requests, {total / 2**20:7.2f} MB "
+                  f"(with the manifest; at most {sheets_per_slice} per slice)")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-item thumbnails against per-slice sprite sheets")
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--format', choices=['webp', 'avif'], default='webp')
+    parser.add_argument('--workers', type=int, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# benchmark_thumbnails.py
+#
+# Thumbnails per second and peak memory for make_thumbnails.py on a synthetic
+# corpus of large JPEGs. The hash -> path index is hashMapper.js's
+# hash_path_cache.json. Compares:
+#
+#   - threads: the old builder, 8 threads decoding every pixel
+#   - processes: the process pool with JPEG draft decoding
+#   - rerun: the process pool again, with every thumbnail already up to date
+#
+# Each variant runs in its own process so peak RSS is measured independently;
+# for the process pool the largest worker is reported too.
+#
+# Usage: python benchmark_thumbnails.py [--images 200] [--width 4000] [--height 3000] [--workers N]
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_corpus(directory, count, width, height):
+    images = os.path.join(directory, 'images')
+    os.makedirs(images)
+    # One photo-like base (gradient plus noise, so it doesn't compress to nothing),
+    # saved at varying quality so the files differ
+    base = Image.merge('RGB', [Image.linear_gradient('L').resize((width, height)),
+                               Image.effect_noise((width, height), 40),
+                               Image.radial_gradient('L').resize((width, height))])
+    mappings, data = {}, {}
+    for i in range(count):
+        path = os.path.join(images, f'{i}.jpg')
+        base.save(path, format='JPEG', quality=80 + i % 15)
+        hash_key = hashlib.sha256(str(i).encode()).hexdigest()
+        mappings[hash_key] = path
+        data[hash_key] = {"filename": path}
+    os.makedirs(os.path.join(directory, 'data'))
+    with open(os.path.join(directory, 'data', 'adjusted_data.json'), 'w') as f:
+        json.dump(data, f)
+    with open(os.path.join(directory, 'hash_path_cache.json'), 'w') as f:
+        json.dump({"mappings": mappings}, f)
+    return os.path.getsize(path)
+
+
+def old_thumbnail(hash_key, img_path):
+    # make_thumbnails.process_image as it was: full decode, LANCZOS, always rewritten
+    img = Image.open(img_path).convert('RGB')
+    width = 400
+    if img.size[0] > width:
+        height = int(img.size[1] * (width / float(img.size[0])))
+        img = img.resize((width, height), resample=Image.LANCZOS)
+    output_dir = os.path.join('public', 'thumbnails', hash_key[0], hash_key[1], hash_key[2])
+    os.makedirs(output_dir, exist_ok=True)
+    img.save(os.path.join(output_dir, f"{hash_key[3:]}.jpg"), format='JPEG', quality=85)
+
+
+def child(variant, workers):
+    start = time.perf_counter()
+    if variant == 'threads':
+        with open('hash_path_cache.json') as f:
+            mappings = json.load(f)['mappings']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda item: old_thumbnail(*item), mappings.items()))
+    else:
+        import make_thumbnails
+        make_thumbnails.main(workers, pyramid_format=None)
+    elapsed = time.perf_counter() - start
+    made = sum(len(files) for _, _, files in os.walk(os.path.join('public', 'thumbnails')))
+    print(json.dumps({"elapsed": elapsed, "made": made, "rss": peak_rss_mb(),
+                      "worker_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0}))
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix='thumbnail_bench_')
+    try:
+        size = make_corpus(directory, args.images, args.width, args.height)
+        print(f"{args.images} JPEGs of {args.width}x{args.height} (~{size / 2**20:.1f} MB each), "
+              f"{args.workers or os.cpu_count()} worker processes")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                        os.environ.get('PYTHONPATH')])))
+        for variant in ('threads', 'processes', 'rerun'):
+            if variant != 'rerun':
+                shutil.rmtree(os.path.join(directory, 'public'), ignore_errors=True)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', variant,
+                                     '--workers', str(args.workers or 0)],
+                                    cwd=directory, env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            workers = f", largest worker {result['worker_rss']:.0f} MB" if variant != 'threads' else ''
+            print(f"  {variant:9s}: {args.images / result['elapsed']:8.1f} images/sec ({result['elapsed']:.1f}s, "
+                  f"{result['made']} thumbnails on disk), peak RSS {result['rss']:.0f} MB{workers}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark thumbnail building on a synthetic JPEG corpus")
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--child', choices=['threads', 'processes', 'rerun'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.workers or None)
+    else:
+        main(args)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# benchmark_weight_queue.py
+#
+# Bookkeeping cost of assign_weights.py with the LLM taken out: every batch
+# "weighs" its pairs instantly. The old loop rescanned every pair for the
+# unweighted ones and rewrote the whole weights JSON after each batch, so it
+# is timed over its first --sample batches and extrapolated. The queue
+# (weight_queue.py) is seeded once and drained completely by 1 and then
+# --workers processes, checking that no pair is handed out twice.
+#
+# Usage: python benchmark_weight_queue.py [--tags 500] [--chunk 20] [--sample 20] [--workers 4]
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from weight_queue import has_weight, open_weight_queue
+
+MAX_PAIR_ATTEMPTS = 3
+
+
+def write_pairs(directory, tags):
+    tag_pairs = {}
+    for tag1, tag2 in itertools.combinations([f'Tag {i:03d}' for i in range(tags)], 2):
+        tag_pairs.setdefault(tag1, {})[tag2] = None
+    path = os.path.join(directory, 'tag_pairs.json')
+    with open(path, 'w') as f:
+        json.dump(tag_pairs, f, indent=2)
+    return path, tag_pairs
+
+
+def old_batch(tag_pairs, weighted_pairs, weights_path, chunk):
+    # generate_prompt's rescan and save_data's full rewrite, as they were
+    unweighted_pairs = []
+    for tag1, pairs in tag_pairs.items():
+        for tag2 in pairs:
+            if not has_weight(tag1, tag2, weighted_pairs):
+                unweighted_pairs.append((tag1, tag2))
+    unweighted_pairs.sort()
+    for tag1, tag2 in unweighted_pairs[:chunk]:
+        weighted_pairs.setdefault(tag1, {})[tag2] = 0.5
+    with open(weights_path, 'w') as f:
+        json.dump(weighted_pairs, f, indent=2)
+
+
+def drain(args):
+    tag_pairs_path, weights_path, chunk, worker = args
+    queue = open_weight_queue(tag_pairs_path, weights_path)
+    claimed = []
+    while True:
+        pairs = queue.claim(worker, chunk)
+        if not pairs:
+            break
+        queue.complete(pairs, [(tag1, tag2, 0.5) for tag1, tag2 in pairs], MAX_PAIR_ATTEMPTS)
+        claimed.extend(pairs)
+    queue.close()
+    return claimed
+
+
+def queue_run(directory, tag_pairs_path, chunk, workers):
+    weights_path = os.path.join(directory, 'weights.json')
+    queue_path = os.path.splitext(tag_pairs_path)[0] + '.queue.db'
+    # Start from nothing weighted
+    for path in (weights_path, queue_path, queue_path + '-wal', queue_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    start = time.perf_counter()
+    open_weight_queue(tag_pairs_path, weights_path).close()
+    seeded = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        claimed = pool.map(drain, [(tag_pairs_path, weights_path, chunk, f'worker-{i}') for i in range(workers)])
+    drained = time.perf_counter()
+    queue = open_weight_queue(tag_pairs_path, weights_path)
+    queue.export(weights_path)
+    counts = queue.counts()
+    queue.close()
+    exported = time.perf_counter()
+    all_claimed = [pair for pairs in claimed for pair in pairs]
+    assert len(all_claimed) == len(set(all_claimed)) == counts['done'], "a pair was handed out twice"
+    return seeded - start, drained - seeded, exported - drained, [len(pairs) for pairs in claimed]
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix='weight_queue_bench_')
+    try:
+        tag_pairs_path, tag_pairs = write_pairs(directory, args.tags)
+        total = sum(len(pairs) for pairs in tag_pairs.values())
+        batches = -(-total // args.chunk)
+        print(f"{args.tags} tags, {total} pairs, {batches} batches of {args.chunk}")
+
+        weighted_pairs = {}
+        start = time.perf_counter()
+        for _ in range(args.sample):
+            old_batch(tag_pairs, weighted_pairs, os.path.join(directory, 'old_weights.json'), args.chunk)
+        per_batch = (time.perf_counter() - start) / args.sample
+        # Later batches rewrite a bigger JSON, so this understates the total
+        print(f"  rescan + rewrite: {per_batch * 1000:8.1f} ms/batch over the first {args.sample}, "
+              f">= {per_batch * batches / 60:.1f} min for all batches")
+
+        for workers in sorted({1, args.workers}):
+            seed, drain_time, export, shares = queue_run(directory, tag_pairs_path, args.chunk, workers)
+            print(f"  queue, {workers} worker(s): seed {seed:.2f}s, {drain_time / batches * 1000:.2f} ms/batch, "
+                  f"all batches in {drain_time:.1f}s, export {export:.2f}s; pairs per worker {shares}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark assign_weights.py bookkeeping: rescan vs work queue")
+    parser.add_argument('--tags', type=int, default=500)
+    parser.add_argument('--chunk', type=int, default=20)
+    parser.add_argument('--sample', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    main(parser.parse_args())
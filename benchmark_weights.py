@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# benchmark_weights.py
+#
+# Throughput of assign_weights.py against fake_generate_server.py with a fixed
+# number of slots and a bounded queue (503 once --max-queue requests wait):
+# the blocking mode with its 5 second sleep (a few batches only), then --async
+# with a fixed concurrency at and above the slot count, and with adaptive
+# pacing from a high ceiling. Each run weighs the same synthetic pairs from
+# scratch and checks every pair got a weight.
+#
+# Usage: python benchmark_weights.py [--tags 100] [--latency-ms 200] [--slots 4] [--max-queue 4] [--ceiling 16]
+
+import argparse
+import ast
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_generate_server import start_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def prepare(directory, tags):
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    tag_pairs = {}
+    for tag1, tag2 in itertools.combinations([f'Tag {i:03d}' for i in range(tags)], 2):
+        tag_pairs.setdefault(tag1, {})[tag2] = None
+    with open(os.path.join(directory, 'data', 'tag_pairs.json'), 'w') as f:
+        json.dump(tag_pairs, f)
+    for name in os.listdir(os.path.join(directory, 'data')):
+        if name != 'tag_pairs.json':
+            os.remove(os.path.join(directory, 'data', name))
+    shutil.copy(os.path.join(REPO_DIR, 'tag_weights_prompt_template.txt'), directory)
+    return sum(len(pairs) for pairs in tag_pairs.values())
+
+
+def server_stats(address):
+    with urllib.request.urlopen(f'http://{address}/stats') as response:
+        return json.load(response)
+
+
+def run(directory, address, tags, extra_args):
+    pairs = prepare(directory, tags)
+    busy_before = server_stats(address)['busy']
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'assign_weights.py'), '--server', address] + extra_args,
+                            cwd=directory, check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(directory, 'data', 'tag_pairs_with_weights.json')) as f:
+        weighted = sum(len(weights) for weights in json.load(f).values())
+    client = re.search(r'^LLM client: (.*)$', output, re.MULTILINE)
+    batches = len(re.findall(r'^Sending request for', output, re.MULTILINE))
+    return {"pairs": pairs, "weighted": weighted, "elapsed": elapsed, "batches": batches,
+            "busy": server_stats(address)['busy'] - busy_before,
+            "client": ast.literal_eval(client.group(1)) if client else {}}
+
+
+def show(label, result):
+    client = result["client"]
+    latency = f", mean latency {client['mean_latency']:.2f}s" if client else ''
+    limit = f", limit ended at {client['concurrency_limit']}" if 'concurrency_limit' in client else ''
+    print(f"  {label:26s} {result['batches'] / result['elapsed'] * 60:8.1f} batches/min, "
+          f"{result['weighted']}/{result['pairs']} weighted in {result['elapsed']:.1f}s, "
+          f"{result['busy']} turned away busy{latency}{limit}")
+
+
+def main(args):
+    server, address = start_server(latency_ms=args.latency_ms, slots=args.slots, max_queue=args.max_queue)
+    directory = tempfile.mkdtemp(prefix='weights_bench_')
+    try:
+        print(f"Fake server: {args.slots} slots, {args.latency_ms:.0f} ms per request, 503 beyond {args.max_queue} queued")
+        # Four batches of 20 pairs are enough to see the sleep-bound rate
+        show("blocking, sleep 5s", run(directory, address, 12, []))
+        for concurrency in sorted({args.slots, args.ceiling}):
+            show(f"async, {concurrency} fixed", run(directory, address, args.tags,
+                                                    ['--async', '--concurrency', str(concurrency), '--fixed-concurrency']))
+        show(f"async, adaptive up to {args.ceiling}", run(directory, address, args.tags,
+                                                          ['--async', '--concurrency', str(args.ceiling)]))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark assign_weights.py request pacing against the fake server")
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--slots', type=int, default=4)
+    parser.add_argument('--max-queue', type=int, default=4)
+    parser.add_argument('--ceiling', type=int, default=16)
+    main(parser.parse_args())
@@ -1,79 +1,127 @@
 #!/usr/bin/env python3
 import os
 import sys
+import argparse
 import hashlib
-import json
+import mmap
+import threading
+import time
 import requests
 import signal
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from PIL import Image
 from pathlib import Path
+from hash_cache import HashCache, HASH_CACHE_PATH
+from caption_store import CaptionStore, CAPTION_STORE_PATH
 
 # Constants
 #CAPTION_ENDPOINT = "http://mlboy:8000/caption"
 CAPTION_ENDPOINT = "http://bestiary:8000/caption"
 SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
-LOCAL_DB_PATH = 'images_captioned.json'
-BATCH_SAVE_INTERVAL = 10
-
-# Load the local database of processed files
-def load_local_db(db_path):
-    if os.path.exists(db_path):
-        with open(db_path, 'r') as f:
-            return json.load(f)
-    else:
-        return {}
+LOCAL_DB_PATH = CAPTION_STORE_PATH
+# Imported into the store on first run, and rewritten from it after every run
+LEGACY_DB_PATH = 'images_captioned.json'
+HASH_WORKERS = 8
+UPLOAD_WORKERS = 4
+# Files hashed or uploading at once; the directory walk blocks beyond this,
+# so a slow server throttles the whole pipeline instead of queueing the tree
+MAX_IN_FLIGHT = 32
+# Retries for 429/503 and connection errors, with exponential backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2.0
+HASH_READ_SIZE = 1024 * 1024
+
+processed_files = None
+counter_lock = threading.Lock()
+
+# Open the local database of processed files, importing the legacy JSON once
+def load_local_db(db_path, legacy_path=LEGACY_DB_PATH):
+    is_new = not os.path.exists(db_path)
+    store = CaptionStore(db_path)
+    if is_new and os.path.exists(legacy_path):
+        count = store.import_json(legacy_path)
+        print(f"Imported {count} entries from {legacy_path}.")
+    return store
 
-# Save the local database of processed files
-def save_local_db(db, db_path):
-    with open(db_path, 'w') as f:
-        json.dump(db, f, indent=4)
-    print(f"Saved local database to {db_path}")
+# Rewrite the legacy JSON from the store; tag_caption_output.py still reads that
+# layout (copied to data/images_captioned.json), as it did when this script wrote it
+def export_legacy_json(json_path=LEGACY_DB_PATH):
+    count = processed_files.export_json(json_path)
+    print(f"Exported {count} captions to {json_path}.")
 
-# Handle Ctrl+C and save the database on exit
+# Handle Ctrl+C; every caption is committed as it arrives
 def handle_exit(signum, frame):
-    print("\nSaving local database before exit...")
-    save_local_db(processed_files, LOCAL_DB_PATH)
+    print("\nClosing local database before exit...")
+    if processed_files is not None:
+        export_legacy_json()
+        processed_files.close()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, handle_exit)
 
-# Calculate SHA-256 hash of the file contents
+# Calculate SHA-256 hash of the file contents, mapping the file instead of
+# copying it through small reads
 def calculate_file_hash(file_path):
     sha256_hash = hashlib.sha256()
     with open(file_path, 'rb') as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
-
-# Call the /caption endpoint for the given image file
-def caption_image(file_path):
-    with open(file_path, 'rb') as f:
-        files = {'file': (os.path.basename(file_path), f)}
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return sha256_hash.hexdigest()
         try:
-            response = requests.post(CAPTION_ENDPOINT, files=files)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            print(f"Error processing file {file_path}: {e}")
-            return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha256_hash.update(mapped)
+        except (OSError, ValueError):
+            # Some filesystems (FUSE, network mounts) refuse mmap
+            for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
 
-def process_image(file_path):
-    file_hash = calculate_file_hash(file_path)
+# One keep-alive session with a connection per upload worker
+def make_session(upload_workers=UPLOAD_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=upload_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    # Skip if the image has already been processed
-    if file_hash in processed_files:
-        #print(f"File already processed: {file_path}")
-        return False
+# Call the /caption endpoint for the given image file
+def caption_image(file_path, session=None, endpoint=None):
+    session = session or requests
+    endpoint = endpoint or CAPTION_ENDPOINT
+    delay = RETRY_BACKOFF
+    for attempt in range(MAX_RETRIES + 1):
+        with open(file_path, 'rb') as f:
+            files = {'file': (os.path.basename(file_path), f)}
+            try:
+                response = session.post(endpoint, files=files)
+                if response.status_code in (429, 503) and attempt < MAX_RETRIES:
+                    # Server is saturated; back off before trying again
+                    retry_after = response.headers.get('Retry-After')
+                    time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else delay)
+                    delay *= 2
+                    continue
+                response.raise_for_status()
+                return response.json()
+            except requests.ConnectionError as e:
+                if attempt < MAX_RETRIES:
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+                print(f"Error processing file {file_path}: {e}")
+                return None
+            except requests.RequestException as e:
+                print(f"Error processing file {file_path}: {e}")
+                return None
+    return None
 
-    result = caption_image(file_path)
+# Record a /caption response; returns True if a new caption was stored
+def record_result(file_path, file_hash, result):
     if result and "results" in result:
         caption_data = result["results"].get(file_hash, {})
         if "description" in caption_data and caption_data["description"]:
-            processed_files[file_hash] = {
-                "filename": caption_data["filename"],
-                "description": caption_data["description"]
-            }
+            processed_files.put(file_hash, caption_data["filename"], caption_data["description"])
 
             print(f"Captioned: {caption_data['filename']}")
             print(f"Description: {caption_data['description']}")
@@ -86,60 +134,140 @@ def process_image(file_path):
 
     return False
 
-# Get all image files from the provided directory
-def get_image_files(directory):
-    image_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if Path(file).suffix.lower() in SUPPORTED_EXTENSIONS:
-                image_files.append(os.path.join(root, file))
-    return image_files
+# Hash through the stat cache when there is one, so unchanged files are not reread
+def file_hash_for(file_path, hash_cache=None):
+    if hash_cache is not None:
+        return hash_cache.hash_file(file_path, calculate_file_hash)
+    return calculate_file_hash(file_path)
+
+def process_image(file_path, session=None, endpoint=None, hash_cache=None):
+    file_hash = file_hash_for(file_path, hash_cache)
+
+    # Skip if the image has already been processed
+    if file_hash in processed_files:
+        #print(f"File already processed: {file_path}")
+        return False
+
+    return record_result(file_path, file_hash, caption_image(file_path, session, endpoint))
+
+# Stream image files from the provided directory without listing it all first
+def iter_image_files(directory):
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        print(f"Error reading directory {directory}: {e}")
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_image_files(entry.path)
+            elif Path(entry.name).suffix.lower() in SUPPORTED_EXTENSIONS:
+                yield entry.path
+
+# Hash on one pool and upload on another, keeping at most max_in_flight files
+# between the walk and the server. Returns the number of new captions.
+# on_result, if given, is called from the worker threads with each file's path
+# and 'captioned', 'seen' (captioned before) or 'failed'.
+def run_pipeline(image_files, endpoint=None, hash_workers=HASH_WORKERS, upload_workers=UPLOAD_WORKERS,
+                 max_in_flight=MAX_IN_FLIGHT, progress=True, hash_cache=None, on_result=None):
+    session = make_session(upload_workers)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    counters = {"new": 0}
+    progress_bar = tqdm(desc="Processing images", unit="file", disable=not progress)
+
+    def finish(file_path, outcome):
+        if outcome == 'captioned':
+            with counter_lock:
+                counters["new"] += 1
+        if on_result is not None:
+            on_result(file_path, outcome)
+        progress_bar.update(1)
+        in_flight.release()
+
+    def upload(file_path, file_hash):
+        try:
+            captioned = record_result(file_path, file_hash, caption_image(file_path, session, endpoint))
+            finish(file_path, 'captioned' if captioned else 'failed')
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+            finish(file_path, 'failed')
+
+    def hash_then_upload(file_path):
+        # Every path must end in finish(), or its permit leaks and the drain below never returns
+        try:
+            file_hash = file_hash_for(file_path, hash_cache)
+            seen = file_hash in processed_files
+        except Exception as e:
+            print(f"Error hashing file {file_path}: {e}")
+            finish(file_path, 'failed')
+            return
+        if seen:
+            finish(file_path, 'seen')
+            return
+        try:
+            upload_pool.submit(upload, file_path, file_hash)
+        except Exception as e:
+            print(f"Error queueing file {file_path}: {e}")
+            finish(file_path, 'failed')
+
+    with ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+        with ThreadPoolExecutor(max_workers=hash_workers) as hash_pool:
+            for image_file in image_files:
+                in_flight.acquire()
+                hash_pool.submit(hash_then_upload, image_file)
+        # Wait for every hash and upload to drain
+        for _ in range(max_in_flight):
+            in_flight.acquire()
+
+    progress_bar.close()
+    session.close()
+    if hash_cache is not None:
+        hash_cache.flush()
+    return counters["new"]
 
 # Main function
-def main(path):
+def main(path, hash_workers=HASH_WORKERS, upload_workers=UPLOAD_WORKERS, max_in_flight=MAX_IN_FLIGHT,
+         hash_cache_path=HASH_CACHE_PATH, endpoint=None):
     global processed_files
 
     # Load processed images from the local database
     processed_files = load_local_db(LOCAL_DB_PATH)
     print(f"Loaded local database with {len(processed_files)} entries.")
 
-    new_images_processed = False
+    hash_cache = HashCache(hash_cache_path) if hash_cache_path else None
 
     # If path is a file, process only that file
     if os.path.isfile(path):
         print(f"Processing single file: {path}")
-        if process_image(path):
-            new_images_processed = True
+        process_image(path, endpoint=endpoint, hash_cache=hash_cache)
     elif os.path.isdir(path):
         print(f"Processing directory: {path}")
-        image_files = get_image_files(path)
-        print(f"Found {len(image_files)} image files in {path}.")
-
-        progress_bar = tqdm(image_files, desc="Processing images", unit="file")
-        save_counter = 0
+        new_captions = run_pipeline(iter_image_files(path), endpoint=endpoint, hash_workers=hash_workers,
+                                    upload_workers=upload_workers, max_in_flight=max_in_flight,
+                                    hash_cache=hash_cache)
+        print(f"Captioned {new_captions} new images from {path}.")
 
-        for image_file in progress_bar:
-            if process_image(image_file):
-                new_images_processed = True
-                save_counter += 1
-
-            if save_counter >= BATCH_SAVE_INTERVAL:
-                save_local_db(processed_files, LOCAL_DB_PATH)
-                save_counter = 0  # Reset the counter
-
-    if new_images_processed:
-        save_local_db(processed_files, LOCAL_DB_PATH)
+    export_legacy_json()
+    processed_files.close()
+    if hash_cache is not None:
+        hash_cache.close()
     print("Finished processing all images.")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python caption_images_with_cogvlm2.py <file_or_directory>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Caption images with the CogVLM2 server")
+    parser.add_argument("path", help="Image file or directory")
+    parser.add_argument("--hash-workers", type=int, default=HASH_WORKERS)
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS)
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--hash-cache", default=HASH_CACHE_PATH, help="Stat -> hash cache database")
+    parser.add_argument("--no-hash-cache", action="store_true", help="Rehash every file")
+    parser.add_argument("--endpoint", default=CAPTION_ENDPOINT, help="CogVLM2 /caption URL")
+    args = parser.parse_args()
 
-    path = sys.argv[1]
+    path = args.path
     if not os.path.exists(path):
         print(f"Error: {path} is not a valid file or directory.")
         sys.exit(1)
 
-    main(path)
-
+    main(path, args.hash_workers, args.upload_workers, args.max_in_flight,
+         None if args.no_hash_cache else args.hash_cache, args.endpoint)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# caption_store.py
+#
+# The captioner's local database of processed images, hash -> (filename,
+# description), in SQLite instead of one JSON dict. Adding a caption is a
+# single-row insert and membership is an index lookup, so neither depends on
+# how many images are already captioned and nothing has to be held in RAM.
+#
+# The legacy images_captioned.json is still the input of tag_caption_output.py;
+# the captioner exports it after every run, the ingestion daemon periodically
+# and at shutdown, and export here writes it on demand.
+# import loads an existing one.
+#
+# Usage: python caption_store.py import [images_captioned.json] [--db images_captioned.db]
+#        python caption_store.py export [images_captioned.json] [--db images_captioned.db]
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+CAPTION_STORE_PATH = 'images_captioned.db'
+LEGACY_JSON_PATH = 'images_captioned.json'
+IMPORT_CHUNK = 10000
+
+
+class CaptionStore:
+    def __init__(self, path=CAPTION_STORE_PATH):
+        self.path = path
+        # Shared by the hashing and upload threads; every statement is short
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS captions (
+                hash TEXT PRIMARY KEY,
+                filename TEXT,
+                description TEXT
+            )
+        ''')
+        self.conn.commit()
+
+    def __contains__(self, hash_value):
+        with self.lock:
+            cursor = self.conn.execute('SELECT 1 FROM captions WHERE hash=?', (hash_value,))
+            return cursor.fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM captions').fetchone()[0]
+
+    def get(self, hash_value):
+        with self.lock:
+            cursor = self.conn.execute('SELECT filename, description FROM captions WHERE hash=?', (hash_value,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return {"filename": row[0], "description": row[1]}
+
+    def put(self, hash_value, filename, description):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO captions (hash, filename, description) VALUES (?, ?, ?)',
+                              (hash_value, filename, description))
+            self.conn.commit()
+
+    def items(self):
+        """Iterates (hash, {"filename", "description"}) in insertion order without loading the table."""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT hash, filename, description FROM captions ORDER BY rowid')
+        for hash_value, filename, description in cursor:
+            yield hash_value, {"filename": filename, "description": description}
+
+    def import_json(self, json_path):
+        """Loads a legacy images_captioned.json. Existing hashes are overwritten. Returns the entry count."""
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        rows = [(hash_value, entry.get("filename"), entry.get("description")) for hash_value, entry in data.items()]
+        del data
+        with self.lock:
+            for start in range(0, len(rows), IMPORT_CHUNK):
+                self.conn.executemany('INSERT OR REPLACE INTO captions (hash, filename, description) VALUES (?, ?, ?)',
+                                      rows[start:start + IMPORT_CHUNK])
+            self.conn.commit()
+        return len(rows)
+
+    def export_json(self, json_path):
+        """Writes the legacy JSON layout, streaming rows so the dict is never built. Returns the entry count."""
+        tmp_path = json_path + '.tmp'
+        count = 0
+        with open(tmp_path, 'w') as f:
+            f.write('{')
+            for hash_value, entry in self.items():
+                body = json.dumps(entry, indent=4).replace('\n', '\n    ')
+                f.write(f'{"," if count else ""}\n    {json.dumps(hash_value)}: {body}')
+                count += 1
+            f.write('\n}' if count else '}')
+        os.replace(tmp_path, json_path)
+        return count
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import or export the legacy images_captioned.json")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("json_path", nargs="?", default=LEGACY_JSON_PATH)
+    parser.add_argument("--db", default=CAPTION_STORE_PATH)
+    args = parser.parse_args()
+
+    store = CaptionStore(args.db)
+    if args.command == "import":
+        if not os.path.exists(args.json_path):
+            print(f"Error: {args.json_path} does not exist.")
+            sys.exit(1)
+        count = store.import_json(args.json_path)
+        print(f"Imported {count} entries from {args.json_path} into {args.db}.")
+    else:
+        count = store.export_json(args.json_path)
+        print(f"Exported {count} entries from {args.db} to {args.json_path}.")
+    store.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# batching.py
+#
+# Dynamic micro-batching in front of the model. Request handlers await
+# submit() with a single item; a worker task drains the queue into batches of
+# up to max_batch_size items, waiting at most max_wait_ms for a batch to fill,
+# runs the batch function on a dedicated thread and hands each caller back its
+# own result.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=20, name="batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self.queue = None
+        self.loop = None
+        self.worker = None
+        # One thread: the model is a single shared resource, so batches run
+        # back to back while the event loop keeps accepting requests.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        # Items already queued belong to callers still waiting, so a restarted
+        # worker carries on with the same queue; only a new event loop needs a new one
+        if self.queue is None or self.loop is not loop:
+            self.queue = asyncio.Queue()
+            self.loop = loop
+        if self.worker is None or self.worker.done():
+            self.worker = loop.create_task(self._run())
+
+    async def submit(self, item):
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name}: batch function returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            except asyncio.CancelledError:
+                # The worker is going away; don't leave this batch's callers waiting
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                self.batches += 1
+                self.items += len(items)
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
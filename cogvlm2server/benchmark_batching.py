@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# benchmark_batching.py
+#
+# Measures the micro-batcher against the CPU stub backend at several client
+# concurrency levels and prints images/sec and p50/p99 latency.
+#
+# Usage: python benchmark_batching.py [--requests 200] [--max-batch-size 8] [--max-wait-ms 20]
+
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from PIL import Image
+
+from batching import MicroBatcher
+from model_backend import StubBackend
+
+
+async def run_level(batcher, image, concurrency, total_requests):
+    latencies = []
+    remaining = [total_requests]
+
+    async def client():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            await batcher.submit(image)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000.0
+    return {
+        "images_per_sec": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_batch_size": batcher.stats()["mean_batch_size"],
+    }
+
+
+async def main(args):
+    backend = StubBackend(embedding_size=args.embedding_size, call_overhead=args.call_overhead, per_item=args.per_item)
+    image = Image.new("RGB", (64, 64), (128, 64, 32))
+
+    print(f"{'batch':>5} {'conc':>5} {'img/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'mean batch':>10}")
+    for max_batch_size in sorted({1, args.max_batch_size}):
+        for concurrency in args.concurrency:
+            batcher = MicroBatcher(backend.caption_batch, max_batch_size, args.max_wait_ms, name="bench")
+            result = await run_level(batcher, image, concurrency, args.requests)
+            print(f"{max_batch_size:>5} {concurrency:>5} {result['images_per_sec']:>8.1f} "
+                  f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['mean_batch_size']:>10.2f}")
+            batcher.executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the caption micro-batcher with a CPU stub model.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--embedding-size", type=int, default=4096)
+    parser.add_argument("--call-overhead", type=float, default=0.05, help="Stub seconds per model call")
+    parser.add_argument("--per-item", type=float, default=0.005, help="Stub seconds per item in a call")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# benchmark_embedding_formats.py
+#
+# Database size, conversion time, index rebuild time and recall@k for each
+# embedding storage format (embedding_codec.py), on a synthetic clustered
+# database. Recall is measured against exact search over the original float32
+# vectors, for:
+#
+#   flat           exact search over the decoded stored vectors
+#   sq8            the 8-bit scalar-quantized index alone
+#   sq8+rerank     sq8 candidates (k * --rerank-factor) reranked in float32 on
+#                  the stored vectors, as server.py searches lossy indexes
+#
+# Usage: python benchmark_embedding_formats.py [--rows 100000] [--dim 1024] [--queries 200] [--k 10]
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+import embedding_codec
+from image_store import ImageStore
+from index_factory import create_index, with_ids, train_index, search, rerank, sample_training_vectors
+from migrate_embedding_format import migrate, vacuum, database_size
+from rebuild_faiss_and_indices import add_in_chunks
+
+INSERT_CHUNK = 50000
+CLUSTERS = 1000
+
+
+def make_vectors(rows, dim, rng):
+    # Clustered like real embeddings, so near neighbours are meaningfully nearer than the rest
+    centers = rng.standard_normal((CLUSTERS, dim)).astype(np.float32)
+    vectors = np.empty((rows, dim), dtype=np.float32)
+    for start in range(0, rows, INSERT_CHUNK):
+        end = min(rows, start + INSERT_CHUNK)
+        vectors[start:end] = centers[rng.integers(0, CLUSTERS, end - start)]
+        vectors[start:end] += 0.5 * rng.standard_normal((end - start, dim)).astype(np.float32)
+    return vectors
+
+
+def build_database(path, vectors):
+    store = ImageStore(path)
+    conn = store.connection()
+    for start in range(0, len(vectors), INSERT_CHUNK):
+        end = min(len(vectors), start + INSERT_CHUNK)
+        conn.executemany('INSERT INTO image_data (hash, filename, description, embedding) VALUES (?, ?, ?, ?)',
+                         ((f'{i:064x}', f'/archive/{i}.jpg', f'Synthetic description number {i}.', vectors[i].tobytes())
+                          for i in range(start, end)))
+        conn.commit()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    store.close()
+
+
+def rebuild(conn, index_type, dim):
+    cursor = conn.cursor()
+    index = with_ids(create_index(index_type, dim))
+    train_index(index, sample_training_vectors(cursor, 20000, dim))
+    cursor.execute('SELECT rowid, embedding, embedding_format, embedding_scale FROM image_data')
+    add_in_chunks(index, cursor, dim)
+    return index
+
+
+def recall(found, exact, k):
+    return sum(len(set(f[:k]) & set(e)) for f, e in zip(found, exact)) / float(len(exact) * k)
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.rows, args.dim, rng)
+    picks = rng.integers(0, args.rows, args.queries)
+    queries = vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    # Ground truth over the original float32 vectors; rowids are 1-based
+    truth = faiss.IndexFlatL2(args.dim)
+    truth.add(vectors)
+    _, exact = truth.search(queries, args.k)
+    exact = exact + 1
+    del truth
+
+    directory = tempfile.mkdtemp(prefix='embedding_formats_bench_')
+    try:
+        source = os.path.join(directory, 'source.db')
+        build_database(source, vectors)
+        del vectors
+        print(f"{args.rows} vectors of {args.dim} floats, {args.queries} queries, recall@{args.k} against "
+              f"exact float32 search; sq8+rerank reranks {args.k * args.rerank_factor} candidates")
+        print(f"  {'format':8s} {'db MB':>7s} {'convert':>8s} {'rebuild':>8s} {'flat':>7s} {'sq8':>7s} "
+              f"{'sq8+rerank':>11s} {'ms/query':>9s}")
+        for fmt in embedding_codec.FORMATS:
+            path = os.path.join(directory, f'{fmt}.db')
+            shutil.copy(source, path)
+            conn = sqlite3.connect(path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            start = time.perf_counter()
+            if migrate(conn, fmt):
+                vacuum(conn)
+            convert = time.perf_counter() - start
+            size = database_size(path)
+
+            start = time.perf_counter()
+            flat = rebuild(conn, 'flat', args.dim)
+            rebuild_seconds = time.perf_counter() - start
+            _, found = flat.search(queries, args.k)
+            flat_recall = recall(found, exact, args.k)
+            del flat
+
+            sq8 = rebuild(conn, 'sq8', args.dim)
+            _, found = sq8.search(queries, args.k)
+            sq8_recall = recall(found, exact, args.k)
+            store = ImageStore(path, read_only=True)
+            reranked = []
+            start = time.perf_counter()
+            for query in queries:
+                _, candidates = search(sq8, query.reshape(1, -1), args.k * args.rerank_factor)
+                ids = [int(i) for i in candidates[0] if i >= 0]
+                reranked.append(rerank(query, candidates[0], store.embeddings_by_rowids(ids), args.k)[1][0])
+            per_query = (time.perf_counter() - start) * 1000.0 / len(queries)
+            store.close()
+            conn.close()
+            print(f"  {fmt:8s} {size / 2**20:7.0f} {convert:7.1f}s {rebuild_seconds:7.1f}s {flat_recall:7.4f} "
+                  f"{sq8_recall:7.4f} {recall(reranked, exact, args.k):11.4f} {per_query:9.2f}")
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the embedding storage formats")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank-factor', type=int, default=4)
+    main(parser.parse_args())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# benchmark_hydration.py
+#
+# Times hydrating k search results from image_data: the old one-SELECT-per-
+# neighbour loop against ImageStore's single IN query, on a synthetic database.
+#
+# Usage: python benchmark_hydration.py [--rows 1000000] [--k 100] [--dim 32] [--db /tmp/hydration_bench.db]
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from image_store import ImageStore
+
+INSERT_CHUNK = 50000
+
+
+def build_database(store, rows, dim):
+    conn = store.connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM image_data')
+    existing = cursor.fetchone()[0]
+    if existing >= rows:
+        print(f"Reusing {store.path} with {existing} rows.")
+        return
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for chunk_start in range(existing, rows, INSERT_CHUNK):
+        chunk_end = min(rows, chunk_start + INSERT_CHUNK)
+        vectors = rng.standard_normal((chunk_end - chunk_start, dim)).astype(np.float32)
+        cursor.executemany(
+            'INSERT INTO image_data (hash, filename, description, embedding) VALUES (?, ?, ?, ?)',
+            ((f'{i:064x}', f'/archive/{i}.jpg', f'Synthetic description number {i}.', vectors[i - chunk_start].tobytes())
+             for i in range(chunk_start, chunk_end)))
+        conn.commit()
+    print(f"Built {rows} rows in {time.perf_counter() - start:.1f}s.")
+
+
+def time_it(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) * 1000.0 / repeats
+
+
+def main(args):
+    store = ImageStore(args.db)
+    build_database(store, args.rows, args.dim)
+    rng = np.random.default_rng(1)
+    rowids = [int(x) for x in rng.integers(1, args.rows + 1, size=args.k)]
+    hashes = [f'{rowid - 1:064x}' for rowid in rowids]
+    cursor = store.cursor()
+
+    def per_row():
+        for hash_value in hashes:
+            cursor.execute('SELECT filename, description FROM image_data WHERE hash=?', (hash_value,))
+            cursor.fetchone()
+
+    def embeddings_copy():
+        for hash_value in hashes[:10]:
+            cursor.execute('SELECT embedding FROM image_data WHERE hash=?', (hash_value,))
+            np.array(list(np.frombuffer(cursor.fetchone()[0], dtype=np.float32)), dtype=np.float32)
+
+    def embeddings_zero_copy():
+        for hash_value in hashes[:10]:
+            store.get_embedding(hash_value)
+
+    print(f"k={args.k} over {args.rows} rows, {args.repeats} repeats")
+    print(f"  per-row SELECT by hash:   {time_it(per_row, args.repeats):8.3f} ms")
+    print(f"  one IN query by hash:     {time_it(lambda: store.hydrate_hashes(hashes), args.repeats):8.3f} ms")
+    print(f"  one IN query by rowid:    {time_it(lambda: store.hydrate_rowids(rowids), args.repeats):8.3f} ms")
+    print(f"  10 embeddings via copy:   {time_it(embeddings_copy, args.repeats):8.3f} ms")
+    print(f"  10 embeddings zero-copy:  {time_it(embeddings_zero_copy, args.repeats):8.3f} ms")
+    if not args.keep:
+        store.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark search result hydration from image_data")
+    parser.add_argument('--db', default='/tmp/hydration_bench.db')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=32, help="Synthetic embedding size (keeps the 1M-row file small)")
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--keep', action='store_true', help="Keep the synthetic database for the next run")
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# benchmark_ingest.py
+#
+# Compares ingest throughput of the old "rewrite faiss_index.bin after every
+# image" persistence with the write-ahead log, as the archive grows. Uses a
+# throwaway database and a flat index with synthetic vectors.
+#
+# Usage: python benchmark_ingest.py [--items 20000] [--dim 1024] [--report-every 2000]
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+import index_wal
+from index_factory import add_with_ids, create_index, with_ids
+
+
+def open_db(path):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_data (
+            hash TEXT PRIMARY KEY,
+            filename TEXT,
+            description TEXT,
+            embedding BLOB
+        )
+    ''')
+    index_wal.ensure_wal_tables(cursor)
+    conn.commit()
+    return conn, cursor
+
+
+def ingest(mode, workdir, args):
+    conn, cursor = open_db(os.path.join(workdir, f'{mode}.db'))
+    index_path = os.path.join(workdir, f'{mode}.bin')
+    index = with_ids(create_index('flat', args.dim))
+    rng = np.random.default_rng(0)
+    rates = []
+    start = time.perf_counter()
+    for i in range(args.items):
+        embedding = rng.standard_normal(args.dim).astype(np.float32)
+        cursor.execute('INSERT INTO image_data (hash, filename, description, embedding) VALUES (?, ?, ?, ?)',
+                       (f'{i:064x}', f'{i}.jpg', '', embedding.tobytes()))
+        rowid = cursor.lastrowid
+        if mode == 'wal':
+            index_wal.log_add(cursor, rowid)
+        conn.commit()
+        add_with_ids(index, embedding.reshape(1, -1), [rowid])
+        if mode == 'rewrite':
+            faiss.write_index(index, index_path)
+        elif (i + 1) % args.checkpoint_every == 0:
+            # Stand-in for the background checkpoint thread
+            index_wal.write_index_file(faiss.serialize_index(index), index_path)
+            index_wal.mark_checkpoint(conn, index_wal.last_seq(cursor))
+        if (i + 1) % args.report_every == 0:
+            elapsed = time.perf_counter() - start
+            rates.append((i + 1, args.report_every / elapsed))
+            start = time.perf_counter()
+    conn.close()
+    return rates
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {mode: ingest(mode, workdir, args) for mode in ('rewrite', 'wal')}
+    print(f"{'archive size':>12} {'rewrite img/s':>14} {'wal img/s':>10}")
+    for (size, rewrite_rate), (_, wal_rate) in zip(results['rewrite'], results['wal']):
+        print(f"{size:>12} {rewrite_rate:>14.1f} {wal_rate:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark index persistence during ingest")
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--report-every', type=int, default=2000)
+    parser.add_argument('--checkpoint-every', type=int, default=5000,
+                        help="Items between checkpoints in wal mode")
+    main(parser.parse_args())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# benchmark_search_replica.py
+#
+# Startup time and memory per worker of the search-only replica
+# (search_server.py) against loading the index the way server.py does, on a
+# synthetic database and flat index. --workers processes of each kind run at
+# once, search the whole index and report, while all are alive:
+#
+#   VmRSS    resident memory, counting the mapped index in every worker
+#   RssAnon  private memory, which is what a worker really costs
+#   Pss      proportional share, shared pages split between the workers
+#
+# The replica is then left searching in a loop while a writer publishes a new
+# index generation, to time the swap and check no search failed during it.
+#
+# Usage: python benchmark_search_replica.py [--rows 100000] [--dim 1024] [--workers 4] [--queries 20]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+START = time.perf_counter()
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+INSERT_CHUNK = 50000
+# search_server.py's settings; importing it would already map the index
+DATABASE_PATH = 'image_data.db'
+FAISS_INDEX_PATH = 'faiss_index.bin'
+TEXT_MODEL_VERSION = os.environ.get("TEXT_MODEL_VERSION", "./models/THUDM/cogvlm2-llama3-chat-19B/")
+
+
+def build(directory, rows, dim, start=0):
+    import faiss
+    import numpy as np
+    import index_wal
+    from image_store import ImageStore
+    from index_factory import add_with_ids, create_index, with_ids
+
+    store = ImageStore(os.path.join(directory, DATABASE_PATH))
+    conn = store.connection()
+    cursor = conn.cursor()
+    rng = np.random.default_rng(start)
+    for chunk_start in range(start, start + rows, INSERT_CHUNK):
+        chunk_end = min(start + rows, chunk_start + INSERT_CHUNK)
+        vectors = rng.standard_normal((chunk_end - chunk_start, dim)).astype(np.float32)
+        cursor.executemany(
+            'INSERT INTO image_data (hash, filename, description, embedding) VALUES (?, ?, ?, ?)',
+            ((f'{i:064x}', f'/archive/{i}.jpg', f'Synthetic description number {i}.', vectors[i - chunk_start].tobytes())
+             for i in range(chunk_start, chunk_end)))
+        for i in range(chunk_start, chunk_end):
+            index_wal.log_add(cursor, i + 1)
+        conn.commit()
+    if start == 0:
+        store.put_text_embedding(TEXT_MODEL_VERSION, 'a red car', rng.standard_normal(dim))
+
+    # What the writer's checkpoint does: serialize everything, rename over the file, record the log position
+    index = with_ids(create_index("flat", dim))
+    cursor.execute('SELECT rowid, embedding FROM image_data')
+    for batch in iter(lambda: cursor.fetchmany(INSERT_CHUNK), []):
+        add_with_ids(index, np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in batch]),
+                     [rowid for rowid, _ in batch])
+    seq = index_wal.last_seq(cursor)
+    index_wal.write_index_file(faiss.serialize_index(index), os.path.join(directory, FAISS_INDEX_PATH))
+    index_wal.mark_checkpoint(conn, seq)
+    store.close()
+    return index.ntotal
+
+
+def child(kind, queries, ready_path, go_path):
+    import numpy as np
+
+    if kind == 'full':
+        # server.py's load_faiss_index, without the model it also loads at import
+        import faiss
+        from image_store import ImageStore
+        from index_factory import search
+        start = time.perf_counter()
+        index = faiss.read_index(FAISS_INDEX_PATH)
+        load = time.perf_counter() - start
+        store = ImageStore(DATABASE_PATH)
+
+        def run_query(vector):
+            _, ids = search(index, vector.reshape(1, -1), 10)
+            return store.hydrate_rowids([int(i) for i in ids[0] if i >= 0])
+        dim = index.d
+    else:
+        import search_server
+
+        def run_query(vector):
+            return search_server.search_image(image_hash=None, vector=vector.tolist(), text=None, k=10,
+                                              nprobe=None, ef_search=None)['results']
+        dim = search_server.replica.generation.index.d
+        load = search_server.replica.generation.load_seconds
+    startup = time.perf_counter() - START
+
+    rng = np.random.default_rng(os.getpid())
+    start = time.perf_counter()
+    run_query(rng.standard_normal(dim).astype(np.float32))
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(queries):
+        run_query(rng.standard_normal(dim).astype(np.float32))
+    per_query = (time.perf_counter() - start) / queries
+
+    # Measure once every worker is up, so shared pages are split between all of them
+    open(ready_path, 'w').close()
+    while not os.path.exists(go_path):
+        time.sleep(0.05)
+    from search_server import memory_stats
+    print(json.dumps({"startup": startup, "load": load, "first": first, "per_query": per_query, "memory": memory_stats(),
+                      "torch": 'torch' in sys.modules}))
+
+
+def reload_child(add_rows):
+    import numpy as np
+    import search_server
+
+    replica = search_server.replica
+    before = replica.generation
+    dim = before.index.d
+    stats = {"searches": 0, "errors": 0}
+    stop = threading.Event()
+
+    def searcher():
+        rng = np.random.default_rng(1)
+        while not stop.is_set():
+            response = search_server.search_image(image_hash=None, vector=rng.standard_normal(dim).tolist(), text=None,
+                                                  k=10, nprobe=None, ef_search=None)
+            stats["searches"] += 1
+            if 'error' in response or len(response['results']) != 10:
+                stats["errors"] += 1
+
+    thread = threading.Thread(target=searcher)
+    thread.start()
+    start = time.perf_counter()
+    build('.', add_rows, dim, start=before.index.ntotal)
+    published = time.perf_counter()
+    while replica.generation is before:
+        time.sleep(0.01)
+    swapped = time.perf_counter()
+    time.sleep(0.5)
+    stop.set()
+    thread.join()
+
+    newest = f'{before.index.ntotal + add_rows - 1:064x}'
+    found = search_server.search_image(image_hash=newest, vector=None, text=None, k=1, nprobe=None, ef_search=None)
+    cached = search_server.search_image(image_hash=None, vector=None, text=' a  red car ', k=1, nprobe=None,
+                                        ef_search=None)
+    print(json.dumps({"before": before.index.ntotal, "after": replica.generation.index.ntotal,
+                      "publish": published - start, "swap_delay": swapped - published,
+                      "load_ms": replica.generation.load_seconds * 1000, "newest_found": found['results'][0]['hash'] == newest,
+                      "text_cached": 'results' in cached, **stats}))
+
+
+def run_workers(directory, env, kind, workers, queries):
+    go_path = os.path.join(directory, f'{kind}.go')
+    ready = [os.path.join(directory, f'{kind}.{i}.ready') for i in range(workers)]
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', kind, '--queries', str(queries),
+                               '--ready', ready[i], '--go', go_path],
+                              cwd=directory, env=env, stdout=subprocess.PIPE, text=True) for i in range(workers)]
+    while not all(os.path.exists(path) for path in ready):
+        if any(proc.poll() not in (None, 0) for proc in procs):
+            raise RuntimeError(f"a {kind} worker failed")
+        time.sleep(0.05)
+    open(go_path, 'w').close()
+    results = [json.loads(proc.communicate()[0].strip().splitlines()[-1]) for proc in procs]
+    mean = lambda key, sub=None: sum((r[key][sub] if sub else r[key]) for r in results) / len(results)
+    label = "read_index (server.py)" if kind == 'full' else "mmap (search_server.py)"
+    print(f"  {label:24s}: startup {mean('startup'):5.2f}s (index load {mean('load') * 1000:5.0f} ms), first query {mean('first') * 1000:6.1f} ms, "
+          f"then {mean('per_query') * 1000:6.1f} ms; per worker VmRSS {mean('memory', 'VmRSS'):6.0f} MB, "
+          f"RssAnon {mean('memory', 'RssAnon'):6.0f} MB, Pss {mean('memory', 'Pss'):6.0f} MB; "
+          f"torch imported: {any(r['torch'] for r in results)}")
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix='search_replica_bench_')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])),
+               RELOAD_INTERVAL_SECONDS='0.2')
+    try:
+        start = time.perf_counter()
+        ntotal = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', 'build', '--rows', str(args.rows),
+                                 '--dim', str(args.dim)], cwd=directory, env=env, check=True,
+                                capture_output=True, text=True).stdout.strip().splitlines()[-1]
+        size = os.path.getsize(os.path.join(directory, 'faiss_index.bin'))
+        print(f"{ntotal} vectors of {args.dim} floats, index file {size / 2**20:.0f} MB "
+              f"(built in {time.perf_counter() - start:.0f}s); {args.workers} workers of each kind at once")
+        for kind in ('full', 'mmap'):
+            run_workers(directory, env, kind, args.workers, args.queries)
+        result = json.loads(subprocess.run([sys.executable, os.path.abspath(__file__), '--child', 'reload',
+                                            '--rows', str(args.add_rows)], cwd=directory, env=env, check=True,
+                                           capture_output=True, text=True).stdout.strip().splitlines()[-1])
+        print(f"  reload: {result['before']} -> {result['after']} vectors; new generation published in "
+              f"{result['publish']:.1f}s, swapped in {result['swap_delay'] * 1000:.0f} ms later (mapped in "
+              f"{result['load_ms']:.0f} ms); {result['searches']} searches meanwhile, {result['errors']} failed; "
+              f"newest row found: {result['newest_found']}, cached text query answered: {result['text_cached']}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the mmap search replica against a full index load")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--add-rows', type=int, default=10000)
+    parser.add_argument('--child', choices=['build', 'full', 'mmap', 'reload'], help=argparse.SUPPRESS)
+    parser.add_argument('--ready', help=argparse.SUPPRESS)
+    parser.add_argument('--go', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child == 'build':
+        print(build('.', args.rows, args.dim))
+    elif args.child == 'reload':
+        reload_child(args.rows)
+    elif args.child:
+        child(args.child, args.queries, args.ready, args.go)
+    else:
+        main(args)
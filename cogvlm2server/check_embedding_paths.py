@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# check_embedding_paths.py
+#
+# Captions a few images with both embedding modes of CogVLM2Backend and checks
+# that the single-pass (prefill) embeddings match the old two-pass ones.
+#
+# --stub runs the same backend code around tiny_cogvlm.py on the CPU instead of
+# the real model, so the check needs neither GPUs nor weights; without image
+# paths it captions a few random images of different sizes in one batch.
+#
+# Usage: python check_embedding_paths.py <image> [<image> ...]
+#        python check_embedding_paths.py --stub [<image> ...]
+
+import argparse
+import sys
+
+import numpy as np
+from PIL import Image
+
+from model_backend import CogVLM2Backend
+
+LOCAL_MODEL_DIR = "./models/THUDM/cogvlm2-llama3-chat-19B/"
+# Both paths run the same prefill in bf16/fp16, so only rounding noise is expected
+ATOL = 1e-2
+MIN_COSINE = 0.9999
+# The stub runs in float32
+STUB_ATOL = 1e-5
+STUB_IMAGES = 4
+
+
+def random_images(count, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = [(int(w), int(h)) for w, h in rng.integers(16, 256, (count, 2))]
+    return [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)) for w, h in sizes]
+
+
+def main(paths, stub=False):
+    if stub:
+        from tiny_cogvlm import tiny_backend
+        backend = tiny_backend("prefill")
+        atol = STUB_ATOL
+    else:
+        backend = CogVLM2Backend(LOCAL_MODEL_DIR, embedding_mode="prefill")
+        atol = ATOL
+    if paths:
+        images = [Image.open(path).convert("RGB") for path in paths]
+    else:
+        images = random_images(STUB_IMAGES)
+        paths = [f"random {image.width}x{image.height}" for image in images]
+
+    prefill = backend.caption_batch(images)
+    backend.embedding_mode = "two_pass"
+    two_pass = backend.caption_batch(images)
+
+    failed = False
+    for path, (caption_a, emb_a), (caption_b, emb_b) in zip(paths, prefill, two_pass):
+        max_diff = float(np.max(np.abs(emb_a - emb_b)))
+        cosine = float(np.dot(emb_a, emb_b) / (np.linalg.norm(emb_a) * np.linalg.norm(emb_b)))
+        ok = np.allclose(emb_a, emb_b, atol=atol) and cosine >= MIN_COSINE and caption_a == caption_b
+        failed |= not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {path}: max abs diff {max_diff:.6f}, cosine {cosine:.6f}, "
+              f"captions {'match' if caption_a == caption_b else 'differ'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that prefill and two-pass embeddings match")
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--stub", action="store_true", help="Use a tiny CPU model instead of CogVLM2")
+    args = parser.parse_args()
+    if not args.images and not args.stub:
+        parser.error("give image paths, or --stub to check on random images")
+    main(args.images, args.stub)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# embedding_cache.py
+#
+# Cache of text-query embeddings for /search. Text searches from the UI repeat
+# the same strings, and each miss costs a full forward pass of the model, so:
+#
+#   - queries are normalized (Unicode NFKC, collapsed whitespace) and keyed
+#     together with the model version (a fingerprint of the weights), so a
+#     model swap never serves stale vectors
+#   - a bounded in-memory LRU holds the hottest embeddings
+#   - an optional on-disk tier in image_data.db survives restarts
+#   - identical queries that arrive while one is being computed wait on that
+#     computation instead of starting their own
+
+import asyncio
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_query(text):
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+class TextEmbeddingCache:
+    def __init__(self, compute, model_version, max_bytes=64 * 1024 * 1024, store=None):
+        # compute is an async function text -> embedding (or None on failure)
+        self.compute = compute
+        self.model_version = model_version
+        self.max_bytes = max_bytes
+        self.store = store
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.inflight = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _remember(self, key, embedding):
+        if key in self.entries:
+            self.bytes_used -= self.entries.pop(key).nbytes
+        if embedding.nbytes > self.max_bytes:
+            return
+        self.entries[key] = embedding
+        self.bytes_used += embedding.nbytes
+        while self.bytes_used > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes_used -= evicted.nbytes
+
+    async def get(self, text):
+        query = normalize_query(text)
+        key = (self.model_version, query)
+
+        embedding = self.entries.get(key)
+        if embedding is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The request computing it was cancelled rather than this one; compute it here
+                return await self.get(text)
+
+        if self.store is not None:
+            embedding = self.store.get_text_embedding(self.model_version, query)
+            if embedding is not None:
+                self.disk_hits += 1
+                self._remember(key, embedding)
+                return embedding
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            embedding = await self.compute(query)
+            if embedding is not None:
+                self._remember(key, embedding)
+                if self.store is not None:
+                    self.store.put_text_embedding(self.model_version, query, embedding)
+            future.set_result(embedding)
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        except BaseException:
+            # Cancelled: release the coalesced waiters instead of leaving them hanging
+            future.cancel()
+            raise
+        finally:
+            del self.inflight[key]
+        return embedding
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses + self.coalesced
+        return {
+            "model_version": self.model_version,
+            "entries": len(self.entries),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "disk_tier": self.store is not None,
+            "inflight": len(self.inflight),
+        }
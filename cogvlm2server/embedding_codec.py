@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# embedding_codec.py
+#
+# Storage formats for the embedding blobs in image_data:
+#
+#   float32  4 bytes per value, exact (the original format)
+#   float16  2 bytes per value, about 3 significant digits
+#   int8     1 byte per value, symmetric scalar quantization with one float
+#            scale per vector (value = code * scale), stored next to the blob
+#
+# Rows record their own format (NULL meaning float32), so a database can be
+# converted in place a chunk at a time and rows written before a format change
+# stay readable. Everything decodes to float32 for FAISS and for reranking.
+
+import numpy as np
+
+FORMATS = ("float32", "float16", "int8")
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def encode(embedding, fmt="float32"):
+    """Returns (blob, scale) for a vector; scale is None except for int8."""
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    if fmt == "float32":
+        return vector.tobytes(), None
+    if fmt == "float16":
+        return np.clip(vector, -FLOAT16_MAX, FLOAT16_MAX).astype(np.float16).tobytes(), None
+    if fmt == "int8":
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        return np.rint(vector / scale).clip(-127, 127).astype(np.int8).tobytes(), scale
+    raise ValueError(f"Unknown embedding format: {fmt}. Expected one of {', '.join(FORMATS)}")
+
+
+def decode(blob, fmt=None, scale=None):
+    """float32 vector for a stored blob. float32 blobs give a zero-copy, read-only view."""
+    if fmt is None or fmt == "float32":
+        return np.frombuffer(blob, dtype=np.float32)
+    if fmt == "float16":
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+    if fmt == "int8":
+        vector = np.frombuffer(blob, dtype=np.int8).astype(np.float32)
+        vector *= scale
+        return vector
+    raise ValueError(f"Unknown embedding format: {fmt}")
+
+
+def decode_into(out, blob, fmt=None, scale=None):
+    """Decodes a blob straight into a row of a preallocated float32 array."""
+    if fmt is None or fmt == "float32":
+        out[:] = np.frombuffer(blob, dtype=np.float32)
+    else:
+        out[:] = np.frombuffer(blob, dtype=DTYPES[fmt])
+        if fmt == "int8":
+            out *= scale
+
+
+def dimension(blob, fmt=None):
+    return len(blob) // np.dtype(DTYPES[fmt or "float32"]).itemsize
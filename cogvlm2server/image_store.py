@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# image_store.py
+#
+# Data access for image_data.db. Each thread gets its own sqlite3 connection
+# (a connection must not be shared across threads once handlers, the
+# checkpointer and worker pools run concurrently), opened in WAL mode so
+# readers never block the writer. All SQL is fixed strings so the per-
+# connection statement cache keeps them prepared; variable-length IN lists are
+# padded up to a few fixed sizes for the same reason.
+#
+# Embeddings are written in the store's embedding_format (embedding_codec.py)
+# and every read decodes them back to float32, whatever format the row has.
+
+import sqlite3
+import threading
+
+import numpy as np
+
+import embedding_codec
+import index_wal
+
+# SQLite's default limit on host parameters in older builds is 999
+MAX_IN_PARAMS = 900
+IN_LIST_SIZES = (8, 32, 128, 512, MAX_IN_PARAMS)
+
+
+def embedding_from_blob(blob, fmt=None, scale=None):
+    # float32 blobs are a zero-copy view over the bytes; read-only, copy before mutating
+    return embedding_codec.decode(blob, fmt, scale)
+
+
+def ensure_embedding_columns(cursor):
+    # Databases from before compact storage have neither column; NULL reads as float32
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(image_data)')}
+    if 'embedding_format' not in columns:
+        cursor.execute('ALTER TABLE image_data ADD COLUMN embedding_format TEXT')
+    if 'embedding_scale' not in columns:
+        cursor.execute('ALTER TABLE image_data ADD COLUMN embedding_scale REAL')
+
+
+class ImageStore:
+    # Selected wherever an embedding is read, so it can be decoded
+    embedding_columns = 'embedding, embedding_format, embedding_scale'
+
+    def __init__(self, path, statement_cache_size=256, read_only=False, embedding_format="float32"):
+        if embedding_format not in embedding_codec.FORMATS:
+            raise ValueError(f"Unknown embedding format: {embedding_format}. "
+                             f"Expected one of {', '.join(embedding_codec.FORMATS)}")
+        self.path = path
+        self.statement_cache_size = statement_cache_size
+        # Search replicas open the writer's database without ever taking its write lock
+        self.read_only = read_only
+        self.embedding_format = embedding_format
+        self.local = threading.local()
+        if read_only:
+            # A replica cannot add the format columns to a database the writer has not upgraded yet
+            columns = {row[1] for row in self.cursor().execute('PRAGMA table_info(image_data)')}
+            if 'embedding_format' not in columns:
+                self.embedding_columns = 'embedding, NULL, NULL'
+            return
+        cursor = self.connection().cursor()
+        # FAISS IDs are the rowid of this table, so the table must keep its
+        # implicit rowid (no WITHOUT ROWID)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_data (
+                hash TEXT PRIMARY KEY,
+                filename TEXT,
+                description TEXT,
+                embedding BLOB
+            )
+        ''')
+        # Disk tier of the text-query embedding cache (embedding_cache.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS text_embedding_cache (
+                model_version TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model_version, query)
+            )
+        ''')
+        ensure_embedding_columns(cursor)
+        index_wal.ensure_wal_tables(cursor)
+        self.connection().commit()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True,
+                                       cached_statements=self.statement_cache_size)
+            else:
+                conn = sqlite3.connect(self.path, cached_statements=self.statement_cache_size)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def get_rowid(self, hash_value):
+        cursor = self.cursor()
+        cursor.execute('SELECT rowid FROM image_data WHERE hash=?', (hash_value,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_description_and_embedding(self, hash_value):
+        cursor = self.cursor()
+        cursor.execute(f'SELECT description, {self.embedding_columns} FROM image_data WHERE hash=?', (hash_value,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        description, embedding_blob, fmt, scale = row
+        return description, embedding_from_blob(embedding_blob, fmt, scale) if embedding_blob is not None else None
+
+    def get_embedding(self, hash_value):
+        cursor = self.cursor()
+        cursor.execute(f'SELECT {self.embedding_columns} FROM image_data WHERE hash=?', (hash_value,))
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return embedding_from_blob(*row)
+
+    def first_embedding_size(self):
+        cursor = self.cursor()
+        cursor.execute(f'SELECT {self.embedding_columns} FROM image_data WHERE embedding IS NOT NULL LIMIT 1')
+        row = cursor.fetchone()
+        return embedding_codec.dimension(row[0], row[1]) if row else None
+
+    def _in_query(self, sql, column, keys):
+        # Runs sql once per chunk of keys, padding each chunk to a fixed size
+        # so only a handful of distinct statements are ever prepared
+        cursor = self.cursor()
+        rows = []
+        for start in range(0, len(keys), MAX_IN_PARAMS):
+            chunk = list(keys[start:start + MAX_IN_PARAMS])
+            size = next(n for n in IN_LIST_SIZES if n >= len(chunk))
+            chunk += [chunk[-1]] * (size - len(chunk))
+            cursor.execute(sql.format(column=column, placeholders=','.join('?' * size)), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def hydrate_rowids(self, rowids):
+        """{rowid: (hash, filename, description)} for the given rowids, one query per 900 IDs."""
+        if not rowids:
+            return {}
+        rows = self._in_query('SELECT rowid, hash, filename, description FROM image_data WHERE {column} IN ({placeholders})',
+                              'rowid', rowids)
+        return {row[0]: row[1:] for row in rows}
+
+    def hydrate_hashes(self, hashes):
+        """{hash: (rowid, filename, description)} for the given hashes."""
+        if not hashes:
+            return {}
+        rows = self._in_query('SELECT hash, rowid, filename, description FROM image_data WHERE {column} IN ({placeholders})',
+                              'hash', hashes)
+        return {row[0]: row[1:] for row in rows}
+
+    def embeddings_by_rowids(self, rowids):
+        """{rowid: float32 embedding} for the given rowids, e.g. to rerank search candidates."""
+        if not rowids:
+            return {}
+        rows = self._in_query('SELECT rowid, ' + self.embedding_columns +
+                              ' FROM image_data WHERE {column} IN ({placeholders}) AND embedding IS NOT NULL',
+                              'rowid', rowids)
+        return {row[0]: embedding_from_blob(*row[1:]) for row in rows}
+
+    def existing_hashes(self, hashes):
+        return set(self.hydrate_hashes(hashes))
+
+    def upsert(self, hash_value, filename, description, embedding):
+        """Inserts or replaces an image row and logs it for the index.
+
+        Returns (rowid, replaced). The row and its log entries commit together.
+        """
+        conn = self.connection()
+        cursor = conn.cursor()
+        blob, scale = embedding_codec.encode(embedding, self.embedding_format)
+        cursor.execute('SELECT rowid FROM image_data WHERE hash=?', (hash_value,))
+        row = cursor.fetchone()
+        if row:
+            rowid = row[0]
+            cursor.execute('''
+                UPDATE image_data SET filename=?, description=?, embedding=?, embedding_format=?, embedding_scale=?
+                WHERE rowid=?
+            ''', (filename, description, blob, self.embedding_format, scale, rowid))
+            index_wal.log_remove(cursor, rowid)
+        else:
+            cursor.execute('''
+                INSERT INTO image_data (hash, filename, description, embedding, embedding_format, embedding_scale)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (hash_value, filename, description, blob, self.embedding_format, scale))
+            rowid = cursor.lastrowid
+        index_wal.log_add(cursor, rowid)
+        conn.commit()
+        return rowid, row is not None
+
+    def delete(self, hash_value):
+        """Deletes an image row and logs the removal. Returns its rowid or None."""
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT rowid FROM image_data WHERE hash=?', (hash_value,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute('DELETE FROM image_data WHERE rowid=?', (row[0],))
+        index_wal.log_remove(cursor, row[0])
+        conn.commit()
+        return row[0]
+
+    def get_text_embedding(self, model_version, query):
+        cursor = self.cursor()
+        cursor.execute('SELECT embedding FROM text_embedding_cache WHERE model_version=? AND query=?',
+                       (model_version, query))
+        row = cursor.fetchone()
+        return embedding_from_blob(row[0]) if row else None
+
+    def put_text_embedding(self, model_version, query, embedding):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO text_embedding_cache (model_version, query, embedding) VALUES (?, ?, ?)',
+                     (model_version, query, np.asarray(embedding, dtype=np.float32).tobytes()))
+        conn.commit()
+
+    def embeddings_by_hash(self, hash_values):
+        """Iterates (rowid, embedding) for the given hashes in order, skipping unknown ones."""
+        cursor = self.cursor()
+        for hash_value in hash_values:
+            cursor.execute(f'SELECT rowid, {self.embedding_columns} FROM image_data WHERE hash=?', (hash_value,))
+            row = cursor.fetchone()
+            if row is None or row[1] is None:
+                continue
+            yield row[0], embedding_from_blob(*row[1:])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# index_factory.py
+#
+# Builds the FAISS index used by server.py and rebuild_faiss_and_indices.py.
+# The index type is configurable so large archives can move off a brute-force
+# flat scan:
+#
+#   flat      exact IndexFlatL2, no training (the original behaviour)
+#   ivf_flat  inverted lists over full vectors, searched with nprobe
+#   ivf_pq    inverted lists over product-quantized vectors, smallest memory
+#   hnsw      graph index, no training, searched with efSearch
+#   sq8       flat scan over 8-bit scalar-quantized codes, a quarter of the
+#             memory, trained per-dimension ranges
+#   sq_fp16   flat scan over float16 codes, half the memory, no training
+#
+# Searches over lossy codes (ivf_pq, sq8, sq_fp16) can fetch a few times k
+# candidates and rerank them on their float32 vectors from image_data (rerank).
+#
+# Every index stores stable 64-bit IDs (the image_data rowid) rather than
+# relying on row position. IVF indexes keep IDs in their inverted lists; the
+# others are wrapped in IndexIDMap2. HNSW cannot remove vectors, so deletes on
+# an HNSW index need a rebuild.
+
+import faiss
+import numpy as np
+
+import embedding_codec
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "sq_fp16")
+# Types that cannot take vectors before train_index
+TRAINED_TYPES = ("ivf_flat", "ivf_pq", "sq8")
+
+DEFAULT_NLIST = 1024
+DEFAULT_PQ_M = 64
+DEFAULT_PQ_NBITS = 8
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_CONSTRUCTION = 200
+DEFAULT_TRAIN_SIZE = 100000
+# FAISS warns below roughly 39 training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def create_index(index_type, d, nlist=DEFAULT_NLIST, pq_m=DEFAULT_PQ_M, pq_nbits=DEFAULT_PQ_NBITS,
+                 hnsw_m=DEFAULT_HNSW_M, ef_construction=DEFAULT_EF_CONSTRUCTION):
+    if index_type == "flat":
+        return faiss.IndexFlatL2(d)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, nlist, faiss.METRIC_L2)
+    if index_type == "ivf_pq":
+        if d % pq_m != 0:
+            raise ValueError(f"PQ sub-quantizer count {pq_m} must divide the embedding size {d}")
+        return faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, pq_m, pq_nbits)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_L2)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    if index_type == "sq_fp16":
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    raise ValueError(f"Unknown index type: {index_type}. Expected one of {', '.join(INDEX_TYPES)}")
+
+
+def read_index_mmap(path):
+    """Reads an index for searching only, with its vectors mapped from the file
+    instead of copied into RAM, so processes serving the same file share the
+    pages. Flat and HNSW storage is mapped with IO_FLAG_MMAP_IFC (FAISS 1.9+);
+    IVF inverted lists with IO_FLAG_MMAP."""
+    mmap_ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if mmap_ifc is not None:
+        index = faiss.read_index(path, mmap_ifc | faiss.IO_FLAG_READ_ONLY)
+        if faiss.try_extract_index_ivf(index) is None:
+            return index
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def with_ids(index):
+    if faiss.try_extract_index_ivf(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def base_index(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def add_with_ids(index, vectors, ids):
+    index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+
+
+def supports_removal(index):
+    return not isinstance(base_index(index), faiss.IndexHNSW)
+
+
+def remove_ids(index, ids):
+    if not supports_removal(index):
+        raise RuntimeError("HNSW indexes do not support removal; rebuild the index instead")
+    return index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+
+def stored_ids(index):
+    """All IDs currently held by the index, as an int64 array."""
+    downcast = faiss.downcast_index(index)
+    if isinstance(downcast, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(downcast.id_map).astype(np.int64)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        ids = []
+        for list_no in range(ivf.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                ptr = invlists.get_ids(list_no)
+                ids.append(faiss.rev_swig_ptr(ptr, size).copy())
+                invlists.release_ids(list_no, ptr)
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    # Positional index without an ID map: rows are numbered 0..ntotal-1
+    return np.arange(index.ntotal, dtype=np.int64)
+
+
+def clamp_nlist(nlist, n_train):
+    # Keep small archives trainable instead of failing k-means
+    return max(1, min(nlist, n_train // MIN_POINTS_PER_CENTROID))
+
+
+def sample_training_vectors(cursor, n, d=None):
+    """Pulls a random sample of up to n embeddings from the image_data table."""
+    cursor.execute('SELECT embedding, embedding_format, embedding_scale FROM image_data '
+                   'WHERE embedding IS NOT NULL ORDER BY RANDOM() LIMIT ?', (n,))
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    if d is None:
+        d = embedding_codec.dimension(rows[0][0], rows[0][1])
+    sample = np.empty((len(rows), d), dtype=np.float32)
+    for i, row in enumerate(rows):
+        embedding_codec.decode_into(sample[i], *row)
+    return sample
+
+
+def train_index(index, sample):
+    if not index.is_trained:
+        print(f"Training index on {sample.shape[0]} vectors...")
+        index.train(sample)
+
+
+def search_params(index, nprobe=None, ef_search=None):
+    """Per-query search parameters, so concurrent queries do not share knobs."""
+    if nprobe is not None:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            return faiss.SearchParametersIVF(nprobe=nprobe)
+    if ef_search is not None:
+        if isinstance(base_index(index), faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+def search(index, queries, k, nprobe=None, ef_search=None):
+    params = search_params(index, nprobe, ef_search)
+    if params is None:
+        return index.search(queries, k)
+    return index.search(queries, k, params=params)
+
+
+def has_lossy_codes(index):
+    """True if the index compares queries against compressed vectors, so its
+    distances (and order) are approximate even for the candidates it finds."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return not isinstance(faiss.downcast_index(ivf), faiss.IndexIVFFlat)
+    return isinstance(base_index(index), (faiss.IndexScalarQuantizer, faiss.IndexPQ))
+
+
+def rerank(query, ids, vectors_by_id, k):
+    """Re-sorts candidate ids by exact float32 L2 distance to query and keeps k.
+    vectors_by_id maps id -> float32 vector; ids without one are dropped.
+    Returns (D, I) for the one query, shaped like index.search's."""
+    ids = [int(i) for i in ids if i >= 0 and int(i) in vectors_by_id]
+    if not ids:
+        return np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+    vectors = np.vstack([vectors_by_id[i] for i in ids])
+    diff = vectors - np.asarray(query, dtype=np.float32).reshape(1, -1)
+    distances = np.einsum('ij,ij->i', diff, diff)
+    order = np.argsort(distances, kind='stable')[:k]
+    return distances[order].reshape(1, -1), np.asarray(ids, dtype=np.int64)[order].reshape(1, -1)
+
+
+def candidate_count(index, k, rerank_factor):
+    # Only worth fetching extra candidates when the index distances are approximate
+    return k * rerank_factor if rerank_factor > 1 and has_lossy_codes(index) else k
+
+
+def describe_index(index):
+    info = {"type": type(base_index(index)).__name__, "ntotal": index.ntotal, "d": index.d}
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        info["nlist"] = ivf.nlist
+        info["nprobe"] = ivf.nprobe
+    return info
+
+
+def recall_at_k(index, reference, queries, k, nprobe=None, ef_search=None):
+    """Fraction of the exact top-k (from the flat reference) the index returns."""
+    _, exact = reference.search(queries, k)
+    _, approx = search(index, queries, k, nprobe, ef_search)
+    hits = 0
+    for exact_row, approx_row in zip(exact, approx):
+        hits += len(set(exact_row[exact_row >= 0]) & set(approx_row[approx_row >= 0]))
+    return hits / float(exact.shape[0] * k)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# index_wal.py
+#
+# Write-ahead log for the FAISS index. Every change to the index is appended to
+# the index_wal table in the same transaction as the image_data row it refers
+# to, so an ingest costs one small SQLite write instead of rewriting
+# faiss_index.bin. The vectors themselves already live in image_data, so a log
+# entry only records the operation and the rowid.
+#
+# A checkpoint serializes the index, writes it to a temp file, fsyncs and
+# renames it over faiss_index.bin, then records the last log sequence number it
+# contains and drops the older log entries. On startup the log entries after the
+# last checkpoint are replayed on top of the loaded index.
+
+import os
+import threading
+import time
+
+import faiss
+
+import embedding_codec
+from index_factory import add_with_ids, remove_ids, stored_ids, supports_removal
+
+
+def ensure_wal_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_wal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            image_rowid INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+
+
+def log_add(cursor, rowid):
+    cursor.execute('INSERT INTO index_wal (op, image_rowid) VALUES (?, ?)', ('add', rowid))
+
+
+def log_remove(cursor, rowid):
+    cursor.execute('INSERT INTO index_wal (op, image_rowid) VALUES (?, ?)', ('remove', rowid))
+
+
+def last_seq(cursor):
+    # A checkpoint prunes the log, so once it is empty the last number handed
+    # out (AUTOINCREMENT never reuses one) comes from sqlite_sequence
+    cursor.execute('''
+        SELECT MAX(COALESCE((SELECT MAX(seq) FROM index_wal), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name='index_wal'), 0))
+    ''')
+    return cursor.fetchone()[0]
+
+
+def checkpoint_seq(cursor):
+    cursor.execute("SELECT value FROM index_meta WHERE key='checkpoint_seq'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def mark_checkpoint(conn, seq):
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES ('checkpoint_seq', ?)", (seq,))
+    cursor.execute('DELETE FROM index_wal WHERE seq <= ?', (seq,))
+    conn.commit()
+
+
+def write_index_file(index_bytes, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(index_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def replay(index, cursor):
+    """Applies log entries newer than the last checkpoint. Returns the count.
+
+    Entries are applied against the IDs already in the index, so a crash
+    between renaming a checkpoint and recording it only re-reads a few entries
+    instead of adding duplicates. Removals an index cannot apply (HNSW) are
+    skipped with a warning rather than failing startup.
+    """
+    after = checkpoint_seq(cursor)
+    cursor.execute('SELECT seq, op, image_rowid FROM index_wal WHERE seq > ? ORDER BY seq', (after,))
+    entries = cursor.fetchall()
+    if not entries:
+        return 0
+    present = set(stored_ids(index).tolist())
+    removable = supports_removal(index)
+    applied = 0
+    skipped = 0
+    for seq, op, rowid in entries:
+        if op == 'add':
+            if rowid in present:
+                continue
+            cursor.execute('SELECT embedding, embedding_format, embedding_scale FROM image_data WHERE rowid=?', (rowid,))
+            row = cursor.fetchone()
+            if row is None or row[0] is None:
+                # Deleted later on; its remove entry follows
+                continue
+            add_with_ids(index, embedding_codec.decode(*row).reshape(1, -1), [rowid])
+            present.add(rowid)
+        elif op == 'remove':
+            if rowid not in present:
+                continue
+            if not removable:
+                skipped += 1
+                continue
+            remove_ids(index, [rowid])
+            present.discard(rowid)
+        applied += 1
+    if skipped:
+        print(f"Warning: skipped {skipped} index log removals the index cannot apply; its vectors for those rows "
+              "are stale until rebuild_faiss_and_indices.py is run.")
+    return applied
+
+
+class Checkpointer:
+    """Background thread that checkpoints the index.
+
+    A checkpoint runs every interval seconds when the log has new entries, or
+    sooner once max_pending entries have been logged. get_index returns the
+    current index (it may be replaced), and lock guards every index mutation.
+    store is the ImageStore, which hands the thread its own connection.
+    """
+
+    def __init__(self, get_index, lock, index_path, store, interval=60.0, max_pending=1000):
+        self.get_index = get_index
+        self.lock = lock
+        self.index_path = index_path
+        self.store = store
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.checkpoints = 0
+        self.last_checkpoint_seconds = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="index-checkpointer", daemon=True)
+            self.thread.start()
+
+    def notify(self, entries=1):
+        # Called from several index threads; the checkpoint resets pending under the same lock
+        with self.lock:
+            self.pending += entries
+            due = self.pending >= self.max_pending
+        if due:
+            self.wake.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        conn = self.store.connection()
+        try:
+            while not self.stopping:
+                self.wake.wait(self.interval)
+                self.wake.clear()
+                if self.pending:
+                    self.checkpoint(conn)
+            # Final checkpoint on shutdown
+            if self.pending:
+                self.checkpoint(conn)
+        finally:
+            self.store.close()
+
+    def checkpoint(self, conn):
+        start = time.time()
+        with self.lock:
+            index = self.get_index()
+            if index is None:
+                return
+            # Serializing in memory keeps the lock short; the slow disk write
+            # happens outside it while ingest carries on
+            seq = last_seq(conn.cursor())
+            index_bytes = faiss.serialize_index(index)
+            ntotal = index.ntotal
+            self.pending = 0
+        write_index_file(index_bytes, self.index_path)
+        mark_checkpoint(conn, seq)
+        self.checkpoints += 1
+        self.last_checkpoint_seconds = time.time() - start
+        print(f"Checkpointed FAISS index with {ntotal} embeddings up to log entry {seq} in {self.last_checkpoint_seconds:.2f}s.")
+
+    def stats(self):
+        return {
+            "pending_entries": self.pending,
+            "checkpoints": self.checkpoints,
+            "last_checkpoint_seconds": self.last_checkpoint_seconds,
+            "interval_seconds": self.interval,
+        }
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# ingest.py
+#
+# Server-side bulk ingestion for /ingest. A job takes a directory or a list of
+# paths on the server and runs them through a pipeline:
+#
+#   walk -> hash (thread pool) -> drop hashes already in image_data (one set
+#   query per chunk) -> decode + resize (thread pool, overlapping the GPU) ->
+#   caption + store (through the server's micro-batcher)
+#
+# Jobs and their items are persisted in image_data.db, so a job interrupted by
+# a restart can be resumed by id and only does the work that is left. Progress
+# is published as one event per item to any number of NDJSON subscribers.
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+HASH_READ_SIZE = 1024 * 1024
+HASH_CHUNK = 256
+# Images are shrunk to fit the model's input size before captioning, on every
+# path into the model, so a file gets the same caption however it arrives
+MAX_IMAGE_SIDE = 1344
+
+# Item states; pending and hashed items are (re)processed by run/resume
+PENDING, HASHED, SKIPPED, DONE, FAILED = 'pending', 'hashed', 'skipped', 'done', 'failed'
+
+
+def ensure_ingest_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
+            job_id TEXT PRIMARY KEY,
+            created REAL,
+            status TEXT,
+            source TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_items (
+            job_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            hash TEXT,
+            status TEXT NOT NULL,
+            message TEXT,
+            PRIMARY KEY (job_id, path)
+        )
+    ''')
+
+
+def hash_file(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def prepare_image(source):
+    """Decodes a path or file object into the RGB image the model is given."""
+    image = Image.open(source)
+    # JPEG can decode straight to a reduced size, far cheaper than full size
+    image.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    image = image.convert('RGB')
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.BICUBIC)
+    return image
+
+
+def walk_images(directory):
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if Path(file).suffix.lower() in SUPPORTED_EXTENSIONS:
+                yield os.path.join(root, file)
+
+
+class IngestJob:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.task = None
+        self.subscribers = set()
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+
+class IngestManager:
+    """Runs ingest jobs.
+
+    process is an async function (hash_value, path, image) -> status message
+    that captions and stores one decoded image; it is expected to raise on
+    failure.
+    """
+
+    def __init__(self, store, process, hash_workers=8, decode_workers=4, max_in_flight=16):
+        self.store = store
+        self.process = process
+        self.hash_pool = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="ingest-hash")
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="ingest-decode")
+        self.max_in_flight = max_in_flight
+        self.jobs = {}
+        cursor = store.cursor()
+        ensure_ingest_tables(cursor)
+        store.connection().commit()
+
+    def create_job(self, directory=None, paths=None):
+        job_id = uuid.uuid4().hex
+        source = {"directory": directory, "paths": paths}
+        conn = self.store.connection()
+        conn.execute('INSERT INTO ingest_jobs (job_id, created, status, source) VALUES (?, ?, ?, ?)',
+                     (job_id, time.time(), 'created', json.dumps(source)))
+        conn.commit()
+        return job_id
+
+    def job_exists(self, job_id):
+        cursor = self.store.cursor()
+        cursor.execute('SELECT 1 FROM ingest_jobs WHERE job_id=?', (job_id,))
+        return cursor.fetchone() is not None
+
+    def status(self, job_id):
+        cursor = self.store.cursor()
+        cursor.execute('SELECT status, source, created FROM ingest_jobs WHERE job_id=?', (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute('SELECT status, COUNT(*) FROM ingest_items WHERE job_id=? GROUP BY status', (job_id,))
+        counts = dict(cursor.fetchall())
+        job = self.jobs.get(job_id)
+        return {
+            "job_id": job_id,
+            "status": row[0],
+            "running": bool(job and job.running),
+            "source": json.loads(row[1]),
+            "created": row[2],
+            "items": counts,
+            "total": sum(counts.values()),
+        }
+
+    def start(self, job_id):
+        """Starts or resumes a job. Returns False if it is already running."""
+        job = self.jobs.setdefault(job_id, IngestJob(job_id))
+        if job.running:
+            return False
+        job.task = asyncio.get_running_loop().create_task(self._run(job))
+        return True
+
+    async def events(self, job_id):
+        """Yields NDJSON lines: a status snapshot, then one line per item until the job ends."""
+        job = self.jobs.setdefault(job_id, IngestJob(job_id))
+        queue = asyncio.Queue()
+        job.subscribers.add(queue)
+        try:
+            yield json.dumps({"event": "status", **self.status(job_id)}) + "\n"
+            if not job.running:
+                return
+            while True:
+                event = await queue.get()
+                yield json.dumps(event) + "\n"
+                if event["event"] == "finished":
+                    return
+        finally:
+            job.subscribers.discard(queue)
+
+    def _set_job_status(self, job_id, status):
+        conn = self.store.connection()
+        conn.execute('UPDATE ingest_jobs SET status=? WHERE job_id=?', (status, job_id))
+        conn.commit()
+
+    def _set_items(self, job_id, updates):
+        # updates: [(hash, status, message, path)]
+        conn = self.store.connection()
+        conn.executemany('UPDATE ingest_items SET hash=?, status=?, message=? WHERE job_id=? AND path=?',
+                         [(h, status, message, job_id, path) for h, status, message, path in updates])
+        conn.commit()
+
+    def _enumerate(self, job_id):
+        # Runs on a worker thread with its own connection; records every file
+        # up front so a resumed job knows exactly what is left
+        cursor = self.store.cursor()
+        cursor.execute('SELECT source FROM ingest_jobs WHERE job_id=?', (job_id,))
+        source = json.loads(cursor.fetchone()[0])
+        if source.get("directory"):
+            paths = walk_images(source["directory"])
+        else:
+            paths = iter(source.get("paths") or [])
+        conn = self.store.connection()
+        batch = []
+        for path in paths:
+            batch.append((job_id, path, PENDING))
+            if len(batch) >= 10000:
+                conn.executemany('INSERT OR IGNORE INTO ingest_items (job_id, path, status) VALUES (?, ?, ?)', batch)
+                conn.commit()
+                batch = []
+        if batch:
+            conn.executemany('INSERT OR IGNORE INTO ingest_items (job_id, path, status) VALUES (?, ?, ?)', batch)
+        conn.execute("UPDATE ingest_jobs SET status='enumerated' WHERE job_id=?", (job_id,))
+        conn.commit()
+
+    def _hash_or_none(self, path):
+        try:
+            return hash_file(path), None
+        except OSError as e:
+            return None, str(e)
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        job_id = job.job_id
+        try:
+            if self.status(job_id)["status"] == 'created':
+                await loop.run_in_executor(self.hash_pool, self._enumerate, job_id)
+            self._set_job_status(job_id, 'running')
+
+            cursor = self.store.cursor()
+            cursor.execute('SELECT path, hash FROM ingest_items WHERE job_id=? AND status IN (?, ?)',
+                           (job_id, PENDING, HASHED))
+            remaining = cursor.fetchall()
+            in_flight = asyncio.Semaphore(self.max_in_flight)
+            tasks = set()
+            seen = set()
+
+            for start in range(0, len(remaining), HASH_CHUNK):
+                chunk = remaining[start:start + HASH_CHUNK]
+                unhashed = [path for path, h in chunk if h is None]
+                hashed = await asyncio.gather(*(loop.run_in_executor(self.hash_pool, self._hash_or_none, path)
+                                                for path in unhashed))
+                hashes = dict(zip(unhashed, hashed))
+                updates, to_process = [], []
+                for path, h in chunk:
+                    if h is None:
+                        h, error = hashes[path]
+                        if h is None:
+                            updates.append((None, FAILED, error, path))
+                            continue
+                    to_process.append((path, h))
+
+                # One set-difference query per chunk instead of one lookup per file
+                existing = self.store.existing_hashes([h for _, h in to_process])
+                queued = []
+                for path, h in to_process:
+                    if h in existing:
+                        updates.append((h, SKIPPED, "Already in database.", path))
+                    elif h in seen:
+                        updates.append((h, SKIPPED, "Duplicate of another file in this job.", path))
+                    else:
+                        seen.add(h)
+                        updates.append((h, HASHED, None, path))
+                        queued.append((path, h))
+                self._set_items(job_id, updates)
+                for h, status, message, path in updates:
+                    if status in (SKIPPED, FAILED):
+                        job.publish({"event": "item", "path": path, "hash": h, "status": status, "message": message})
+
+                for path, h in queued:
+                    await in_flight.acquire()
+                    task = loop.create_task(self._process_item(job, path, h, in_flight))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*list(tasks))
+            self._set_job_status(job_id, 'finished')
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self._set_job_status(job_id, 'interrupted')
+            job.publish({"event": "error", "message": str(e)})
+        finally:
+            job.publish({"event": "finished", **self.status(job_id), "running": False})
+
+    async def _process_item(self, job, path, hash_value, in_flight):
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(self.decode_pool, prepare_image, path)
+            message = await self.process(hash_value, path, image)
+            status = DONE
+        except Exception as e:
+            message = f"An error occurred: {str(e)}"
+            status = FAILED
+        finally:
+            in_flight.release()
+        self._set_items(job.job_id, [(hash_value, status, message, path)])
+        job.publish({"event": "item", "path": path, "hash": hash_value, "status": status, "message": message})
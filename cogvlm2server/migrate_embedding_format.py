@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# migrate_embedding_format.py
+#
+# Converts the embedding blobs in image_data.db to another storage format
+# (embedding_codec.py) in place, a chunk of rows per transaction, so the
+# server can keep running; rows it writes meanwhile use its own
+# EMBEDDING_FORMAT. Rowids do not change, so faiss_index.bin stays valid; run
+# rebuild_faiss_and_indices.py afterwards to build it from the new vectors.
+# The file only shrinks after a VACUUM, which needs as much free disk space as
+# the database and the server stopped, since it leaves WAL mode. The VACUUM
+# also moves the file to PAGE_SIZE pages: with SQLite's default 4 KB pages a
+# 2 KB float16 row leaves no room for a second one, so float16 would save
+# almost nothing.
+#
+# Converting back to float32 restores the layout, not the precision lost.
+#
+# Usage: python migrate_embedding_format.py --to {float32,float16,int8} [--db image_data.db] [--no-vacuum]
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import embedding_codec
+from image_store import ensure_embedding_columns
+
+DATABASE_PATH = 'image_data.db'
+CHUNK_SIZE = 5000
+PAGE_SIZE = 16384
+
+
+def database_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def migrate(conn, target, chunk_size=CHUNK_SIZE):
+    """Re-encodes every embedding not yet stored as target. Returns the number converted."""
+    cursor = conn.cursor()
+    ensure_embedding_columns(cursor)
+    conn.commit()
+    converted = 0
+    last_rowid = 0
+    while True:
+        # Walk by rowid so each chunk is one short write transaction
+        cursor.execute('''
+            SELECT rowid, embedding, embedding_format, embedding_scale FROM image_data
+            WHERE rowid > ? AND embedding IS NOT NULL AND IFNULL(embedding_format, 'float32') != ?
+            ORDER BY rowid LIMIT ?
+        ''', (last_rowid, target, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return converted
+        updates = []
+        for rowid, blob, fmt, scale in rows:
+            new_blob, new_scale = embedding_codec.encode(embedding_codec.decode(blob, fmt, scale), target)
+            updates.append((new_blob, target, new_scale, rowid))
+        cursor.executemany('UPDATE image_data SET embedding=?, embedding_format=?, embedding_scale=? WHERE rowid=?',
+                           updates)
+        conn.commit()
+        converted += len(rows)
+        last_rowid = rows[-1][0]
+        print(f"Converted {converted} embeddings...", end='\r')
+
+
+def vacuum(conn, page_size=PAGE_SIZE):
+    # The page size of a WAL database is fixed; leave WAL mode for the rebuild
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.execute(f'PRAGMA page_size={int(page_size)}')
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA journal_mode=WAL')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the stored embeddings to another format")
+    parser.add_argument('--to', required=True, choices=embedding_codec.FORMATS)
+    parser.add_argument('--db', default=DATABASE_PATH)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help="SQLite page size to rebuild the file with")
+    parser.add_argument('--no-vacuum', action='store_true', help="Skip reclaiming the freed space")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Error: {args.db} does not exist.")
+        sys.exit(1)
+    conn = sqlite3.connect(args.db, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    before = database_size(args.db)
+    start = time.time()
+    converted = migrate(conn, args.to, args.chunk_size)
+    print(f"Converted {converted} embeddings to {args.to} in {time.time() - start:.1f}s.")
+    if converted and not args.no_vacuum:
+        start = time.time()
+        vacuum(conn, args.page_size)
+        print(f"Vacuumed in {time.time() - start:.1f}s.")
+    conn.close()
+    print(f"{args.db}: {before / 2**20:.0f} MB -> {database_size(args.db) / 2**20:.0f} MB")
+    if converted:
+        print("Run rebuild_faiss_and_indices.py to rebuild the index from the converted vectors.")
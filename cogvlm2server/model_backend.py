@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# model_backend.py
+#
+# Model backends used by server.py. Every backend exposes the same two batch
+# calls so the micro-batcher (batching.py) does not care whether it is talking
+# to the real CogVLM2 model on the GPUs or to a CPU stub used for benchmarking.
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+task_prompt = ("Provide a detailed caption that fully describes the image. Be sure to describe any text the image "
+               "contains. If it contains NSFW content, describe it in detail and include a NSFW specifier. If the "
+               "image contains people of identifiable races, be sure to mention those, including but not limited to "
+               "black, African black, white, Asian, Hispanic, Jewish, or Arab. If the image contains animals, "
+               "describe them in detail. Attempt to describe any jokes. Attempt to describe any memes. If the "
+               "image seems controversial or political, attempt to describe that in detail, including why it may be "
+               "offensive. If it does not contain any of these elements don't bother mentioning their absence.")
+
+# Bytes hashed from each end of every file in the model directory for its fingerprint
+FINGERPRINT_SAMPLE = 1024 * 1024
+
+
+def weights_fingerprint(model_dir):
+    """Identifies a model by its files rather than their location.
+
+    Hashes each file's name and size with its first and last
+    FINGERPRINT_SAMPLE bytes, so moving the directory keeps the fingerprint
+    and replacing the weights in place changes it, without reading every
+    shard in full.
+    """
+    digest = hashlib.sha256()
+    for entry in sorted(os.scandir(model_dir), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        size = entry.stat().st_size
+        digest.update(f"{entry.name}\0{size}\0".encode('utf-8'))
+        with open(entry.path, 'rb') as f:
+            digest.update(f.read(FINGERPRINT_SAMPLE))
+            if size > 2 * FINGERPRINT_SAMPLE:
+                f.seek(-FINGERPRINT_SAMPLE, os.SEEK_END)
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class CaptionBackend:
+    """Interface shared by all model backends.
+
+    caption_batch takes a list of PIL images and returns a list of
+    (caption, embedding) tuples in the same order. embed_text_batch takes a
+    list of strings and returns a list of float32 embeddings.
+    """
+
+    name = "base"
+    # Identifies the weights, e.g. to key cached embeddings
+    version = "base"
+    device = "cpu"
+    torch_dtype = None
+    embedding_size = None
+
+    def caption_batch(self, images):
+        raise NotImplementedError
+
+    def embed_text_batch(self, texts):
+        raise NotImplementedError
+
+
+class PrefillCapture:
+    """Keeps the output of the first forward call through a module.
+
+    Hooked onto the decoder's final norm, the first call inside generate() is
+    the prefill over the whole prompt, and its output is the same tensor a
+    separate forward pass would return as hidden_states[-1]. Later decode
+    steps only see one new token each and are ignored.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.hidden_state = None
+        self.handle = None
+
+    def _hook(self, module, inputs, output):
+        if self.hidden_state is None:
+            self.hidden_state = output.detach()
+
+    def __enter__(self):
+        self.handle = self.module.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.handle.remove()
+        return False
+
+
+class CogVLM2Backend(CaptionBackend):
+    """CogVLM2 split across the local GPUs with accelerate."""
+
+    def __init__(self, model_dir, max_memory=None, offload_folder="/tmp/offload", embedding_mode="prefill"):
+        # torch and transformers are only imported here so the stub backend and
+        # the benchmarks can run on machines without them.
+        import torch
+        import transformers
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        from accelerate import init_empty_weights, load_checkpoint_and_dispatch, infer_auto_device_map
+
+        print(f"PyTorch version: {torch.__version__}")
+        print(f"Transformers version: {transformers.__version__}")
+
+        self.torch = torch
+        self.name = model_dir
+        self.version = weights_fingerprint(model_dir)
+        # "prefill" pools the hidden states generate() already computes for the
+        # prompt; "two_pass" runs the old second forward pass over the prompt.
+        if embedding_mode not in ("prefill", "two_pass"):
+            raise ValueError(f"Unknown embedding mode: {embedding_mode}")
+        self.embedding_mode = embedding_mode
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.torch_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+
+        tokenizer = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True)
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token_id = 128002
+        if tokenizer.eos_token_id is None:
+            tokenizer.eos_token_id = 128003
+
+        print(f"pad_token_id: {tokenizer.pad_token_id}")
+        print(f"eos_token_id: {tokenizer.eos_token_id}")
+        self.tokenizer = tokenizer
+
+        with init_empty_weights():
+            model = AutoModelForCausalLM.from_pretrained(
+                model_dir,
+                torch_dtype=self.torch_dtype,
+                trust_remote_code=True,
+            )
+
+        if max_memory is None:
+            max_memory = {
+                0: "20.5GiB",
+                1: "23GiB"
+            }
+
+        num_gpus = torch.cuda.device_count()
+        if num_gpus != len(max_memory):
+            raise ValueError(f"Number of GPUs ({num_gpus}) does not match the number of specified memory limits ({len(max_memory)}).")
+
+        device_map = infer_auto_device_map(
+            model=model,
+            max_memory=max_memory,
+            no_split_module_classes=["CogVLMDecoderLayer"]
+        )
+
+        if not os.path.exists(offload_folder):
+            os.makedirs(offload_folder)
+
+        model = load_checkpoint_and_dispatch(
+            model=model,
+            checkpoint=model_dir,
+            device_map=device_map,
+            dtype=self.torch_dtype,
+            offload_folder=offload_folder,
+        )
+
+        self.model = model.eval()
+        self.embedding_size = self.model.config.hidden_size
+
+    def _collate(self, inputs):
+        # Left-pad the per-sample tensors from build_conversation_input_ids so
+        # generate() continues every row from its last real token.
+        torch = self.torch
+        max_length = max(x['input_ids'].shape[0] for x in inputs)
+        input_ids, token_type_ids, attention_mask = [], [], []
+        for x in inputs:
+            padding = max_length - x['input_ids'].shape[0]
+            input_ids.append(torch.cat([
+                torch.full((padding,), self.tokenizer.pad_token_id, dtype=x['input_ids'].dtype),
+                x['input_ids']]))
+            token_type_ids.append(torch.cat([
+                torch.zeros(padding, dtype=x['token_type_ids'].dtype),
+                x['token_type_ids']]))
+            attention_mask.append(torch.cat([
+                torch.zeros(padding, dtype=x['attention_mask'].dtype),
+                x['attention_mask']]))
+        batch = {
+            'input_ids': torch.stack(input_ids).to(self.device),
+            'token_type_ids': torch.stack(token_type_ids).to(self.device),
+            'attention_mask': torch.stack(attention_mask).to(self.device),
+        }
+        if inputs[0].get('images'):
+            batch['images'] = [[x['images'][0].to(self.device).to(self.torch_dtype)] for x in inputs]
+        return batch
+
+    def _pool(self, hidden_state, attention_mask):
+        # Mean of the last hidden state over the real (unpadded) tokens.
+        mask = attention_mask.to(hidden_state.device).unsqueeze(-1).to(hidden_state.dtype)
+        summed = (hidden_state * mask).sum(dim=1)
+        pooled = summed / mask.sum(dim=1).clamp(min=1)
+        return pooled.to(self.torch.float32).cpu().numpy()
+
+    def embed_text_batch(self, texts):
+        inputs = [
+            self.model.build_conversation_input_ids(
+                self.tokenizer,
+                query=text,
+                history=[],
+                images=None,  # No images provided
+                template_version='chat'
+            )
+            for text in texts
+        ]
+        batch = self._collate(inputs)
+        with self.torch.no_grad():
+            outputs = self.model(**batch, output_hidden_states=True)
+            embeddings = self._pool(outputs.hidden_states[-1], batch['attention_mask'])
+        return list(embeddings)
+
+    def caption_batch(self, images):
+        inputs = [
+            self.model.build_conversation_input_ids(
+                self.tokenizer,
+                query=task_prompt,
+                history=[],
+                images=[image],
+                template_version='chat'
+            )
+            for image in images
+        ]
+        batch = self._collate(inputs)
+        gen_kwargs = {
+            "max_new_tokens": 2048,
+            "pad_token_id": 128002,
+            "top_k": 1,
+        }
+        with self.torch.no_grad():
+            if self.embedding_mode == "prefill":
+                with PrefillCapture(self.model.model.norm) as prefill:
+                    # Generate the text response (caption)
+                    caption_outputs = self.model.generate(**batch, **gen_kwargs)
+                embeddings = self._pool(prefill.hidden_state, batch['attention_mask'])
+            else:
+                caption_outputs = self.model.generate(**batch, **gen_kwargs)
+
+                # Generate embeddings separately by calling the model directly
+                outputs = self.model(**batch, output_hidden_states=True)
+                embeddings = self._pool(outputs.hidden_states[-1], batch['attention_mask'])
+
+            caption_outputs = caption_outputs[:, batch['input_ids'].shape[1]:]
+            captions = [
+                self.tokenizer.decode(row).split(self.tokenizer.eos_token)[0].strip()
+                for row in caption_outputs
+            ]
+        for caption in captions:
+            print(f"Generated caption: {caption}")
+        return list(zip(captions, embeddings))
+
+
+class StubBackend(CaptionBackend):
+    """CPU stand-in for CogVLM2 used by the benchmarks.
+
+    The cost model is a fixed per-call overhead plus a smaller per-item cost,
+    which is roughly how a batched forward pass on the GPUs behaves.
+    """
+
+    name = "stub"
+    version = "stub"
+
+    def __init__(self, embedding_size=4096, call_overhead=0.05, per_item=0.005):
+        self.embedding_size = embedding_size
+        self.call_overhead = call_overhead
+        self.per_item = per_item
+
+    def _embedding(self, seed_bytes):
+        seed = int.from_bytes(hashlib.sha256(seed_bytes).digest()[:8], 'little')
+        rng = np.random.default_rng(seed)
+        return rng.standard_normal(self.embedding_size).astype(np.float32)
+
+    def _sleep(self, n):
+        time.sleep(self.call_overhead + self.per_item * n)
+
+    def caption_batch(self, images):
+        self._sleep(len(images))
+        results = []
+        for image in images:
+            embedding = self._embedding(image.tobytes()[:4096])
+            results.append((f"Stub caption for a {image.width}x{image.height} image.", embedding))
+        return results
+
+    def embed_text_batch(self, texts):
+        self._sleep(len(texts))
+        return [self._embedding(text.encode('utf-8')) for text in texts]
+
+
+def load_backend(kind, model_dir, embedding_mode="prefill"):
+    if kind == "stub":
+        return StubBackend()
+    if kind == "cogvlm2":
+        return CogVLM2Backend(model_dir, embedding_mode=embedding_mode)
+    raise ValueError(f"Unknown caption backend: {kind}")
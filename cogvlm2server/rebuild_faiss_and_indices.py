@@ -1,76 +1,207 @@
 #!/usr/bin/env python
+import argparse
 import os
+import time
 import faiss
 import numpy as np
 import sqlite3
 import pickle
 
+from index_factory import (INDEX_TYPES, DEFAULT_NLIST, DEFAULT_PQ_M, DEFAULT_HNSW_M, DEFAULT_TRAIN_SIZE,
+                           create_index, with_ids, add_with_ids, stored_ids, clamp_nlist, sample_training_vectors,
+                           train_index, recall_at_k, search, has_lossy_codes, rerank)
+import embedding_codec
+import index_wal
+from image_store import ImageStore, ensure_embedding_columns
+
 FAISS_INDEX_PATH = 'faiss_index.bin'
-INDEX_HASH_KEYS_PATH = 'index_hash_keys.pkl'
+# Written by older versions that stored vectors by position; removed after a rebuild
+LEGACY_INDEX_HASH_KEYS_PATH = 'index_hash_keys.pkl'
 DATABASE_PATH = 'image_data.db'
-def rebuild_faiss_index():
-    global index, index_hash_keys, conn, cursor
+ADD_CHUNK_SIZE = 10000
 
-    # Step 1: Delete old FAISS index and index_hash_keys.pkl if they exist
-    if os.path.exists(FAISS_INDEX_PATH):
-        os.remove(FAISS_INDEX_PATH)
-        print(f"Deleted old FAISS index at {FAISS_INDEX_PATH}")
-    else:
-        print(f"No existing FAISS index found at {FAISS_INDEX_PATH}")
 
-    if os.path.exists(INDEX_HASH_KEYS_PATH):
-        os.remove(INDEX_HASH_KEYS_PATH)
-        print(f"Deleted old index_hash_keys at {INDEX_HASH_KEYS_PATH}")
-    else:
-        print(f"No existing index_hash_keys found at {INDEX_HASH_KEYS_PATH}")
+def build_empty_index(args, cursor, d=None):
+    sample = sample_training_vectors(cursor, args.train_size, d)
+    if sample is None:
+        return None, None
+    d = sample.shape[1]
+    nlist = clamp_nlist(args.nlist, sample.shape[0])
+    if args.index_type.startswith("ivf") and nlist != args.nlist:
+        print(f"Only {sample.shape[0]} training vectors available; using nlist={nlist} instead of {args.nlist}")
+    index = with_ids(create_index(args.index_type, d, nlist=nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m))
+    print(f"Initialized new {args.index_type} FAISS index with embedding size {d}")
+    start = time.time()
+    train_index(index, sample)
+    print(f"Training took {time.time() - start:.1f}s")
+    return index, sample
+
+
+def add_in_chunks(index, rows, d):
+    # Adds (rowid, embedding_blob, format, scale) rows under their rowid,
+    # decoding each blob straight into one reused float32 chunk
+    chunk = np.empty((ADD_CHUNK_SIZE, d), dtype=np.float32)
+    ids = np.empty(ADD_CHUNK_SIZE, dtype=np.int64)
+    filled = 0
+    for rowid, embedding_blob, fmt, scale in rows:
+        embedding_codec.decode_into(chunk[filled], embedding_blob, fmt, scale)
+        ids[filled] = rowid
+        filled += 1
+        if filled == ADD_CHUNK_SIZE:
+            add_with_ids(index, chunk, ids)
+            filled = 0
+    if filled:
+        add_with_ids(index, chunk[:filled], ids[:filled])
 
-    # Step 2: Connect to the database
-    if 'conn' not in globals():
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-    else:
-        cursor = conn.cursor()
 
-    # Step 3: Retrieve all embeddings and hashes from the database
-    cursor.execute('SELECT hash, embedding FROM image_data WHERE embedding IS NOT NULL')
-    data = cursor.fetchall()
+def log_position(cursor):
+    # Read before image_data: entries logged while the rebuild reads the rows
+    # may not be in it, so they must stay after the checkpoint and be replayed
+    index_wal.ensure_wal_tables(cursor)
+    return index_wal.last_seq(cursor)
 
-    if not data:
+
+def write_index_atomically(index, cursor, seq):
+    # Write next to the live file and rename over it so a crash never leaves
+    # a half-written index behind. The rebuilt index holds everything in the
+    # server's write-ahead log up to seq, so the log is checkpointed there.
+    index_wal.write_index_file(faiss.serialize_index(index), FAISS_INDEX_PATH)
+    index_wal.mark_checkpoint(cursor.connection, seq)
+    print(f"Saved FAISS index to {FAISS_INDEX_PATH}")
+    if os.path.exists(LEGACY_INDEX_HASH_KEYS_PATH):
+        os.remove(LEGACY_INDEX_HASH_KEYS_PATH)
+        print(f"Deleted old index_hash_keys at {LEGACY_INDEX_HASH_KEYS_PATH}")
+
+
+def rebuild_faiss_index(args, cursor):
+    cursor.execute('SELECT COUNT(*) FROM image_data WHERE embedding IS NOT NULL')
+    total = cursor.fetchone()[0]
+    if not total:
         print("No embeddings found in the database.")
-        return
+        return None, None
+
+    print(f"Found {total} embeddings in the database. Rebuilding FAISS index...")
+    seq = log_position(cursor)
+    index, sample = build_empty_index(args, cursor)
+
+    cursor.execute('SELECT rowid, embedding, embedding_format, embedding_scale FROM image_data WHERE embedding IS NOT NULL')
+    add_in_chunks(index, cursor, index.d)
+    print(f"Added {index.ntotal} embeddings to the FAISS index.")
+
+    write_index_atomically(index, cursor, seq)
+    return index, sample
 
-    index_hash_keys = []
-    embeddings_list = []
 
-    print(f"Found {len(data)} embeddings in the database. Rebuilding FAISS index...")
+def migrate_faiss_index(args, cursor):
+    # Rebuilds the existing index as a new type over the same set of images.
+    # Vectors are read back from the database rather than the old index, which
+    # may be lossy (PQ).
+    if not os.path.exists(FAISS_INDEX_PATH):
+        print(f"Nothing to migrate: {FAISS_INDEX_PATH} is missing.")
+        return None, None
 
-    for hash_value, embedding_blob in data:
-        # Convert embedding blob back to numpy array
-        embedding = np.frombuffer(embedding_blob, dtype=np.float32)
-        embeddings_list.append(embedding)
-        index_hash_keys.append(hash_value)
+    seq = log_position(cursor)
+    old_index = faiss.read_index(FAISS_INDEX_PATH)
+    print(f"Migrating {type(faiss.downcast_index(old_index)).__name__} with {old_index.ntotal} embeddings to {args.index_type}")
+    if os.path.exists(LEGACY_INDEX_HASH_KEYS_PATH):
+        # Positional index: translate its hash list into rowids
+        with open(LEGACY_INDEX_HASH_KEYS_PATH, 'rb') as f:
+            hash_keys = pickle.load(f)
+        rowids = []
+        for hash_value in hash_keys:
+            cursor.execute('SELECT rowid FROM image_data WHERE hash=?', (hash_value,))
+            row = cursor.fetchone()
+            if row is not None:
+                rowids.append(row[0])
+    else:
+        rowids = stored_ids(old_index).tolist()
 
-    # Convert embeddings to a numpy array
-    embeddings_array = np.array(embeddings_list).astype('float32')
+    index, sample = build_empty_index(args, cursor, old_index.d)
+    if index is None:
+        print("No embeddings found in the database.")
+        return None, None
+    del old_index
 
-    # Step 4: Initialize a new FAISS index
-    embedding_size = embeddings_array.shape[1]
-    index = faiss.IndexFlatL2(embedding_size)
-    print(f"Initialized new FAISS index with embedding size {embedding_size}")
+    def rows():
+        for rowid in sorted(rowids):
+            cursor.execute('SELECT rowid, embedding, embedding_format, embedding_scale FROM image_data WHERE rowid=?',
+                           (rowid,))
+            row = cursor.fetchone()
+            if row is None or row[1] is None:
+                print(f"Warning: row {rowid} has no embedding in the database; skipping it.")
+                continue
+            yield row
 
-    # Step 5: Add all embeddings to the FAISS index
-    index.add(embeddings_array)
+    add_in_chunks(index, rows(), index.d)
     print(f"Added {index.ntotal} embeddings to the FAISS index.")
+    write_index_atomically(index, cursor, seq)
+    return index, sample
 
-    # Step 6: Save the FAISS index and index_hash_keys
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    with open(INDEX_HASH_KEYS_PATH, 'wb') as f:
-        pickle.dump(index_hash_keys, f)
-    print(f"Saved FAISS index to {FAISS_INDEX_PATH} and index_hash_keys to {INDEX_HASH_KEYS_PATH}")
 
-    # Close the database connection if it was opened here
-    cursor.close()
-    # conn.close()  # Uncomment if you want to close the connection
+def report_recall(index, sample, cursor, args):
+    # Compare against an exact flat index over the same (decoded) vectors
+    reference = with_ids(faiss.IndexFlatL2(index.d))
+    cursor.execute('SELECT rowid, embedding, embedding_format, embedding_scale FROM image_data WHERE embedding IS NOT NULL')
+    add_in_chunks(reference, cursor, index.d)
+    queries = sample[np.random.default_rng(0).permutation(sample.shape[0])[:args.recall_queries]]
+
+    start = time.time()
+    search(reference, queries, args.k)
+    flat_ms = (time.time() - start) * 1000.0 / len(queries)
+    start = time.time()
+    recall = recall_at_k(index, reference, queries, args.k, args.nprobe, args.ef_search)
+    index_ms = (time.time() - start) * 1000.0 / len(queries)
+    print(f"recall@{args.k} over {len(queries)} queries: {recall:.4f} "
+          f"({index_ms:.2f} ms/query vs {flat_ms:.2f} ms/query for flat)")
+
+    if args.rerank_factor > 1 and has_lossy_codes(index):
+        # What server.py's search does on lossy codes: k * factor candidates, reranked in float32
+        store = ImageStore(DATABASE_PATH, read_only=True)
+        _, exact = reference.search(queries, args.k)
+        start = time.time()
+        hits = 0
+        for query, exact_row in zip(queries, exact):
+            _, candidates = search(index, query.reshape(1, -1), args.k * args.rerank_factor, args.nprobe, args.ef_search)
+            _, reranked = rerank(query, candidates[0], store.embeddings_by_rowids([int(i) for i in candidates[0] if i >= 0]),
+                                 args.k)
+            hits += len(set(exact_row[exact_row >= 0]) & set(reranked[0]))
+        rerank_ms = (time.time() - start) * 1000.0 / len(queries)
+        store.close()
+        print(f"recall@{args.k} with {args.k * args.rerank_factor} candidates reranked in float32: "
+              f"{hits / float(len(queries) * args.k):.4f} ({rerank_ms:.2f} ms/query)")
+
 
 if __name__ == '__main__':
-    rebuild_faiss_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Rebuild or migrate the FAISS index from image_data.db")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat')
+    parser.add_argument('--nlist', type=int, default=DEFAULT_NLIST, help="IVF inverted lists")
+    parser.add_argument('--pq-m', type=int, default=DEFAULT_PQ_M, help="PQ sub-quantizers (must divide the embedding size)")
+    parser.add_argument('--hnsw-m', type=int, default=DEFAULT_HNSW_M, help="HNSW neighbours per node")
+    parser.add_argument('--train-size', type=int, default=DEFAULT_TRAIN_SIZE, help="Vectors sampled from image_data for training")
+    parser.add_argument('--migrate', action='store_true', help="Convert the existing faiss_index.bin in place over the same images")
+    parser.add_argument('--eval-recall', action='store_true', help="Report recall@k against a flat baseline")
+    parser.add_argument('--recall-queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef-search', type=int, default=None)
+    parser.add_argument('--rerank-factor', type=int, default=4,
+                        help="With --eval-recall on lossy indexes, also report recall after reranking k times this many candidates")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    ensure_embedding_columns(cursor)
+    start = time.time()
+    if args.migrate:
+        index, sample = migrate_faiss_index(args, cursor)
+    else:
+        index, sample = rebuild_faiss_index(args, cursor)
+    if index is not None:
+        cursor.execute('SELECT embedding_format, COUNT(*) FROM image_data WHERE embedding IS NOT NULL GROUP BY 1')
+        formats = ', '.join(f"{count} {fmt or 'float32'}" for fmt, count in cursor.fetchall())
+        print(f"Built in {time.time() - start:.1f}s from {formats} embeddings; "
+              f"{DATABASE_PATH} is {os.path.getsize(DATABASE_PATH) / 2**20:.0f} MB")
+    if index is not None and args.eval_recall:
+        report_recall(index, sample, cursor, args)
+    cursor.close()
+    conn.close()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# search_server.py
+#
+# Search-only replica of server.py. It never imports torch or loads the
+# model, so it starts in about a second and can run as many uvicorn workers
+# as needed next to (or away from) the captioning server:
+#
+#   - faiss_index.bin is mapped read-only (index_factory.read_index_mmap), so
+#     every worker shares the vectors through the page cache instead of each
+#     holding its own copy
+#   - image_data.db is opened read-only
+#   - /search answers image_hash and raw vector queries; text queries are
+#     answered from the writer's text-query embedding cache and refused on a
+#     miss, since embedding new text needs the model
+#   - on indexes over lossy codes, candidates are reranked in float32 on
+#     their stored vectors, as in server.py
+#
+# The writer publishes a new index generation with every checkpoint, by
+# renaming a complete file over faiss_index.bin. A background thread notices
+# the new file, maps it and swaps it in with one assignment; searches already
+# running finish on the generation they started with. Vectors logged since
+# the last checkpoint become searchable with the next one.
+#
+# Start with: uvicorn search_server:app --host 0.0.0.0 --port 8001 --workers 4
+
+import os
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+from fastapi import FastAPI, Body, Query
+
+import index_wal
+from embedding_cache import normalize_query
+from image_store import ImageStore
+from index_factory import candidate_count, describe_index, read_index_mmap, rerank, search
+
+DATABASE_PATH = 'image_data.db'
+FAISS_INDEX_PATH = "faiss_index.bin"
+# Seconds between checks for a new index generation
+RELOAD_INTERVAL_SECONDS = float(os.environ.get("RELOAD_INTERVAL_SECONDS", "5"))
+# The writer's text cache is keyed by model version, server.py's backend name
+TEXT_MODEL_VERSION = os.environ.get("TEXT_MODEL_VERSION", "./models/THUDM/cogvlm2-llama3-chat-19B/")
+# Candidates per result to rerank on indexes over lossy codes, as server.py's
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", "4"))
+
+
+def file_generation(path):
+    # A checkpoint renames a new file into place, so the inode changes with every generation
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def memory_stats():
+    """Resident memory of this process in MB: all of it, the private part, and the
+    shared file pages (the mapped index), plus the proportional share where available."""
+    stats = {}
+    for status_path, keys in (('/proc/self/status', ('VmRSS', 'RssAnon', 'RssFile')),
+                              ('/proc/self/smaps_rollup', ('Pss',))):
+        try:
+            with open(status_path) as f:
+                for line in f:
+                    key = line.split(':')[0]
+                    if key in keys:
+                        stats[key] = int(line.split()[1]) / 1024.0
+        except OSError:
+            pass
+    return stats
+
+
+class Generation:
+    def __init__(self, index, file_key, checkpoint_seq, load_seconds):
+        self.index = index
+        self.file_key = file_key
+        self.checkpoint_seq = checkpoint_seq
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+
+
+class IndexReplica:
+    """Holds the current mapped generation of the index and swaps in new ones."""
+
+    def __init__(self, index_path, store, interval=RELOAD_INTERVAL_SECONDS):
+        self.index_path = index_path
+        self.store = store
+        self.interval = interval
+        self.generation = None
+        self.reloads = 0
+        self.failed_reloads = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def load(self):
+        """Maps the index file if it is a generation not loaded yet. Returns True if it swapped."""
+        file_key = file_generation(self.index_path)
+        if file_key is None or (self.generation is not None and self.generation.file_key == file_key):
+            return False
+        start = time.time()
+        # Should another checkpoint land between the stat and the read, the key
+        # is stale and the next check maps the newer file again
+        index = read_index_mmap(self.index_path)
+        # Recorded just after the rename, so this can lag the file by one checkpoint
+        seq = index_wal.checkpoint_seq(self.store.cursor())
+        # One assignment: searches hold whichever generation they picked up
+        self.generation = Generation(index, file_key, seq, time.time() - start)
+        self.reloads += 1
+        print(f"Mapped FAISS index generation with {index.ntotal} embeddings (checkpoint {seq}) "
+              f"in {self.generation.load_seconds * 1000:.0f} ms.")
+        return True
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="index-reloader", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.load()
+            except Exception as e:
+                # Keep serving the previous generation; the next check tries again
+                self.failed_reloads += 1
+                print(f"Error loading a new index generation: {e}")
+
+    def stats(self):
+        generation = self.generation
+        return {
+            "index_path": self.index_path,
+            "loaded": generation is not None,
+            "checkpoint_seq": generation.checkpoint_seq if generation else None,
+            "load_ms": generation.load_seconds * 1000 if generation else None,
+            "loaded_at": generation.loaded_at if generation else None,
+            "reloads": self.reloads,
+            "failed_reloads": self.failed_reloads,
+            "reload_interval_seconds": self.interval,
+        }
+
+
+app = FastAPI(
+    title="CogVLM2 Search Replica",
+    description="Read-only FAISS search over the captioning server's index and database, without the model.",
+    version="1.0.0"
+)
+
+store = ImageStore(DATABASE_PATH, read_only=True)
+replica = IndexReplica(FAISS_INDEX_PATH, store)
+replica.load()
+replica.start()
+
+@app.on_event("shutdown")
+def stop_replica():
+    replica.stop()
+
+
+@app.post("/search", summary="Search images in the FAISS index by hash, vector or cached text")
+def search_image(
+        image_hash: Optional[str] = Body(None),
+        vector: Optional[List[float]] = Body(None),
+        text: Optional[str] = Body(None),
+        k: int = Query(5, description="Number of nearest neighbors to retrieve"),
+        nprobe: Optional[int] = Query(None, description="IVF lists to visit (IVF indexes only)"),
+        ef_search: Optional[int] = Query(None, description="HNSW search depth (HNSW indexes only)")
+):
+    generation = replica.generation
+    if generation is None or generation.index.ntotal == 0:
+        return {"error": "FAISS index is empty. Add images with embeddings first."}
+    index = generation.index
+
+    try:
+        if image_hash is not None:
+            embedding = store.get_embedding(image_hash)
+            if embedding is None:
+                return {"error": f"Image hash not found in database: {image_hash}"}
+        elif vector is not None:
+            embedding = np.asarray(vector, dtype=np.float32)
+        elif text is not None:
+            embedding = store.get_text_embedding(TEXT_MODEL_VERSION, normalize_query(text))
+            if embedding is None:
+                return {"error": "No cached embedding for this text; search it on the captioning server first."}
+        else:
+            return {"error": "No input provided for search. Please provide an image hash, a vector or text."}
+        if embedding.shape[0] != index.d:
+            return {"error": f"Expected a vector of {index.d} values, got {embedding.shape[0]}."}
+
+        fetch = candidate_count(index, k, RERANK_FACTOR)
+        D, I = search(index, embedding.reshape(1, -1), fetch, nprobe, ef_search)
+        if fetch > k:
+            D, I = rerank(embedding, I[0], store.embeddings_by_rowids([int(idx) for idx in I[0] if idx >= 0]), k)
+
+        # FAISS returns image_data rowids; fetch all neighbours in one lookup
+        rows = store.hydrate_rowids([int(idx) for idx in I[0] if idx >= 0])
+
+        results = []
+        for idx, dist in zip(I[0], D[0]):
+            if idx < 0 or int(idx) not in rows:
+                # Deleted since this generation was checkpointed
+                continue
+            result_hash, result_filename, description = rows[int(idx)]
+            results.append({
+                "hash": result_hash,
+                "distance": float(dist),
+                "filename": result_filename,
+                "description": description
+            })
+
+        return {"results": results}
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return {"error": f"An error occurred: {str(e)}"}
+
+@app.get("/debug", summary="Index generation and memory of this worker")
+def debug_info():
+    generation = replica.generation
+    return {
+        "pid": os.getpid(),
+        "faiss_index": describe_index(generation.index) if generation else None,
+        "replica": replica.stats(),
+        "memory_mb": memory_stats(),
+        "text_model_version": TEXT_MODEL_VERSION,
+    }
+
+# Start the server with: uvicorn search_server:app --host 0.0.0.0 --port 8001 --workers 4
@@ -1,73 +1,65 @@
 #!/usr/bin/env python3
 # server.py
 
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Body, UploadFile, File, Query
 from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 import pickle
 import hashlib
-import torch
 import faiss
 import numpy as np
-from PIL import Image
 from io import BytesIO
-from fastapi import FastAPI, Body, UploadFile, File, Query
 from pydantic import BaseModel, Field
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from accelerate import init_empty_weights, load_checkpoint_and_dispatch, infer_auto_device_map
-import transformers
-from typing import List, Optional
-import sqlite3
-
-print(f"PyTorch version: {torch.__version__}")
-print(f"Transformers version: {transformers.__version__}")
+import threading
+
+from batching import MicroBatcher
+from model_backend import load_backend
+from index_factory import (INDEX_TYPES, TRAINED_TYPES, create_index, describe_index, search, with_ids, add_with_ids,
+                           remove_ids, supports_removal, candidate_count, rerank)
+import index_wal
+from image_store import ImageStore
+from rebuild_faiss_and_indices import add_in_chunks
+from embedding_cache import TextEmbeddingCache
+from ingest import IngestManager, prepare_image
 
 LOCAL_MODEL_DIR = "./models/THUDM/cogvlm2-llama3-chat-19B/"
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-TORCH_TYPE = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+# "cogvlm2" for the real model, "stub" for the CPU stand-in used in benchmarks
+CAPTION_BACKEND = os.environ.get("CAPTION_BACKEND", "cogvlm2")
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MAX_BATCH_WAIT_MS", "20"))
+# "prefill" takes the image embedding from the caption's own prefill pass,
+# "two_pass" runs the old separate forward pass
+EMBEDDING_MODE = os.environ.get("EMBEDDING_MODE", "prefill")
+# Index type for a brand new index, one of index_factory.INDEX_TYPES. Types that
+# need training start out flat and are converted by rebuild_faiss_and_indices.py.
+FAISS_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+# New vectors go to the index_wal table; the index file is rewritten by a
+# background checkpoint at most this often, or sooner after this many entries
+CHECKPOINT_INTERVAL_SECONDS = float(os.environ.get("CHECKPOINT_INTERVAL_SECONDS", "60"))
+CHECKPOINT_MAX_PENDING = int(os.environ.get("CHECKPOINT_MAX_PENDING", "1000"))
+# Format new embeddings are stored in, one of embedding_codec.FORMATS; existing
+# rows are converted with migrate_embedding_format.py
+EMBEDDING_FORMAT = os.environ.get("EMBEDDING_FORMAT", "float32")
+# On indexes over lossy codes (ivf_pq, sq8, sq_fp16), fetch k times this many
+# candidates and rerank them on their stored vectors in float32; 1 turns it off
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", "4"))
+# In-memory budget for cached text-query embeddings, and whether misses also
+# fall through to (and fill) a table in image_data.db
+TEXT_CACHE_MAX_BYTES = int(os.environ.get("TEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TEXT_CACHE_DISK = os.environ.get("TEXT_CACHE_DISK", "1") == "1"
+# /ingest worker pools; decoding overlaps with captioning on the GPUs
+INGEST_HASH_WORKERS = int(os.environ.get("INGEST_HASH_WORKERS", "8"))
+INGEST_DECODE_WORKERS = int(os.environ.get("INGEST_DECODE_WORKERS", "4"))
 
 origins = [
     "http://localhost:3000",
 ]
 
-tokenizer = AutoTokenizer.from_pretrained(LOCAL_MODEL_DIR, trust_remote_code=True)
-if tokenizer.pad_token_id is None:
-    tokenizer.pad_token_id = 128002
-if tokenizer.eos_token_id is None:
-    tokenizer.eos_token_id = 128003
-
-print(f"pad_token_id: {tokenizer.pad_token_id}")
-print(f"eos_token_id: {tokenizer.eos_token_id}")
-
-with init_empty_weights():
-    model = AutoModelForCausalLM.from_pretrained(
-        LOCAL_MODEL_DIR,
-        torch_dtype=TORCH_TYPE,
-        trust_remote_code=True,
-    )
-
-num_gpus = torch.cuda.device_count()
-
-max_memory = {
-    0: "20.5GiB",
-    1: "23GiB"
-}
-
-if num_gpus != len(max_memory):
-    raise ValueError(f"Number of GPUs ({num_gpus}) does not match the number of specified memory limits ({len(max_memory)}).")
-
-device_map = infer_auto_device_map(
-    model=model,
-    max_memory=max_memory,
-    no_split_module_classes=["CogVLMDecoderLayer"]
-)
-
-offload_folder = "/tmp/offload"
-if not os.path.exists(offload_folder):
-    os.makedirs(offload_folder)
-
 app = FastAPI(
     title="CogVLM2 Multi-GPU Image Captioning API",
     description="This API generates detailed captions for images using CogVLM2, stores embeddings using FAISS, and provides debugging information. It supports multi-GPU inference for large models.",
@@ -81,190 +73,206 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model = load_checkpoint_and_dispatch(
-    model=model,
-    checkpoint=LOCAL_MODEL_DIR,
-    device_map=device_map,
-    dtype=TORCH_TYPE,
-    offload_folder=offload_folder,
-)
-
-model = model.eval()
+backend = load_backend(CAPTION_BACKEND, LOCAL_MODEL_DIR, EMBEDDING_MODE)
+DEVICE = backend.device
+TORCH_TYPE = backend.torch_dtype
 
-task_prompt = ("Provide a detailed caption that fully describes the image. Be sure to describe any text the image "
-               "contains. If it contains NSFW content, describe it in detail and include a NSFW specifier. If the "
-               "image contains people of identifiable races, be sure to mention those, including but not limited to "
-               "black, African black, white, Asian, Hispanic, Jewish, or Arab. If the image contains animals, "
-               "describe them in detail. Attempt to describe any jokes. Attempt to describe any memes. If the "
-               "image seems controversial or political, attempt to describe that in detail, including why it may be "
-               "offensive. If it does not contain any of these elements don't bother mentioning their absence.")
+caption_batcher = MicroBatcher(backend.caption_batch, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, name="caption")
+text_batcher = MicroBatcher(backend.embed_text_batch, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, name="text")
 
 index = None
 index_to_metadata = {}
-index_hash_keys = []
+# Guards every mutation of the index against the background checkpoint
+index_lock = threading.Lock()
+# Anything that takes index_lock runs here, never on the event loop, so a
+# checkpoint serializing a large index doesn't stall every request
+index_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="index")
 
+async def in_index_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(index_executor, fn, *args)
+
+DATABASE_PATH = 'image_data.db'
 FAISS_INDEX_PATH = "faiss_index.bin"
-INDEX_HASH_KEYS_PATH = 'index_hash_keys.pkl'
+# Only read to migrate indexes written before vectors carried stable IDs
+LEGACY_INDEX_HASH_KEYS_PATH = 'index_hash_keys.pkl'
+ADD_CHUNK_SIZE = 10000
 
-conn = sqlite3.connect('image_data.db')
-cursor = conn.cursor()
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS image_data (
-        hash TEXT PRIMARY KEY,
-        filename TEXT,
-        description TEXT,
-        embedding BLOB
-    )
-''')
+store = ImageStore(DATABASE_PATH, embedding_format=EMBEDDING_FORMAT)
 
+checkpointer = index_wal.Checkpointer(lambda: index, index_lock, FAISS_INDEX_PATH, store,
+                                      CHECKPOINT_INTERVAL_SECONDS, CHECKPOINT_MAX_PENDING)
 
 
 def save_faiss_index():
-    global index, index_hash_keys
+    # Synchronous checkpoint; request handlers only append to the log
     if index is not None:
-        faiss.write_index(index, FAISS_INDEX_PATH)
-        with open(INDEX_HASH_KEYS_PATH, 'wb') as f:
-            pickle.dump(index_hash_keys, f)
-        print(f"Saved FAISS index with {index.ntotal} embeddings and index_hash_keys with {len(index_hash_keys)} entries.")
-        conn.commit()
+        checkpointer.checkpoint(store.connection())
+
+def new_index(embedding_size):
+    if FAISS_INDEX_TYPE not in INDEX_TYPES or FAISS_INDEX_TYPE in TRAINED_TYPES:
+        print(f"Index type {FAISS_INDEX_TYPE} needs training; starting flat. Run rebuild_faiss_and_indices.py --migrate later.")
+        return with_ids(create_index("flat", embedding_size))
+    return with_ids(create_index(FAISS_INDEX_TYPE, embedding_size))
+
+def migrate_legacy_index(legacy_index, hash_keys):
+    # Re-adds every vector under its image_data rowid, keeping the trained
+    # quantizer of the legacy index
+    legacy_index.reset()
+    migrated = with_ids(legacy_index)
+    rowids, vectors = [], []
+    for rowid, embedding in store.embeddings_by_hash(hash_keys):
+        rowids.append(rowid)
+        vectors.append(embedding)
+        if len(rowids) == ADD_CHUNK_SIZE:
+            add_with_ids(migrated, np.vstack(vectors), rowids)
+            rowids, vectors = [], []
+    if rowids:
+        add_with_ids(migrated, np.vstack(vectors), rowids)
+    if migrated.ntotal < len(hash_keys):
+        print(f"Warning: dropped {len(hash_keys) - migrated.ntotal} index_hash_keys entries with no embedding in the database.")
+    return migrated
+
+def rebuild_from_store():
+    # Startup only: nothing else writes to image_data or the log yet
+    embedding_size = store.first_embedding_size()
+    if embedding_size is None:
+        return None
+    rebuilt = new_index(embedding_size)
+    cursor = store.cursor()
+    cursor.execute(f'SELECT rowid, {store.embedding_columns} FROM image_data WHERE embedding IS NOT NULL')
+    add_in_chunks(rebuilt, cursor, embedding_size)
+    return rebuilt
 
 def load_faiss_index():
-    global index, index_hash_keys
+    global index
     if os.path.exists(FAISS_INDEX_PATH):
         index = faiss.read_index(FAISS_INDEX_PATH)
         print(f"Loaded FAISS index with {index.ntotal} embeddings.")
-        if os.path.exists(INDEX_HASH_KEYS_PATH):
-            with open(INDEX_HASH_KEYS_PATH, 'rb') as f:
-                index_hash_keys = pickle.load(f)
-            print(f"Loaded index_hash_keys with {len(index_hash_keys)} entries.")
-        else:
-            print("index_hash_keys file not found. Initializing empty list.")
-            index_hash_keys = []
+        if os.path.exists(LEGACY_INDEX_HASH_KEYS_PATH):
+            with open(LEGACY_INDEX_HASH_KEYS_PATH, 'rb') as f:
+                hash_keys = pickle.load(f)
+            print(f"Migrating positional index with {len(hash_keys)} index_hash_keys to rowid-based IDs...")
+            index = migrate_legacy_index(index, hash_keys)
+            save_faiss_index()
+            os.remove(LEGACY_INDEX_HASH_KEYS_PATH)
+            print(f"Migrated FAISS index to {index.ntotal} ID-mapped embeddings and removed {LEGACY_INDEX_HASH_KEYS_PATH}.")
+    elif index_wal.checkpoint_seq(store.cursor()) > 0:
+        # The log before the checkpoint is gone, so replaying it would only give a
+        # partial index that the next checkpoint then persists; rebuild it all
+        print("Warning: the log was checkpointed into a FAISS index file that is now missing. "
+              "Rebuilding the index from image_data...")
+        index = rebuild_from_store()
+        if index is not None:
+            save_faiss_index()
+            print(f"Rebuilt FAISS index with {index.ntotal} embeddings.")
+        return
     else:
-        print("FAISS index file not found. Initializing empty index and index_hash_keys.")
+        print("FAISS index file not found. Initializing empty index.")
         index = None
-        index_hash_keys = []
 
-load_faiss_index()
+    # Replay vectors written since the last checkpoint
+    cursor = store.cursor()
+    cursor.execute('SELECT COUNT(*) FROM index_wal WHERE seq > ?', (index_wal.checkpoint_seq(cursor),))
+    if cursor.fetchone()[0]:
+        if index is None:
+            embedding_size = store.first_embedding_size()
+            if embedding_size is None:
+                return
+            index = new_index(embedding_size)
+        applied = index_wal.replay(index, cursor)
+        print(f"Replayed {applied} index log entries; FAISS index now has {index.ntotal} embeddings.")
+        checkpointer.notify(applied)
 
-def generate_text_embedding(text):
+load_faiss_index()
+checkpointer.start()
+
+@app.on_event("shutdown")
+def stop_checkpointer():
+    # Let index writes still running finish so the final checkpoint holds them
+    index_executor.shutdown(wait=True)
+    checkpointer.stop()
+
+def store_embedding(hash_value, filename, description, embedding):
+    """Inserts or replaces an image row and its vector, keyed by the row's rowid.
+
+    The row and its log entry commit together; the index file itself is only
+    rewritten by the next checkpoint.
+    """
+    global index
+    with index_lock:
+        if index is None:
+            index = new_index(embedding.shape[0])
+        # Refuse before committing, or image_data and the index would disagree
+        if not supports_removal(index) and store.get_rowid(hash_value) is not None:
+            raise RuntimeError(f"Cannot replace {hash_value}: HNSW indexes do not support removal")
+        rowid, replaced = store.upsert(hash_value, filename, description, embedding)
+        if replaced:
+            remove_ids(index, [rowid])
+        add_with_ids(index, np.array([embedding]), [rowid])
+    checkpointer.notify(2 if replaced else 1)
+    return rowid
+
+def delete_embedding(hash_value):
+    with index_lock:
+        if index is not None and not supports_removal(index) and store.get_rowid(hash_value) is not None:
+            raise RuntimeError(f"Cannot delete {hash_value}: HNSW indexes do not support removal")
+        rowid = store.delete(hash_value)
+        if rowid is None:
+            return False
+        if index is not None:
+            remove_ids(index, [rowid])
+    checkpointer.notify()
+    return True
+
+def search_index(embedding, k, nprobe=None, ef_search=None):
+    """Searches the index and hydrates the hits; blocking, run it with in_index_thread."""
+    with index_lock:
+        fetch = candidate_count(index, k, RERANK_FACTOR)
+        D, I = search(index, np.array([embedding]).astype("float32"), fetch, nprobe, ef_search)
+    if fetch > k:
+        D, I = rerank(embedding, I[0], store.embeddings_by_rowids([int(idx) for idx in I[0] if idx >= 0]), k)
+    # FAISS returns image_data rowids; fetch all neighbours in one lookup
+    rows = store.hydrate_rowids([int(idx) for idx in I[0] if idx >= 0])
+    return D, I, rows
+
+async def generate_text_embedding(text):
     try:
-        # Prepare input for the model without images
-        input_by_model = model.build_conversation_input_ids(
-            tokenizer,
-            query=text,
-            history=[],
-            images=None,  # No images provided
-            template_version='chat'
-        )
-
-        # Create tensors from input
-        input_ids = input_by_model['input_ids'].unsqueeze(0).to(DEVICE)
-        token_type_ids = input_by_model['token_type_ids'].unsqueeze(0).to(DEVICE)
-        attention_mask = input_by_model['attention_mask'].unsqueeze(0).to(DEVICE)
-
-        # Generate embeddings
-        with torch.no_grad():
-            outputs = model(
-                input_ids=input_ids,
-                token_type_ids=token_type_ids,
-                attention_mask=attention_mask,
-                output_hidden_states=True
-            )
-
-            # Calculate the mean of the last hidden state for embedding
-            embedding = outputs.hidden_states[-1].mean(dim=1).squeeze(0).to(torch.float32).cpu().numpy()
-
-        return embedding
+        return await text_batcher.submit(text)
     except Exception as e:
         print(f"Error in generate_text_embedding: {e}")
         return None
 
-def generate_caption(image):
+text_embedding_cache = TextEmbeddingCache(generate_text_embedding, backend.version, TEXT_CACHE_MAX_BYTES,
+                                          store if TEXT_CACHE_DISK else None)
+
+async def generate_caption(image):
     try:
-        # Prepare input for the model
-        input_by_model = model.build_conversation_input_ids(
-            tokenizer,
-            query=task_prompt,
-            history=[],
-            images=[image],  # Use the resized image
-            template_version='chat'
-        )
-
-        # Create tensors from input
-        input_ids = input_by_model['input_ids'].unsqueeze(0).to(DEVICE)
-        token_type_ids = input_by_model['token_type_ids'].unsqueeze(0).to(DEVICE)
-        attention_mask = input_by_model['attention_mask'].unsqueeze(0).to(DEVICE)
-        images_tensor = [[input_by_model['images'][0].to(DEVICE).to(TORCH_TYPE)]]
-
-        # Generate caption
-        caption_inputs = {
-            'input_ids': input_ids,
-            'token_type_ids': token_type_ids,
-            'attention_mask': attention_mask,
-            'images': images_tensor,
-        }
-        gen_kwargs = {
-            "max_new_tokens": 2048,
-            "pad_token_id": 128002,
-            "top_k": 1,
-        }
-        with torch.no_grad():
-            # Generate the text response (caption)
-            caption_outputs = model.generate(**caption_inputs, **gen_kwargs)
-            caption_outputs = caption_outputs[:, input_ids.shape[1]:]
-            caption = tokenizer.decode(caption_outputs[0])
-            caption = caption.split(tokenizer.eos_token)[0].strip()
-
-        print(f"Generated caption: {caption}")
-        # Generate embeddings separately by calling the model directly
-        with torch.no_grad():
-            outputs = model(
-                input_ids=input_ids,
-                token_type_ids=token_type_ids,
-                attention_mask=attention_mask,
-                images=images_tensor,
-                output_hidden_states=True
-            )
-
-            # Calculate the mean of the last hidden state for embedding
-            embedding = outputs.hidden_states[-1].mean(dim=1).squeeze(0).to(torch.float32).cpu().numpy()
-        return caption, embedding
+        return await caption_batcher.submit(image)
     except Exception as e:
         print(f"Error in generate_caption: {e}")
         return {"error": f"An error occurred: {str(e)}"}, None
 
-def process_image(image_data, filename, insert_embeddings):
-    global index, index_hash_keys, cursor, conn
+async def process_image(image_data, filename, insert_embeddings, replace=False):
     results = {}
     db_status = {}
     try:
         hash_value = hashlib.sha256(image_data).hexdigest()
 
         # Check if image has been processed before
-        cursor.execute('SELECT description, embedding FROM image_data WHERE hash=?', (hash_value,))
-        row = cursor.fetchone()
-        if row:
-            description, embedding_blob = row
-            embedding = np.frombuffer(embedding_blob, dtype=np.float32)
+        row = store.get_description_and_embedding(hash_value)
+        if row and not replace:
+            description, embedding = row
             db_status[hash_value] = "Retrieved from database."
         else:
-            image = Image.open(BytesIO(image_data)).convert("RGB")
-            description, embedding = generate_caption(image)
+            image = prepare_image(BytesIO(image_data))
+            description, embedding = await generate_caption(image)
             if insert_embeddings:
                 if embedding is not None:
-                    # Add to FAISS Index
-                    if index is None:
-                        embedding_size = embedding.shape[0]
-                        index = faiss.IndexFlatL2(embedding_size)
-                    index.add(np.array([embedding]).astype("float32"))
-                    index_hash_keys.append(hash_value)
-                    cursor.execute('''
-                        INSERT INTO image_data (hash, filename, description, embedding)
-                        VALUES (?, ?, ?, ?)
-                    ''', (hash_value, filename, description, embedding.tobytes()))
-                    conn.commit()
-                    db_status[hash_value] = "Successfully added to FAISS and database."
+                    await in_index_thread(store_embedding, hash_value, filename, description, embedding)
+                    if row:
+                        db_status[hash_value] = "Successfully replaced in FAISS and database."
+                    else:
+                        db_status[hash_value] = "Successfully added to FAISS and database."
                 else:
                     db_status[hash_value] = "Failed to generate embedding."
             else:
@@ -280,10 +288,23 @@ def process_image(image_data, filename, insert_embeddings):
     return results, db_status
 
 
+async def ingest_image(hash_value, path, image):
+    description, embedding = await generate_caption(image)
+    if embedding is None:
+        raise RuntimeError(description.get("error", "Failed to generate embedding.") if isinstance(description, dict)
+                           else "Failed to generate embedding.")
+    await in_index_thread(store_embedding, hash_value, path, description, embedding)
+    return "Successfully added to FAISS and database."
+
+ingest_manager = IngestManager(store, ingest_image, INGEST_HASH_WORKERS, INGEST_DECODE_WORKERS,
+                               max_in_flight=MAX_BATCH_SIZE * 4)
+
+
 @app.post("/caption", summary="Generate Caption for Image")
 async def caption_image(
         file: UploadFile = File(None),
         insert_embeddings: bool = Query(True),
+        replace: bool = Query(False, description="Re-caption images that are already in the database"),
         image_paths: Optional[List[str]] = Body(None)
 ):
     results = {}
@@ -292,7 +313,7 @@ async def caption_image(
     if file is not None:
         # Process the uploaded file
         image_data = await file.read()
-        res, status = process_image(image_data, file.filename, insert_embeddings)
+        res, status = await process_image(image_data, file.filename, insert_embeddings, replace)
         results.update(res)
         db_status.update(status)
     elif image_paths is not None:
@@ -301,7 +322,7 @@ async def caption_image(
             if os.path.exists(image_path):
                 with open(image_path, 'rb') as f:
                     image_data = f.read()
-                res, status = process_image(image_data, image_path, insert_embeddings)
+                res, status = await process_image(image_data, image_path, insert_embeddings, replace)
                 results.update(res)
                 db_status.update(status)
             else:
@@ -309,7 +330,6 @@ async def caption_image(
     else:
         return {"error": "No file uploaded or image paths provided.", "db_status": db_status}
 
-    save_faiss_index()
     return {"results": results, "db_status": db_status}
 
 
@@ -320,24 +340,25 @@ async def search_image(
         image_hash: Optional[str] = Body(None),
         text: Optional[str] = Body(None),
         k: int = Query(5, description="Number of nearest neighbors to retrieve"),
+        nprobe: Optional[int] = Query(None, description="IVF lists to visit (IVF indexes only)"),
+        ef_search: Optional[int] = Query(None, description="HNSW search depth (HNSW indexes only)"),
         store_in_db: bool = Query(True)
 ):
-    global index, index_hash_keys, index_to_metadata
+    global index, index_to_metadata
 
-    # Ensure the FAISS index and index_hash_keys are loaded
-    if index is None or len(index_hash_keys) == 0:
+    # Ensure the FAISS index is loaded
+    if index is None:
         load_faiss_index()
 
     if index is None or index.ntotal == 0:
         print(f"FAISS index is empty. Index total: {index.ntotal if index else 'None'}")
-        print(f"index_hash_keys length: {len(index_hash_keys)}")
         return {"error": "FAISS index is empty. Add images with embeddings first."}
 
     try:
         # Determine the source of the query embedding
         if text is not None:
             # Generate embedding from text
-            embedding = generate_text_embedding(text)
+            embedding = await text_embedding_cache.get(text)
             if embedding is None:
                 return {"error": "Failed to generate embedding for the provided text."}
         elif file is not None:
@@ -345,87 +366,59 @@ async def search_image(
             image_data = await file.read()
             filename = file.filename
             # Generate embedding from image
-            image = Image.open(BytesIO(image_data)).convert("RGB")
-            _, embedding = generate_caption(image)
+            image = prepare_image(BytesIO(image_data))
+            _, embedding = await generate_caption(image)
             if embedding is None:
                 return {"error": "Failed to generate embedding for the uploaded image."}
             # Optionally store the embedding and image data
             if store_in_db:
                 hash_value = hashlib.sha256(image_data).hexdigest()
-                cursor.execute('SELECT embedding FROM image_data WHERE hash=?', (hash_value,))
-                row = cursor.fetchone()
-                if row is None:
+                if store.get_rowid(hash_value) is None:
                     # Store in database
-                    cursor.execute('''
-                        INSERT INTO image_data (hash, filename, description, embedding)
-                        VALUES (?, ?, ?, ?)
-                    ''', (hash_value, filename, "", embedding.tobytes()))
-                    conn.commit()
-                    # Add to FAISS index
-                    index.add(np.array([embedding]).astype("float32"))
-                    index_hash_keys.append(hash_value)
-                    save_faiss_index()
+                    await in_index_thread(store_embedding, hash_value, filename, "", embedding)
         elif image_path is not None:
             if os.path.exists(image_path):
                 with open(image_path, 'rb') as f:
                     image_data = f.read()
                 filename = image_path
                 # Generate embedding from image
-                image = Image.open(BytesIO(image_data)).convert("RGB")
-                _, embedding = generate_caption(image)
+                image = prepare_image(BytesIO(image_data))
+                _, embedding = await generate_caption(image)
                 if embedding is None:
                     return {"error": "Failed to generate embedding for the image at the provided path."}
                 # Optionally store the embedding and image data
                 if store_in_db:
                     hash_value = hashlib.sha256(image_data).hexdigest()
-                    cursor.execute('SELECT embedding FROM image_data WHERE hash=?', (hash_value,))
-                    row = cursor.fetchone()
-                    if row is None:
+                    if store.get_rowid(hash_value) is None:
                         # Store in database
-                        cursor.execute('''
-                            INSERT INTO image_data (hash, filename, description, embedding)
-                            VALUES (?, ?, ?, ?)
-                        ''', (hash_value, filename, "", embedding.tobytes()))
-                        conn.commit()
-                        # Add to FAISS index
-                        index.add(np.array([embedding]).astype("float32"))
-                        index_hash_keys.append(hash_value)
-                        save_faiss_index()
+                        await in_index_thread(store_embedding, hash_value, filename, "", embedding)
             else:
                 return {"error": f"File does not exist: {image_path}"}
         elif image_hash is not None:
-            cursor.execute('SELECT filename, embedding FROM image_data WHERE hash=?', (image_hash,))
-            row = cursor.fetchone()
-            if row:
-                filename, embedding_blob = row
-                embedding = np.frombuffer(embedding_blob, dtype=np.float32)
-            else:
+            embedding = store.get_embedding(image_hash)
+            if embedding is None:
                 return {"error": f"Image hash not found in database: {image_hash}"}
         else:
             return {"error": "No input provided for search. Please provide text, an image file, image path, or image hash."}
 
         # Search in the FAISS index
-        print(f"Searching FAISS index with {index.ntotal} embeddings and {len(index_hash_keys)} keys.")
-        D, I = index.search(np.array([embedding]).astype("float32"), k)
+        print(f"Searching FAISS index with {index.ntotal} embeddings.")
+        D, I, rows = await in_index_thread(search_index, embedding, k, nprobe, ef_search)
 
         results = []
         for idx, dist in zip(I[0], D[0]):
-            if 0 <= idx < len(index_hash_keys):
-                result_hash = index_hash_keys[idx]
-                cursor.execute('SELECT filename, description FROM image_data WHERE hash=?', (result_hash,))
-                row = cursor.fetchone()
-                if row:
-                    result_filename, description = row
-                else:
-                    result_filename, description = None, None
-                results.append({
-                    "hash": result_hash,
-                    "distance": float(dist),
-                    "filename": result_filename,
-                    "description": description
-                })
-            else:
-                print(f"Warning: Index {idx} is out of bounds for index_hash_keys (length {len(index_hash_keys)}).")
+            if idx < 0:
+                continue
+            if int(idx) not in rows:
+                print(f"Warning: FAISS id {idx} has no row in image_data.")
+                continue
+            result_hash, result_filename, description = rows[int(idx)]
+            results.append({
+                "hash": result_hash,
+                "distance": float(dist),
+                "filename": result_filename,
+                "description": description
+            })
 
         return {"results": results}
 
@@ -434,6 +427,51 @@ async def search_image(
         traceback.print_exc()
         return {"error": f"An error occurred: {str(e)}"}
 
+@app.post("/ingest", summary="Start a bulk ingest job for a server-side directory or list of paths")
+async def start_ingest(
+        directory: Optional[str] = Body(None),
+        paths: Optional[List[str]] = Body(None)
+):
+    if directory is None and not paths:
+        return {"error": "Provide a directory or a list of paths to ingest."}
+    if directory is not None and not os.path.isdir(directory):
+        return {"error": f"Directory does not exist: {directory}"}
+    job_id = ingest_manager.create_job(directory, paths)
+    ingest_manager.start(job_id)
+    return {"job_id": job_id}
+
+@app.get("/ingest/{job_id}", summary="Ingest job status")
+async def ingest_status(job_id: str):
+    status = ingest_manager.status(job_id)
+    if status is None:
+        return {"error": f"Unknown ingest job: {job_id}"}
+    return status
+
+@app.get("/ingest/{job_id}/events", summary="Stream per-item ingest progress as NDJSON")
+async def ingest_events(job_id: str):
+    if not ingest_manager.job_exists(job_id):
+        return {"error": f"Unknown ingest job: {job_id}"}
+    return StreamingResponse(ingest_manager.events(job_id), media_type="application/x-ndjson")
+
+@app.post("/ingest/{job_id}/resume", summary="Resume an interrupted ingest job")
+async def resume_ingest(job_id: str):
+    if not ingest_manager.job_exists(job_id):
+        return {"error": f"Unknown ingest job: {job_id}"}
+    if not ingest_manager.start(job_id):
+        return {"error": f"Ingest job is already running: {job_id}"}
+    return {"job_id": job_id, "resumed": True}
+
+@app.delete("/image/{image_hash}", summary="Remove an image and its embedding")
+async def delete_image(image_hash: str):
+    try:
+        if not await in_index_thread(delete_embedding, image_hash):
+            return {"error": f"Image hash not found in database: {image_hash}"}
+        return {"deleted": image_hash}
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return {"error": f"An error occurred: {str(e)}"}
+
 @app.get("/debug", summary="Display model and embedding information")
 async def debug_info():
     embedding_size = index.d if index else None
@@ -442,7 +480,15 @@ async def debug_info():
         "device": DEVICE,
         "torch_dtype": str(TORCH_TYPE),
         "embedding_size": embedding_size,
-        "faiss_index_size": index.ntotal if index else 0
+        "faiss_index_size": index.ntotal if index else 0,
+        "faiss_index": describe_index(index) if index else None,
+        "embedding_format": EMBEDDING_FORMAT,
+        "rerank_factor": RERANK_FACTOR,
+        "checkpointer": checkpointer.stats(),
+        "backend": backend.name,
+        "caption_batcher": caption_batcher.stats(),
+        "text_batcher": text_batcher.stats(),
+        "text_embedding_cache": text_embedding_cache.stats(),
     }
     return model_info
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# tiny_cogvlm.py
+#
+# A tiny randomly initialized stand-in for CogVLM2, for check_embedding_paths.py
+# --stub. It has the parts of the model CogVLM2Backend touches:
+# build_conversation_input_ids, a forward that returns hidden_states, model.norm
+# as the final decoder norm, and a generate() that prefills the whole prompt
+# once and then decodes one token per call against a cache, the way the real
+# model runs with its KV cache. That is enough to check on the CPU that the
+# prefill hook captures the prompt pass and pools it like the two-pass path.
+
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch import nn
+
+VOCAB = 256
+HIDDEN = 64
+EOS_ID, PAD_ID = 0, 1
+# Each image becomes a few prompt tokens, so images give different prompts of different lengths
+MIN_IMAGE_TOKENS, MAX_IMAGE_TOKENS = 4, 12
+MAX_NEW_TOKENS = 16
+
+
+class TinyTokenizer:
+    eos_token_id = EOS_ID
+    pad_token_id = PAD_ID
+    eos_token = '<eos>'
+
+    def encode(self, text):
+        return [2 + ord(c) % (VOCAB - 2) for c in text]
+
+    def decode(self, ids):
+        return ' '.join(self.eos_token if int(i) == EOS_ID else f'w{int(i)}' for i in ids)
+
+
+class TinyDecoder(nn.Module):
+    """Token embeddings, a causal running mean over the attended tokens, an MLP and the final norm."""
+
+    def __init__(self):
+        super().__init__()
+        self.embed_tokens = nn.Embedding(VOCAB, HIDDEN)
+        self.mlp = nn.Sequential(nn.Linear(2 * HIDDEN, HIDDEN), nn.Tanh(), nn.Linear(HIDDEN, HIDDEN))
+        self.norm = nn.LayerNorm(HIDDEN)
+
+    def forward(self, input_ids, attention_mask, cache=None):
+        """Hidden states for input_ids continuing from cache; returns (hidden, cache)."""
+        mask = attention_mask[:, -input_ids.shape[1]:].unsqueeze(-1).to(torch.float32)
+        x = self.embed_tokens(input_ids) * mask
+        if cache is None:
+            cache = (torch.zeros_like(x[:, 0]), torch.zeros_like(mask[:, 0]))
+        sums = cache[0].unsqueeze(1) + x.cumsum(dim=1)
+        counts = cache[1].unsqueeze(1) + mask.cumsum(dim=1)
+        context = sums / counts.clamp(min=1)
+        hidden = self.norm(self.mlp(torch.cat([x, context], dim=-1)))
+        return hidden, (sums[:, -1], counts[:, -1])
+
+
+class TinyCogVLM(nn.Module):
+    def __init__(self, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.model = TinyDecoder()
+        self.lm_head = nn.Linear(HIDDEN, VOCAB)
+        self.config = SimpleNamespace(hidden_size=HIDDEN)
+
+    def build_conversation_input_ids(self, tokenizer, query, history=None, images=None, template_version=None):
+        ids = tokenizer.encode(query)
+        pixels = None
+        if images:
+            pixels = np.asarray(images[0].convert('RGB').resize((8, 8)), dtype=np.uint8).ravel()
+            count = MIN_IMAGE_TOKENS + int(pixels.sum()) % (MAX_IMAGE_TOKENS - MIN_IMAGE_TOKENS + 1)
+            ids = [2 + int(p) % (VOCAB - 2) for p in pixels[:count]] + ids
+        input_ids = torch.tensor(ids, dtype=torch.long)
+        inputs = {
+            'input_ids': input_ids,
+            'token_type_ids': torch.zeros_like(input_ids),
+            'attention_mask': torch.ones_like(input_ids),
+        }
+        if pixels is not None:
+            inputs['images'] = [torch.from_numpy(pixels.astype(np.float32))]
+        return inputs
+
+    def forward(self, input_ids, attention_mask, output_hidden_states=False, **kwargs):
+        hidden, _ = self.model(input_ids, attention_mask)
+        return SimpleNamespace(logits=self.lm_head(hidden), hidden_states=(hidden,) if output_hidden_states else None)
+
+    def generate(self, input_ids, attention_mask, max_new_tokens=MAX_NEW_TOKENS, **kwargs):
+        # Greedy; one prefill call, then one single-token call per new token
+        hidden, cache = self.model(input_ids, attention_mask)
+        output = input_ids
+        for _ in range(min(max_new_tokens, MAX_NEW_TOKENS)):
+            next_ids = self.lm_head(hidden[:, -1]).argmax(dim=-1, keepdim=True)
+            output = torch.cat([output, next_ids], dim=1)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_ids)], dim=1)
+            hidden, cache = self.model(next_ids, attention_mask, cache)
+        return output
+
+
+def tiny_backend(embedding_mode="prefill"):
+    """CogVLM2Backend around TinyCogVLM on the CPU in float32, skipping the real model load."""
+    from model_backend import CogVLM2Backend
+
+    backend = CogVLM2Backend.__new__(CogVLM2Backend)
+    backend.torch = torch
+    backend.name = backend.version = "tiny"
+    backend.embedding_mode = embedding_mode
+    backend.device = 'cpu'
+    backend.torch_dtype = torch.float32
+    backend.tokenizer = TinyTokenizer()
+    backend.model = TinyCogVLM().eval()
+    backend.embedding_size = backend.model.config.hidden_size
+    return backend
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# cooccurrence_weights.py
+#
+# Fast path for data/tag_pairs_with_weights.json that doesn't need the LLM.
+# Builds a sparse items x tags matrix of relevance scores from the tagged
+# captions and scores every pair in data/tag_pairs.json from co-occurrence in
+# one batch of sparse products:
+#
+#   npmi     normalized pointwise mutual information of the two tags, clipped to 0-1
+#   jaccard  items with both tags / items with either
+#   cosine   cosine similarity of the two tags' relevance columns
+#   mean     average of the three
+#
+# Pairs where the three measures disagree most are the ones co-occurrence
+# says least about. --refine N leaves the N most uncertain of them out of the
+# output and writes them to data/tag_pairs_uncertain.json, for the LLM to
+# weigh with `python assign_weights.py --tag-pairs data/tag_pairs_uncertain.json`.
+#
+# Weights already in the output file, e.g. from the LLM, are kept and only the
+# pairs without one are scored; --overwrite rescores every pair.
+#
+# Usage: python cooccurrence_weights.py [--metric cosine] [--refine 0] [--overwrite]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from weight_queue import has_weight
+
+TAGGED_PATH = os.path.join('data', 'images_captioned_tagged.json')
+TAG_PAIRS_PATH = os.path.join('data', 'tag_pairs.json')
+WEIGHTS_OUTPUT_PATH = os.path.join('data', 'tag_pairs_with_weights.json')
+UNCERTAIN_PAIRS_PATH = os.path.join('data', 'tag_pairs_uncertain.json')
+METRICS = ['npmi', 'jaccard', 'cosine', 'mean']
+
+
+def load_relevance_matrix(tagged_path, tags):
+    """CSR matrix of relevance scores, one row per tagged item and one column per tag in tags."""
+    column = {tag: i for i, tag in enumerate(tags)}
+    with open(tagged_path, 'r') as f:
+        data = json.load(f)
+    rows, cols, values = [], [], []
+    row = 0
+    for item in data.values():
+        if not item.get('tags'):
+            continue
+        for tag, score in item['tags'].items():
+            if tag in column and score > 0:
+                rows.append(row)
+                cols.append(column[tag])
+                values.append(score)
+        row += 1
+    # Duplicate entries can't occur (tags is a dict), so no summing happens here
+    return sp.csr_matrix((np.asarray(values, dtype=np.float64), (rows, cols)), shape=(row, len(tags)))
+
+
+def pair_weights(relevance):
+    """Scores every co-occurring pair of columns. Returns (rows, cols, {metric: weights}, uncertainty),
+    all arrays over the pairs i < j that share at least one item."""
+    presence = relevance.copy()
+    presence.data[:] = 1.0
+    n_items = relevance.shape[0]
+    tag_counts = np.asarray(presence.sum(axis=0)).ravel()
+    norms = np.sqrt(np.asarray(relevance.multiply(relevance).sum(axis=0)).ravel())
+
+    both = sp.triu(presence.T @ presence, k=1).tocoo()
+    dot = (relevance.T @ relevance).tocsr()
+    rows, cols, both_counts = both.row, both.col, both.data
+    dots = np.asarray(dot[rows, cols]).ravel()
+
+    p_both = both_counts / n_items
+    pmi = np.log(p_both / ((tag_counts[rows] / n_items) * (tag_counts[cols] / n_items)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Two tags on every item have p_both == 1 and an undefined NPMI; they always co-occur
+        npmi = np.where(p_both < 1.0, pmi / -np.log(p_both), 1.0)
+    weights = {
+        'npmi': np.clip(npmi, 0.0, 1.0),
+        'jaccard': both_counts / (tag_counts[rows] + tag_counts[cols] - both_counts),
+        'cosine': dots / (norms[rows] * norms[cols]),
+    }
+    stacked = np.vstack([weights['npmi'], weights['jaccard'], weights['cosine']])
+    weights['mean'] = stacked.mean(axis=0)
+    uncertainty = stacked.max(axis=0) - stacked.min(axis=0)
+    return rows, cols, weights, uncertainty
+
+
+def tags_in(tag_pairs):
+    return sorted({tag for tag1, pairs in tag_pairs.items() for tag in [tag1, *pairs]})
+
+
+def main(args):
+    for path in (args.tagged, args.tag_pairs):
+        if not os.path.exists(path):
+            print(f"Error: {path} not found.")
+            sys.exit(1)
+    with open(args.tag_pairs, 'r') as f:
+        requested_pairs = json.load(f)
+    weighted = {}
+    if os.path.exists(args.output) and not args.overwrite:
+        with open(args.output, 'r') as f:
+            weighted = json.load(f)
+    tag_pairs = {}
+    for tag1, pairs in requested_pairs.items():
+        missing = [tag2 for tag2 in pairs if not has_weight(tag1, tag2, weighted)]
+        if missing:
+            tag_pairs[tag1] = missing
+    kept = sum(len(pairs) for pairs in requested_pairs.values()) - sum(len(pairs) for pairs in tag_pairs.values())
+    if kept:
+        print(f"Keeping {kept} pairs already weighted in {args.output}.")
+    if not tag_pairs:
+        print("Every pair already has a weight; nothing to do.")
+        return
+    tags = tags_in(tag_pairs)
+    index = {tag: i for i, tag in enumerate(tags)}
+
+    start = time.perf_counter()
+    relevance = load_relevance_matrix(args.tagged, tags)
+    loaded = time.perf_counter()
+    rows, cols, weights, uncertainty = pair_weights(relevance)
+    computed = time.perf_counter()
+    print(f"{relevance.shape[0]} tagged items, {len(tags)} tags, {len(rows)} co-occurring pairs; "
+          f"loaded in {loaded - start:.2f}s, weighted in {computed - loaded:.2f}s")
+
+    scored = dict(zip(zip(rows.tolist(), cols.tolist()), zip(np.round(weights[args.metric], 3).tolist(),
+                                                            uncertainty.tolist())))
+    uncertain = set()
+    if args.refine:
+        # Only pairs that co-occur can be uncertain; the rest have no evidence either way and stay at 0.
+        # Rank just the requested pairs, since a sparse pair file asks for a fraction of the co-occurring ones
+        requested = {tuple(sorted((index[tag1], index[tag2]))) for tag1, pairs in tag_pairs.items() for tag2 in pairs}
+        candidates = np.array([k for k, pair in enumerate(zip(rows.tolist(), cols.tolist())) if pair in requested],
+                              dtype=np.int64)
+        order = candidates[np.argsort(-uncertainty[candidates], kind='stable')[:args.refine]]
+        uncertain = {(tags[rows[k]], tags[cols[k]]) for k in order.tolist()}
+
+    to_refine = {}
+    count = 0
+    for tag1, pairs in tag_pairs.items():
+        for tag2 in pairs:
+            i, j = sorted((index[tag1], index[tag2]))
+            if (tags[i], tags[j]) in uncertain:
+                to_refine.setdefault(tag1, {})[tag2] = None
+            else:
+                weighted.setdefault(tag1, {})[tag2] = scored.get((i, j), (0.0, 0.0))[0]
+                count += 1
+
+    tmp_path = args.output + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(weighted, f, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"Wrote {args.metric} weights for {count} pairs to {args.output} in {time.perf_counter() - start:.2f}s total")
+    if args.refine:
+        with open(UNCERTAIN_PAIRS_PATH, 'w') as f:
+            json.dump(to_refine, f, indent=2)
+        print(f"Wrote the {sum(len(pairs) for pairs in to_refine.values())} most uncertain pairs to {UNCERTAIN_PAIRS_PATH}; "
+              f"weigh them with: python assign_weights.py --tag-pairs {UNCERTAIN_PAIRS_PATH}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Weigh tag pairs from co-occurrence in the tagged captions")
+    parser.add_argument('--metric', choices=METRICS, default='cosine')
+    parser.add_argument('--refine', type=int, default=0,
+                        help="Leave the N pairs the measures disagree on most for assign_weights.py")
+    parser.add_argument('--tagged', default=TAGGED_PATH)
+    parser.add_argument('--tag-pairs', default=TAG_PAIRS_PATH)
+    parser.add_argument('--output', default=WEIGHTS_OUTPUT_PATH)
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Rescore every pair, replacing weights already in the output (including the LLM's)")
+    main(parser.parse_args())
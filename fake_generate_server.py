@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# fake_generate_server.py
+#
+# Stand-in for a KoboldCpp /api/v1/generate server, for exercising the tagging
+# and weighting scripts without a GPU. Each request sleeps for --latency-ms in
+# one of --slots parallel slots (extra requests queue, like a real server), and
+# a fraction --error-rate of requests are answered with 503 to exercise retries.
+# With --max-queue, requests arriving while that many are already waiting for a
+# slot are turned away with 503, like a server whose queue is full.
+# Packed tagging prompts get one result per caption id, with a fraction
+# --drop-rate of them left out to exercise the single-item fallback.
+# A fraction --malformed-rate of tagging responses are broken the ways real
+# models break them (cut off, wrapped in prose, score out of range), unless the
+# request carries a "grammar", which a real server would enforce.
+# /api/extra/tokencount counts whitespace-separated words.
+#
+# Each slot remembers the tokens of its last prompt, like llama.cpp's per-slot
+# KV cache; a request takes the free slot sharing the longest prefix with it.
+# GET /stats reports how many prompt tokens were served from those prefixes.
+#
+# Usage: python fake_generate_server.py [--port 5001] [--latency-ms 200] [--slots 4] [--error-rate 0] [--drop-rate 0]
+#                                      [--malformed-rate 0] [--max-queue N]
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_TAGS = ["Politics", "Social Issues", "Graph", "USA", "Controversy"]
+TOKEN_PATTERN = re.compile(r'\s+|\w+|[^\w\s]')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text)
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """Slots that each keep their last prompt; counts prompt tokens reused from a cached prefix."""
+
+    def __init__(self, slots):
+        self.cached = [[] for _ in range(slots)]
+        self.free = list(range(slots))
+        self.condition = threading.Condition()
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+
+    def acquire(self, tokens):
+        with self.condition:
+            while not self.free:
+                self.condition.wait()
+            slot = max(self.free, key=lambda s: common_prefix_length(self.cached[s], tokens))
+            self.free.remove(slot)
+            self.prompt_tokens += len(tokens)
+            self.reused_tokens += common_prefix_length(self.cached[slot], tokens)
+            self.cached[slot] = tokens
+            return slot
+
+    def release(self, slot):
+        with self.condition:
+            self.free.append(slot)
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "prompt_tokens": self.prompt_tokens,
+                "reused_prefix_tokens": self.reused_tokens,
+                "reuse_ratio": self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            }
+
+
+def fake_tags(caption):
+    # Vary the tags with the caption so results are distinguishable
+    rng = random.Random(caption)
+    tags = [{"tag_name": tag, "relevance_score": round(rng.random(), 1)} for tag in FAKE_TAGS]
+    return {"tags": tags, "spicy": {"spicy": round(rng.random(), 1)}}
+
+
+def fake_tagging_response(prompt):
+    return json.dumps(fake_tags(prompt.rsplit('caption:', 1)[-1]))
+
+
+def fake_packed_response(prompt, drop_rate):
+    captions = re.findall(r'^(\w+): (".*")$', prompt.rsplit('captions:', 1)[-1], re.MULTILINE)
+    return json.dumps({caption_id: fake_tags(caption) for caption_id, caption in captions
+                       if random.random() >= drop_rate}, indent=2)
+
+
+def malform(text):
+    damage = random.choice(['truncate', 'prose', 'range'])
+    if damage == 'truncate':
+        return text[:len(text) // 2]
+    if damage == 'prose':
+        return f"Sure! Here is the JSON for the caption:\n{text}\nLet me know if you need anything else."
+    return re.sub(r'("spicy": )[0-9.]+', r'\g<1>1.5', text, count=1)
+
+
+def fake_weights_response(prompt):
+    pairs = re.findall(r'\{"tag1": ?"([^"]*)", ?"tag2": ?"([^"]*)"\}', prompt.rsplit('Here are the tag pairs:', 1)[-1])
+    rng = random.Random(prompt)
+    return json.dumps([{"tag1": a, "tag2": b, "weight": round(rng.random(), 2)} for a, b in pairs]) + "\n### END"
+
+
+class FakeGenerateHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.2
+    error_rate = 0.0
+    drop_rate = 0.0
+    malformed_rate = 0.0
+    max_queue = None
+    slots = PrefixCache(4)
+    stats_lock = threading.Lock()
+    stats = {"requests": 0, "errors": 0, "busy": 0, "active": 0}
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.stats_lock:
+                self.send_json(200, {**self.stats, **self.slots.stats()})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/api/extra/tokencount':
+            self.send_json(200, {"value": len(body.get("prompt", "").split())})
+            return
+        if self.path != '/api/v1/generate':
+            self.send_json(404, {"error": "not found"})
+            return
+        with self.stats_lock:
+            self.stats["requests"] += 1
+            failed = random.random() < self.error_rate
+            busy = (not failed and self.max_queue is not None
+                    and self.stats["active"] - len(self.slots.cached) >= self.max_queue)
+            if failed:
+                self.stats["errors"] += 1
+            elif busy:
+                self.stats["busy"] += 1
+            else:
+                self.stats["active"] += 1
+        if failed or busy:
+            self.send_json(503, {"error": "server busy"})
+            return
+        prompt = body.get("prompt", "")
+        try:
+            slot = self.slots.acquire(tokenize(prompt))
+            try:
+                time.sleep(self.latency)
+            finally:
+                self.slots.release(slot)
+        finally:
+            with self.stats_lock:
+                self.stats["active"] -= 1
+        if 'tag pairs' in prompt:
+            text = fake_weights_response(prompt)
+        elif 'captions:' in prompt:
+            text = fake_packed_response(prompt, self.drop_rate)
+        else:
+            text = fake_tagging_response(prompt)
+        if 'tag pairs' not in prompt and "grammar" not in body and random.random() < self.malformed_rate:
+            text = malform(text)
+        self.send_json(200, {"results": [{"text": text}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, latency_ms=200, slots=4, error_rate=0.0, drop_rate=0.0, malformed_rate=0.0, max_queue=None):
+    """Starts the fake server on a background thread; returns (server, "host:port")."""
+    handler = type('ConfiguredFakeGenerateHandler', (FakeGenerateHandler,), {
+        "latency": latency_ms / 1000.0,
+        "error_rate": error_rate,
+        "drop_rate": drop_rate,
+        "malformed_rate": malformed_rate,
+        "max_queue": max_queue,
+        "slots": PrefixCache(slots),
+        "stats_lock": threading.Lock(),
+        "stats": {"requests": 0, "errors": 0, "busy": 0, "active": 0},
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'127.0.0.1:{server.server_port}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake KoboldCpp generate server")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--slots', type=int, default=4)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--max-queue', type=int, default=None)
+    args = parser.parse_args()
+    server, address = start_server(args.port, args.latency_ms, args.slots, args.error_rate, args.drop_rate,
+                                   args.malformed_rate, args.max_queue)
+    print(f"Fake generate server listening on {address}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,30 +1,116 @@
 #!/usr/bin/env python3
+import argparse
 import json
-import itertools
+import math
+import time
 
 # Configurable minimum number of entries for tags to be included
 minEntries = 10
 
-# Load tags_with_sizes.json
-with open('data/tags_with_sizes.json', 'r') as f:
-    tags_with_sizes = json.load(f)
+tags_with_sizes_path = 'data/tags_with_sizes.json'
+tag_pairs_path = 'data/tag_pairs.json'
 
-# Filter tags with more than minEntries items
-filtered_tags = [tag for tag, data in tags_with_sizes.items() if len(data['itemIds']) >= minEntries]
+# Inverted index: one int per tag with bit i set when the tag is on item i, so
+# the items two tags share are one AND and a popcount
+def item_bitsets(tags_with_sizes, tags):
+    bit_for_item = {}
+    for tag in tags:
+        for item_id in tags_with_sizes[tag]['itemIds']:
+            bit_for_item.setdefault(item_id, len(bit_for_item))
+    n_bytes = (len(bit_for_item) + 7) // 8
+    bitsets = []
+    for tag in tags:
+        # Set bits in a bytearray and convert once; OR-ing into an int copies it per item
+        buffer = bytearray(n_bytes)
+        for item_id in tags_with_sizes[tag]['itemIds']:
+            bit = bit_for_item[item_id]
+            buffer[bit >> 3] |= 1 << (bit & 7)
+        bitsets.append(int.from_bytes(buffer, 'little'))
+    return bitsets, len(bit_for_item)
 
-# Generate all possible combinations of tag pairs
-# We'll use a dictionary to store the pairs in the format { 'tag1': { 'tag2': weight } }
-tag_pairs = {}
+def jaccard(both, count1, count2, n_items):
+    return both / (count1 + count2 - both)
 
-for tag1, tag2 in itertools.combinations(filtered_tags, 2):
-    # Initialize the nested dictionary if not already present
-    if tag1 not in tag_pairs:
-        tag_pairs[tag1] = {}
-    # Do not add the reverse (tag2 -> tag1) as it's already covered
-    tag_pairs[tag1][tag2] = None  # No weight assigned yet
+def npmi(both, count1, count2, n_items):
+    if both == n_items:
+        return 1.0
+    return math.log(both * n_items / (count1 * count2)) / -math.log(both / n_items)
 
-# Save the tag pairs to a JSON file
-with open('data/tag_pairs.json', 'w') as f:
-    json.dump(tag_pairs, f, indent=2)
+SCORES = {'jaccard': jaccard, 'npmi': npmi}
 
-print(f"Total unique tag pairs generated: {len(tag_pairs)}")
+# Yields (tag1, [tag2, ...]) for each tag with at least one partner. With no
+# threshold every combination is a pair, as before; otherwise only pairs that
+# share min_cooccurrence items and score at least min_score
+def sparse_pairs(tags_with_sizes, tags, min_cooccurrence=None, min_score=None, score='jaccard'):
+    if min_cooccurrence is None and min_score is None:
+        for i, tag1 in enumerate(tags):
+            if tags[i + 1:]:
+                yield tag1, tags[i + 1:]
+        return
+
+    bitsets, n_items = item_bitsets(tags_with_sizes, tags)
+    counts = [bits.bit_count() for bits in bitsets]
+    min_both = max(1, min_cooccurrence or 1)
+    score_fn = SCORES[score]
+    for i, tag1 in enumerate(tags):
+        if counts[i] < min_both:
+            continue
+        bits1 = bitsets[i]
+        partners = []
+        for j in range(i + 1, len(tags)):
+            if counts[j] < min_both:
+                continue
+            both = (bits1 & bitsets[j]).bit_count()
+            if both < min_both:
+                continue
+            if min_score is not None and score_fn(both, counts[i], counts[j], n_items) < min_score:
+                continue
+            partners.append(tags[j])
+        if partners:
+            yield tag1, partners
+
+# Writes the pairs in the same layout as json.dump(..., indent=2), one tag at a
+# time, so the whole nested dict is never held in memory
+def write_pairs(path, pairs):
+    count = 0
+    first = True
+    with open(path, 'w') as f:
+        f.write('{')
+        for tag1, partners in pairs:
+            body = ',\n'.join(f'    {json.dumps(tag2)}: null' for tag2 in partners)
+            f.write(f'{"" if first else ","}\n  {json.dumps(tag1)}: {{\n{body}\n  }}')
+            first = False
+            count += len(partners)
+        f.write('}' if first else '\n}')
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the tag pairs for weighting")
+    parser.add_argument('--min-entries', type=int, default=minEntries,
+                        help="Leave out tags on fewer items than this")
+    parser.add_argument('--min-cooccurrence', type=int, default=None,
+                        help="Only pair tags that share at least this many items")
+    parser.add_argument('--min-score', type=float, default=None,
+                        help="Only pair tags whose co-occurrence score is at least this")
+    parser.add_argument('--score', choices=sorted(SCORES), default='jaccard')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    # Load tags_with_sizes.json
+    with open(tags_with_sizes_path, 'r') as f:
+        tags_with_sizes = json.load(f)
+
+    # Filter tags with more than minEntries items
+    filtered_tags = [tag for tag, data in tags_with_sizes.items() if len(data['itemIds']) >= args.min_entries]
+
+    # Save the pairs in the format { 'tag1': { 'tag2': null } }; the reverse (tag2 -> tag1) is
+    # not added as it's already covered
+    pairs = sparse_pairs(tags_with_sizes, filtered_tags, args.min_cooccurrence, args.min_score, args.score)
+    count = write_pairs(tag_pairs_path, pairs)
+
+    possible = len(filtered_tags) * (len(filtered_tags) - 1) // 2
+    print(f"Total unique tag pairs generated: {count} of {possible} possible among {len(filtered_tags)} tags "
+          f"in {time.perf_counter() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
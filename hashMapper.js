@@ -9,6 +9,8 @@ class HashMapper {
         this.cacheFile = options.cacheFile || 'hash_path_cache.json';
         this.validExtensions = options.validExtensions || ['.jpg', '.jpeg', '.png', '.gif'];
         this.cache = new Map();
+        // path -> { size, mtimeNs, ino, hash }; unchanged files are not rehashed on rescan
+        this.fileStats = new Map();
         this.lastUpdate = 0;
         this.updateInterval = options.updateInterval || 24 * 60 * 60 * 1000; // 24 hours
         this.isUpdating = false;
@@ -32,6 +34,7 @@ class HashMapper {
             const data = await fs.readFile(this.cacheFile, 'utf-8');
             const cacheData = JSON.parse(data);
             this.cache = new Map(Object.entries(cacheData.mappings));
+            this.fileStats = new Map(Object.entries(cacheData.fileStats || {}));
             this.lastUpdate = cacheData.lastUpdate;
         } catch (error) {
             if (error.code !== 'ENOENT') {
@@ -39,6 +42,7 @@ class HashMapper {
             }
             // If file doesn't exist or other error, initialize empty cache
             this.cache = new Map();
+            this.fileStats = new Map();
             this.lastUpdate = 0;
         }
     }
@@ -46,7 +50,8 @@ class HashMapper {
     async saveCache() {
         const cacheData = {
             lastUpdate: this.lastUpdate,
-            mappings: Object.fromEntries(this.cache)
+            mappings: Object.fromEntries(this.cache),
+            fileStats: Object.fromEntries(this.fileStats)
         };
         await fs.writeFile(this.cacheFile, JSON.stringify(cacheData, null, 2));
     }
@@ -60,11 +65,28 @@ class HashMapper {
         return crypto.createHash('sha256').update(fileBuffer).digest('hex');
     }
 
-    async processFile(filePath) {
+    async processFile(filePath, newStats) {
         try {
-            const hash = await this.calculateFileHash(filePath);
+            const stat = await fs.stat(filePath, { bigint: true });
+            const key = {
+                size: stat.size.toString(),
+                mtimeNs: stat.mtimeNs.toString(),
+                ino: stat.ino.toString()
+            };
+            const previous = this.fileStats.get(filePath);
+            let hash;
+            let hashed = false;
+            if (previous && previous.size === key.size && previous.mtimeNs === key.mtimeNs && previous.ino === key.ino) {
+                hash = previous.hash;
+            } else {
+                hash = await this.calculateFileHash(filePath);
+                hashed = true;
+            }
+            if (newStats) {
+                newStats.set(filePath, { ...key, hash });
+            }
             this.cache.set(hash, filePath);
-            return { hash, path: filePath };
+            return { hash, path: filePath, hashed };
         } catch (error) {
             console.error(`Error processing file ${filePath}:`, error);
             return null;
@@ -90,21 +112,28 @@ class HashMapper {
 
         this.isUpdating = true;
         const newCache = new Map();
+        const newStats = new Map();
         const startTime = Date.now();
+        let hashedCount = 0;
 
         try {
             for (const basePath of this.basePaths) {
                 for await (const filePath of this.walkDirectory(basePath)) {
-                    const result = await this.processFile(filePath);
+                    const result = await this.processFile(filePath, newStats);
                     if (result) {
                         newCache.set(result.hash, result.path);
-                        console.log(`Processed file: ${result.path}`);
+                        if (result.hashed) {
+                            hashedCount++;
+                            console.log(`Processed file: ${result.path}`);
+                        }
                     }
                 }
             }
 
             this.cache = newCache;
+            this.fileStats = newStats;
             this.lastUpdate = startTime;
+            console.log(`Hash cache updated: ${newStats.size} files, ${hashedCount} hashed in ${Date.now() - startTime} ms`);
             await this.saveCache();
         } catch (error) {
             console.error('Error updating cache:', error);
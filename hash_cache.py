@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# hash_cache.py
+#
+# Persistent (path, size, mtime_ns, inode) -> sha256 cache shared by the
+# captioner and the thumbnail tool. A file whose stat tuple is unchanged since
+# it was last hashed is not read again, so rescanning a large tree only costs
+# one stat() per file. The cache also answers hash -> path lookups.
+#
+# Usage: python hash_cache.py <directory> [--db file_hashes.db]   (warms the cache)
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+HASH_CACHE_PATH = 'file_hashes.db'
+HASH_READ_SIZE = 1024 * 1024
+# Misses are written in batches; call flush() when a scan is done
+FLUSH_SIZE = 500
+
+
+def sha256_file(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+class HashCache:
+    def __init__(self, path=HASH_CACHE_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = []
+        # Every thread's connection, so close() can close them all
+        self.connections = []
+        self.hits = 0
+        self.misses = 0
+        conn = self.connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS file_hashes_hash ON file_hashes (hash)')
+        conn.commit()
+
+    def connection(self):
+        # One connection per thread, as hashing runs on thread pools
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only its own thread uses it; check_same_thread=False lets close() close it from another
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def lookup(self, path, st=None):
+        """Cached hash for path if its size, mtime and inode still match, else None."""
+        st = st or os.stat(path)
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT size, mtime_ns, inode, hash FROM file_hashes WHERE path=?', (path,))
+        row = cursor.fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return row[3]
+        return None
+
+    def record(self, path, st, hash_value):
+        with self.lock:
+            self.pending.append((path, st.st_size, st.st_mtime_ns, st.st_ino, hash_value))
+            if len(self.pending) < FLUSH_SIZE:
+                return
+            rows, self.pending = self.pending, []
+        self._write(rows)
+
+    def flush(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows):
+        conn = self.connection()
+        conn.executemany('INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)',
+                         rows)
+        conn.commit()
+
+    def hash_file(self, path, hasher=sha256_file):
+        """SHA-256 of path, reading the file only if its stat tuple changed."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        hash_value = self.lookup(path, st)
+        # Hash pools call this from many threads; += on a shared attribute isn't atomic
+        with self.lock:
+            if hash_value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hash_value is not None:
+            return hash_value
+        hash_value = hasher(path)
+        self.record(path, st, hash_value)
+        return hash_value
+
+    def path_for_hash(self, hash_value):
+        """A path last seen with this content that still exists, or None."""
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT path FROM file_hashes WHERE hash=?', (hash_value,))
+        for (path,) in cursor.fetchall():
+            if os.path.exists(path):
+                return path
+        return None
+
+    def paths_by_hash(self):
+        """Every hash -> [paths seen with that content], in one query, for bulk lookups."""
+        self.flush()
+        paths = {}
+        for hash_value, path in self.connection().execute('SELECT hash, path FROM file_hashes'):
+            paths.setdefault(hash_value, []).append(path)
+        return paths
+
+    def close(self):
+        """Flushes and closes every thread's connection; call once the hashing threads are done."""
+        self.flush()
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Hash every image under a directory into the hash cache")
+    parser.add_argument("directory")
+    parser.add_argument("--db", default=HASH_CACHE_PATH)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"Error: {args.directory} is not a directory.")
+        sys.exit(1)
+
+    cache = HashCache(args.db)
+    start = time.perf_counter()
+    for root, _, files in os.walk(args.directory):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in {'.jpg', '.jpeg', '.png', '.gif'}:
+                try:
+                    cache.hash_file(os.path.join(root, file))
+                except OSError as e:
+                    print(f"Error hashing {file}: {e}")
+    cache.close()
+    print(f"Scanned {cache.hits + cache.misses} files in {time.perf_counter() - start:.1f}s "
+          f"({cache.hits} unchanged, {cache.misses} hashed).")
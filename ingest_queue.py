@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# ingest_queue.py
+#
+# Pending queue for auto_caption_on_filesystem_changes.py, in SQLite so files
+# seen but not yet captioned survive a restart. Each file is keyed by path with
+# the size and mtime it had when it settled; adding it again with the same
+# stat is a no-op, so the startup reconciliation scan can offer every file in
+# the tree and only new or changed ones are queued.
+#
+# Files are claimed in batches for one captioning pass. A failed file is
+# retried after a growing delay and given up on after max_attempts; a batch
+# still claimed when the daemon stopped goes back to pending on the next start.
+#
+# Usage: python ingest_queue.py {status,retry} [--db ingest_queue.db]
+
+import os
+import sqlite3
+import threading
+import time
+
+INGEST_QUEUE_PATH = 'ingest_queue.db'
+
+PENDING, CLAIMED, DONE, GIVEN_UP = 0, 1, 2, 3
+
+
+class IngestQueue:
+    def __init__(self, path=INGEST_QUEUE_PATH):
+        self.path = path
+        # Shared by the settle, reconcile and captioning threads; every statement is short
+        self.lock = threading.Lock()
+        # isolation_level=None: transactions are explicit, so a claim is one BEGIN IMMEDIATE ... COMMIT
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                detected_at REAL,
+                queued_at REAL,
+                not_before REAL NOT NULL DEFAULT 0,
+                done_at REAL,
+                outcome TEXT
+            ) WITHOUT ROWID
+        ''')
+        # Claims take the oldest pending files first
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_status ON files (status, queued_at)')
+
+    def _transaction(self, statements):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements()
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def add(self, files):
+        """Queues [(path, size, mtime_ns, detected_at), ...]. A path already known with the
+        same size and mtime is left as it is. Returns the number of files queued."""
+        now = time.time()
+
+        def insert():
+            before = self.conn.total_changes
+            self.conn.executemany('''
+                INSERT INTO files (path, size, mtime_ns, status, detected_at, queued_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size=excluded.size, mtime_ns=excluded.mtime_ns, status=excluded.status, attempts=0,
+                    detected_at=excluded.detected_at, queued_at=excluded.queued_at, not_before=0,
+                    done_at=NULL, outcome=NULL
+                WHERE files.size != excluded.size OR files.mtime_ns != excluded.mtime_ns
+            ''', ((path, size, mtime_ns, PENDING, detected_at, now) for path, size, mtime_ns, detected_at in files))
+            return self.conn.total_changes - before
+
+        return self._transaction(insert)
+
+    def release_claimed(self, paths=None):
+        """Puts batches claimed by a daemon that stopped mid-pass back in the queue,
+        or just the given paths after a pass that failed as a whole."""
+        with self.lock:
+            if paths is None:
+                return self.conn.execute('UPDATE files SET status=? WHERE status=?', (PENDING, CLAIMED)).rowcount
+            before = self.conn.total_changes
+            self.conn.executemany('UPDATE files SET status=? WHERE path=? AND status=?',
+                                  ((PENDING, path, CLAIMED) for path in paths))
+            return self.conn.total_changes - before
+
+    def retry_given_up(self):
+        with self.lock:
+            return self.conn.execute('UPDATE files SET status=?, attempts=0, not_before=0 WHERE status=?',
+                                     (PENDING, GIVEN_UP)).rowcount
+
+    def claim(self, size):
+        """Claims up to size pending files that are due, oldest first. Returns their paths."""
+        now = time.time()
+
+        def select():
+            paths = [row[0] for row in self.conn.execute(
+                'SELECT path FROM files WHERE status=? AND not_before <= ? ORDER BY queued_at LIMIT ?',
+                (PENDING, now, size))]
+            self.conn.executemany('UPDATE files SET status=? WHERE path=?', ((CLAIMED, path) for path in paths))
+            return paths
+
+        return self._transaction(select)
+
+    def complete(self, outcomes, max_attempts, retry_delay):
+        """Records [(path, outcome), ...] for a claimed batch, outcome being one of run_pipeline's
+        'captioned', 'seen' or 'failed'. Failed files are retried after retry_delay, doubling each
+        attempt, and given up on after max_attempts. A file changed since it was claimed has been
+        queued again and is left pending."""
+        now = time.time()
+
+        def update():
+            for path, outcome in outcomes:
+                if outcome == 'failed':
+                    self.conn.execute('''
+                        UPDATE files SET attempts=attempts + 1, outcome=?,
+                            status=CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END,
+                            not_before=? + ? * (1 << attempts)
+                        WHERE path=? AND status=?
+                    ''', (outcome, max_attempts, GIVEN_UP, PENDING, now, retry_delay, path, CLAIMED))
+                else:
+                    self.conn.execute('UPDATE files SET status=?, outcome=?, done_at=? WHERE path=? AND status=?',
+                                      (DONE, outcome, now, path, CLAIMED))
+
+        self._transaction(update)
+
+    def remove(self, paths):
+        """Forgets files deleted before they could be captioned."""
+        with self.lock:
+            self.conn.executemany('DELETE FROM files WHERE path=?', ((path,) for path in paths))
+
+    def next_due(self):
+        """Seconds until the next pending file is due, 0 if one is due now, None if none is pending."""
+        with self.lock:
+            row = self.conn.execute('SELECT MIN(not_before) FROM files WHERE status=?', (PENDING,)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def counts(self):
+        names = {PENDING: 'pending', CLAIMED: 'claimed', DONE: 'done', GIVEN_UP: 'given_up'}
+        counts = dict.fromkeys(names.values(), 0)
+        with self.lock:
+            for status, count in self.conn.execute('SELECT status, COUNT(*) FROM files GROUP BY status'):
+                counts[names[status]] = count
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Inspect the auto-captioning queue or retry the files it gave up on")
+    parser.add_argument("command", choices=["status", "retry"])
+    parser.add_argument("--db", default=INGEST_QUEUE_PATH)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Error: {args.db} does not exist.")
+        sys.exit(1)
+    queue = IngestQueue(args.db)
+    if args.command == "status":
+        print(queue.counts())
+    else:
+        print(f"Queued {queue.retry_given_up()} files again.")
+    queue.close()
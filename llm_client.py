@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# llm_client.py
+#
+# Async client for the KoboldCpp-style /api/v1/generate endpoint, shared by the
+# tagging and weighting scripts. Requests go over one aiohttp session and are
+# limited three ways: a concurrency cap (match the server's parallel slots), an
+# optional token-bucket rate limit, and retries with jittered exponential
+# backoff on 429/5xx and connection errors.
+#
+# With adaptive=True the concurrency cap is only a ceiling: the limit starts at
+# one request and moves AIMD-style, adding one after a full window of requests
+# that came back in time and halving on 429/503 or when latency climbs past
+# LATENCY_TOLERANCE times the fastest seen (requests queueing inside the server).
+
+import asyncio
+import random
+import time
+
+import aiohttp
+
+DEFAULT_SERVER = 'bestiary:5000'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503}
+# Latency above this multiple of the fastest response counts as overload
+LATENCY_TOLERANCE = 2.0
+
+
+def generate_url(server):
+    return f'http://{server}/api/v1/generate'
+
+
+def tokencount_url(server):
+    return f'http://{server}/api/extra/tokencount'
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimit:
+    """A concurrency limit between 1 and maximum that follows the server's capacity (AIMD)."""
+
+    def __init__(self, maximum, target_latency=None):
+        self.maximum = maximum
+        self.limit = 1.0
+        self.in_flight = 0
+        self.target_latency = target_latency
+        self.fastest = None
+        self.window = 0
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decrease(self, latency):
+        # Requests already in flight when the limit was cut report the same overload;
+        # only the first of them within one round trip counts
+        now = time.monotonic()
+        if now - self.last_decrease < latency:
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit / 2)
+        self.window = 0
+        self.decreases += 1
+
+    def on_success(self, latency):
+        self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+        target = self.target_latency or self.fastest * LATENCY_TOLERANCE
+        if latency > target:
+            self.decrease(latency)
+            return
+        self.window += 1
+        if self.window >= int(self.limit):
+            self.window = 0
+            # Waiters see the new slot when this request's __aexit__ notifies them
+            self.limit = min(float(self.maximum), self.limit + 1)
+
+    def on_overload(self, latency):
+        self.decrease(latency)
+
+
+class LLMClient:
+    """Use as `async with LLMClient(...) as client: text = await client.generate(payload)`."""
+
+    def __init__(self, server=DEFAULT_SERVER, concurrency=4, rate=None, burst=None,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0, timeout=600,
+                 adaptive=False, target_latency=None):
+        self.url = generate_url(server)
+        self.tokencount_url = tokencount_url(server)
+        self.concurrency = concurrency
+        self.adaptive = AdaptiveLimit(concurrency, target_latency) if adaptive else None
+        self.semaphore = self.adaptive or asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.latency_total = 0.0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        # Full jitter: spreads retries from many workers instead of syncing them up
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def generate(self, payload):
+        """Returns the generated text, or None once retries are exhausted or on a non-retryable error."""
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            retry_after = None
+            async with self.semaphore:
+                start = time.monotonic()
+                self.requests += 1
+                try:
+                    async with self.session.post(self.url, json=payload) as response:
+                        if response.status == 200:
+                            data = await response.json(content_type=None)
+                            latency = time.monotonic() - start
+                            self.latency_total += latency
+                            if self.adaptive:
+                                self.adaptive.on_success(latency)
+                            try:
+                                return data['results'][0]['text']
+                            except (KeyError, IndexError, TypeError):
+                                print(f"Error: LLM response has no generated text: {str(data)[:200]}")
+                                self.failures += 1
+                                return None
+                        if self.adaptive and response.status in OVERLOAD_STATUSES:
+                            self.adaptive.on_overload(time.monotonic() - start)
+                        if response.status not in RETRY_STATUSES:
+                            print(f"Error: LLM returned status code {response.status}")
+                            self.failures += 1
+                            return None
+                        header = response.headers.get('Retry-After')
+                        retry_after = float(header) if header and header.isdigit() else None
+                        error = f"status code {response.status}"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = repr(e)
+                except ValueError as e:
+                    # A 200 whose body isn't JSON (json() skips the content-type check); not worth retrying
+                    print(f"Error: LLM response is not JSON: {e}")
+                    self.failures += 1
+                    return None
+            if attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+        print(f"Error: giving up after {self.max_retries + 1} attempts ({error})")
+        self.failures += 1
+        return None
+
+    async def count_tokens(self, prompt):
+        """Prompt length in the server's tokenizer, or None if the server can't count."""
+        try:
+            async with self.session.post(self.tokencount_url, json={"prompt": prompt}) as response:
+                if response.status == 200:
+                    return (await response.json(content_type=None))['value']
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError):
+            pass
+        return None
+
+    def stats(self):
+        succeeded = self.requests - self.retries - self.failures
+        stats = {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "mean_latency": self.latency_total / succeeded if succeeded > 0 else 0.0,
+        }
+        if self.adaptive:
+            stats["concurrency_limit"] = int(self.adaptive.limit)
+            stats["limit_decreases"] = self.adaptive.decreases
+        return stats
@@ -1,58 +1,180 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python
+import argparse
 import json
 import os
-from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image, features
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 import requests
+from hash_cache import HashCache
 
-# Load the JSON file
-with open('data/adjusted_data.json', 'r') as f:
-    data = json.load(f)
+THUMBNAIL_WIDTH = 400
+THUMBNAIL_DIR = os.path.join('public', 'thumbnails')
+ADJUSTED_DATA_PATH = 'data/adjusted_data.json'
+# hashMapper.js's index of the image directories, kept by the Node server
+HASH_PATH_CACHE = 'hash_path_cache.json'
+# Asked for hashes neither index knows, as every image was before the local lookup
+HASH_TO_PATH_URL = "http://localhost:3000/hash-to-path/{}"
+SERVER_LOOKUP_WORKERS = 8
+# Extra copies for the 3D spicy view, bounded by their longest side, under
+# public/thumbnails/<size>/; thumbnail_atlas.py packs the small ones into sprite sheets
+PYRAMID_SIZES = (400, 128, 64)
+PYRAMID_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'avif': ('AVIF', {'quality': 60}),
+}
 
-# Function to process a single image
-def process_image(hash_key, entry):
-    try:
-        # get the path with a GET to the server at port 3000 /hash-to-path/:hash
-        img_path = requests.get(f"http://localhost:3000/hash-to-path/{hash_key}").json()['path']
-        if not os.path.exists(img_path):
-            print(f"File {img_path} does not exist.")
+# Use the first 3 characters of the hash for sharding and the rest as the filename
+def thumbnail_path(hash_key):
+    return os.path.join(THUMBNAIL_DIR, hash_key[0], hash_key[1], hash_key[2], f"{hash_key[3:]}.jpg")
+
+def pyramid_path(hash_key, size, pyramid_format):
+    return os.path.join(THUMBNAIL_DIR, str(size), hash_key[0], hash_key[1], hash_key[2],
+                        f"{hash_key[3:]}.{pyramid_format}")
+
+def output_paths(hash_key, pyramid_format=None):
+    paths = [thumbnail_path(hash_key)]
+    if pyramid_format:
+        paths += [pyramid_path(hash_key, size, pyramid_format) for size in PYRAMID_SIZES]
+    return paths
+
+# hash -> [paths] from the captioner's hash cache and the Node server's index,
+# read once up front instead of one request to /hash-to-path per image
+def load_hash_index(mapper_cache_path=HASH_PATH_CACHE):
+    hash_cache = HashCache()
+    index = hash_cache.paths_by_hash()
+    hash_cache.close()
+    if os.path.exists(mapper_cache_path):
+        with open(mapper_cache_path, 'r') as f:
+            for hash_key, path in json.load(f).get('mappings', {}).items():
+                index.setdefault(hash_key, []).append(path)
+    return index
+
+def resolve_path(hash_key, index):
+    for path in index.get(hash_key, ()):
+        if os.path.exists(path):
+            return path
+    return None
+
+# hash -> path from the Node server for hashes the local indexes miss. Stops
+# asking once the server turns out to be unreachable
+def resolve_via_server(hash_keys):
+    session = requests.Session()
+    unreachable = threading.Event()
+    found = {}
+
+    def lookup(hash_key):
+        if unreachable.is_set():
+            return
+        try:
+            img_path = session.get(HASH_TO_PATH_URL.format(hash_key), timeout=10).json().get('path')
+        except requests.ConnectionError:
+            unreachable.set()
+            return
+        except (requests.RequestException, ValueError):
             return
-        img = Image.open(img_path).convert('RGB')  # Ensure image is in RGB mode for JPEG
-        
-        width = 400
+        if img_path and os.path.exists(img_path):
+            found[hash_key] = img_path
+
+    with ThreadPoolExecutor(max_workers=SERVER_LOOKUP_WORKERS) as executor:
+        list(executor.map(lookup, hash_keys))
+    session.close()
+    if unreachable.is_set():
+        print(f"Node server not reachable at {HASH_TO_PATH_URL.format('')}; "
+              f"{len(hash_keys) - len(found)} hashes stay unresolved")
+    return found
+
+def is_up_to_date(img_path, output_path):
+    try:
+        return os.stat(output_path).st_mtime_ns >= os.stat(img_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+# Written under a temp name so an interrupted run never leaves a partial
+# thumbnail that looks up to date
+def save_atomic(img, output_path, format, **params):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    img.save(tmp_path, format=format, **params)
+    os.replace(tmp_path, output_path)
+
+# Function to process a single image; runs in a worker process. Returns an error message or None
+def make_thumbnail(task):
+    hash_key, img_path, pyramid_format = task
+    try:
+        with Image.open(img_path) as img:
+            if img.format == 'JPEG' and img.size[0] > THUMBNAIL_WIDTH:
+                # Let libjpeg decode at the smallest 1/2, 1/4 or 1/8 scale still at least
+                # the thumbnail's size instead of decoding every pixel and throwing most away
+                img.draft('RGB', (THUMBNAIL_WIDTH, max(1, img.size[1] * THUMBNAIL_WIDTH // img.size[0])))
+            img = img.convert('RGB')  # Ensure image is in RGB mode for JPEG
+
+        width = THUMBNAIL_WIDTH
         if img.size[0] > width:
             w_percent = (width / float(img.size[0]))
             height = int((float(img.size[1]) * float(w_percent)))
             img = img.resize((width, height), resample=Image.LANCZOS)
-        
-        # Determine the output path based on the hash
-        # Use the first 3 characters of the hash for sharding
-        subdirs = [hash_key[0], hash_key[1], hash_key[2]]
-        output_dir = os.path.join('public', 'thumbnails', *subdirs)
-        
-        # Ensure the directories exist
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Use the rest of the hash as the filename with .jpg extension
-        output_filename = f"{hash_key[3:]}.jpg"
-        output_path = os.path.join(output_dir, output_filename)
-        
+
         # Save the thumbnail as JPEG
-        img.save(output_path, format='JPEG', quality=85)
+        save_atomic(img, thumbnail_path(hash_key), 'JPEG', quality=85)
+
+        if pyramid_format:
+            # Each size is scaled from the one above it, never from the full image again
+            format, params = PYRAMID_FORMATS[pyramid_format]
+            for size in PYRAMID_SIZES:
+                img = img.copy()
+                img.thumbnail((size, size), resample=Image.LANCZOS)
+                save_atomic(img, pyramid_path(hash_key, size, pyramid_format), format, **params)
     except Exception as e:
-        print(f"Error processing image {hash_key}: {e}")
-
-# Process images in threads
-def main():
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        for hash_key, entry in data.items():
-            futures.append(executor.submit(process_image, hash_key, entry))
-        
+        return f"Error processing image {hash_key}: {e}"
+    return None
+
+# Decides which images need thumbnails; returns the (hash, path, pyramid format) tasks and counts of the rest
+def plan(data, index, force=False, pyramid_format=None, server_lookup=True):
+    tasks, skipped = [], {"up_to_date": 0, "unresolved": 0}
+    resolved = {hash_key: resolve_path(hash_key, index) for hash_key in data}
+    missing = [hash_key for hash_key, img_path in resolved.items() if img_path is None]
+    if missing and server_lookup:
+        resolved.update(resolve_via_server(missing))
+    for hash_key, img_path in resolved.items():
+        if img_path is None:
+            skipped["unresolved"] += 1
+        elif not force and all(is_up_to_date(img_path, path) for path in output_paths(hash_key, pyramid_format)):
+            skipped["up_to_date"] += 1
+        else:
+            tasks.append((hash_key, img_path, pyramid_format))
+    return tasks, skipped
+
+# Process images in worker processes: decoding and resizing hold the GIL, so threads don't scale
+def main(workers=None, force=False, pyramid_format=None, server_lookup=True):
+    if pyramid_format and not features.check(pyramid_format):
+        print(f"Error: this Pillow build can't write {pyramid_format}.")
+        return
+
+    # Load the JSON file
+    with open(ADJUSTED_DATA_PATH, 'r') as f:
+        data = json.load(f)
+
+    tasks, skipped = plan(data, load_hash_index(), force, pyramid_format, server_lookup)
+    print(f"{len(tasks)} thumbnails to make, {skipped['up_to_date']} up to date, "
+          f"{skipped['unresolved']} with no known file")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
         # Use tqdm to show progress bar
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            pass  # You can handle results here if needed
+        for error in tqdm(executor.map(make_thumbnail, tasks, chunksize=16), total=len(tasks)):
+            if error:
+                print(error)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Make 400px JPEG thumbnails (and smaller copies) under public/thumbnails")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="Remake thumbnails that are already up to date")
+    parser.add_argument('--pyramid-format', choices=[*PYRAMID_FORMATS, 'none'], default='none',
+                        help=f"Also write {'/'.join(map(str, PYRAMID_SIZES))}px copies in this codec "
+                             f"for thumbnail_atlas.py (default: none)")
+    parser.add_argument('--no-server', action='store_true',
+                        help="Don't ask the Node server for hashes missing from the local indexes")
+    args = parser.parse_args()
+    main(args.workers, args.force, None if args.pyramid_format == 'none' else args.pyramid_format,
+         not args.no_server)
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# prompt_layout.py
+#
+# LLM servers (KoboldCpp, llama.cpp) keep the KV cache of the previous prompt
+# and only evaluate the tokens after the longest common prefix. Prompts are
+# therefore laid out as a static part that is byte-identical on every request
+# (instructions, tag list, examples) followed by the per-item payload, and
+# built by concatenation rather than repeated string replacement.
+
+
+class PromptLayout:
+    def __init__(self, template, placeholder):
+        parts = template.split(placeholder)
+        if len(parts) != 2:
+            raise ValueError(f"Template must contain {placeholder} exactly once, found {len(parts) - 1}")
+        self.prefix, self.suffix = parts
+        self.placeholder = placeholder
+
+    def render(self, payload):
+        return self.prefix + payload + self.suffix
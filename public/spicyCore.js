@@ -14,6 +14,11 @@ export class SpicyVisualizer {
         this.SLICE_RADIUS = 200;
         this.centerOffset = 0;
         this.sliceView = null;
+        this.atlases = null; // Sprite sheet manifest from thumbnail_atlas.py, if built
+        this.atlasTextures = new Map(); // Map of sheet url to Promise of THREE.Texture
+        this.sliceSprites = []; // Thumbnail sprites standing in for the open slice's nodes
+        this.thumbnailRequest = null;
+        this.ATLAS_SIZE = '64';
 
         // Predefined color palette for tag selection
         this.TAG_COLORS = [
@@ -44,6 +49,7 @@ export class SpicyVisualizer {
         // Load data
         const response = await fetch('/data');
         const data = await response.json();
+        this.atlases = await this.loadAtlasManifest();
 
         // Setup Three.js scene
         this.setupScene();
@@ -176,6 +182,97 @@ export class SpicyVisualizer {
         });
     }
 
+    async loadAtlasManifest() {
+        try {
+            const response = await fetch('/atlases/manifest.json');
+            return response.ok ? await response.json() : null;
+        } catch (error) {
+            console.warn('No thumbnail atlases, showing plain nodes:', error);
+            return null;
+        }
+    }
+
+    // One texture per sheet, loaded once; sprites clone it, which shares the upload
+    loadAtlasTexture(url) {
+        if (!this.atlasTextures.has(url)) {
+            this.atlasTextures.set(url, new THREE.TextureLoader().loadAsync(url).then(texture => {
+                texture.colorSpace = THREE.SRGBColorSpace;
+                return texture;
+            }));
+        }
+        return this.atlasTextures.get(url);
+    }
+
+    // Resolves to Map of hash to { image, x, y, width, height } for the slice's
+    // thumbnails, in sheet pixels; empty without atlases
+    async loadSliceAtlas(level, size = this.ATLAS_SIZE) {
+        const atlas = this.atlases && this.atlases.sizes[size];
+        const sprites = new Map();
+        if (!atlas) return sprites;
+
+        const sheetIndexes = atlas.slices[level.toFixed(1)] || [];
+        const textures = await Promise.all(sheetIndexes.map(index => this.loadAtlasTexture(atlas.sheets[index].url)));
+        const textureBySheet = new Map(sheetIndexes.map((index, i) => [index, textures[i]]));
+
+        Object.entries(atlas.items).forEach(([hash, [sheetIndex, u0, v0, u1, v1]]) => {
+            const texture = textureBySheet.get(sheetIndex);
+            if (!texture) return;
+            const sheet = atlas.sheets[sheetIndex];
+            sprites.set(hash, {
+                texture,
+                image: texture.image,
+                uv: [u0, v0, u1, v1],
+                x: u0 * sheet.width,
+                y: v0 * sheet.height,
+                width: (u1 - u0) * sheet.width,
+                height: (v1 - v0) * sheet.height
+            });
+        });
+        return sprites;
+    }
+
+    async showSliceThumbnails(sliceMesh) {
+        this.hideSliceThumbnails();
+        const request = this.thumbnailRequest = {};
+        const sprites = await this.loadSliceAtlas(sliceMesh.userData.level);
+        // Closed or switched to another slice while the sheets loaded
+        if (this.thumbnailRequest !== request) return;
+
+        sliceMesh.userData.items.forEach(item => {
+            const node = this.nodes.get(item.hash);
+            const sprite = sprites.get(item.hash);
+            if (!node || !sprite) return;
+
+            // Textures are flipped on upload, so v runs bottom-up here
+            const [u0, v0, u1, v1] = sprite.uv;
+            const texture = sprite.texture.clone();
+            texture.offset.set(u0, 1 - v1);
+            texture.repeat.set(u1 - u0, v1 - v0);
+
+            const material = new THREE.SpriteMaterial({ map: texture, transparent: true, opacity: node.material.opacity });
+            const thumbnail = new THREE.Sprite(material);
+            thumbnail.position.copy(node.position);
+            const aspect = sprite.width / sprite.height;
+            thumbnail.scale.set(16 * Math.min(aspect, 1), 16 / Math.max(aspect, 1), 1);
+            thumbnail.userData = { node };
+
+            node.visible = false;
+            this.scene.add(thumbnail);
+            this.sliceSprites.push(thumbnail);
+        });
+    }
+
+    hideSliceThumbnails() {
+        this.sliceSprites.forEach(thumbnail => {
+            thumbnail.userData.node.visible = true;
+            thumbnail.material.map.dispose();
+            thumbnail.material.dispose();
+            this.scene.remove(thumbnail);
+        });
+        this.sliceSprites = [];
+        this.thumbnailRequest = null;
+    }
+
     updateSelection() {
         if (this.selectedTags.size === 0) {
             // Reset all nodes to default grey
@@ -185,6 +282,7 @@ export class SpicyVisualizer {
                 node.material.transparent = false;
             });
             this.tagToColorIndex.clear();
+            this.syncSliceThumbnails();
             return;
         }
 
@@ -218,6 +316,13 @@ export class SpicyVisualizer {
                 node.material.transparent = true;
             }
         });
+        this.syncSliceThumbnails();
+    }
+
+    syncSliceThumbnails() {
+        this.sliceSprites.forEach(thumbnail => {
+            thumbnail.material.opacity = thumbnail.userData.node.material.opacity;
+        });
     }
 
     animate() {
@@ -5,6 +5,8 @@ export class SpicySliceView {
         this.hoveredNode = null;
         this.sliceCanvas = null;
         this.sliceCanvasMousePos = { x: 0, y: 0 };
+        this.sliceDrawRequest = null;
+        this.THUMBNAIL_SIZE = 20; // Thumbnail size on the slice canvas when atlases are built
         this.tooltip = document.getElementById('tooltip');
         this.thumbnailViewer = document.getElementById('thumbnailViewer');
         this.thumbnailImage = document.getElementById('thumbnailImage');
@@ -39,6 +41,8 @@ export class SpicySliceView {
         const viewer = document.getElementById('sliceViewer');
         viewer.style.display = 'none';
         this.hideThumbnail();
+        this.sliceDrawRequest = null;
+        this.visualizer.hideSliceThumbnails();
         if (this.selectedSlice) {
             this.selectedSlice.material.opacity = 0.1;
             this.selectedSlice = null;
@@ -67,6 +71,7 @@ export class SpicySliceView {
         // Draw nodes with tag-based visibility
         const scale = (canvas.width - 20) / (this.visualizer.SLICE_RADIUS * 2);
         const center = canvas.width / 2;
+        const shown = [];
 
         sliceMesh.userData.items.forEach(item => {
             const node = this.visualizer.nodes.get(item.hash);
@@ -103,11 +108,42 @@ export class SpicySliceView {
                 ctx.arc(x, y, 4, 0, Math.PI * 2);
                 ctx.fillStyle = colorStr;
                 ctx.fill();
+                shown.push({ hash: item.hash, x, y, colorStr, opacity });
             }
         });
 
         this.selectedSlice = sliceMesh;
         viewer.style.display = 'block';
+        this.drawSliceThumbnails(sliceMesh, shown);
+        this.visualizer.showSliceThumbnails(sliceMesh);
+    }
+
+    // Draws the slice's thumbnails over its nodes once its sprite sheets are
+    // loaded, a few requests for the whole slice; nodes without one keep their dot
+    async drawSliceThumbnails(sliceMesh, shown) {
+        const request = this.sliceDrawRequest = {};
+        const sprites = await this.visualizer.loadSliceAtlas(sliceMesh.userData.level);
+        // Closed or redrawn while the sheets loaded
+        if (this.sliceDrawRequest !== request || sprites.size === 0) return;
+
+        const ctx = this.sliceCanvas.getContext('2d');
+        const size = this.THUMBNAIL_SIZE;
+        shown.forEach(({ hash, x, y, colorStr, opacity }) => {
+            const sprite = sprites.get(hash);
+            if (!sprite) return;
+            const fit = size / Math.max(sprite.width, sprite.height);
+            const width = sprite.width * fit;
+            const height = sprite.height * fit;
+
+            ctx.globalAlpha = opacity;
+            ctx.drawImage(sprite.image, sprite.x, sprite.y, sprite.width, sprite.height,
+                x - width / 2, y - height / 2, width, height);
+            ctx.globalAlpha = 1;
+            // Outline in the node's tag colour so the selection still reads
+            ctx.strokeStyle = colorStr;
+            ctx.lineWidth = 1.5;
+            ctx.strokeRect(x - width / 2, y - height / 2, width, height);
+        });
     }
 
     getNodeAtCanvasPosition(x, y) {
@@ -242,7 +278,11 @@ export class SpicySliceView {
     updateThumbnail(node) {
         if (node && node.userData.hash) {
             const hash = node.userData.hash;
-            const thumbnailUrl = `/thumbnails/${hash[0]}/${hash[1]}/${hash[2]}/${hash.substring(3)}.jpg`;
+            // With atlases built, use the 400px copy from make_thumbnails.py's pyramid in the same format
+            const atlases = this.visualizer.atlases;
+            const thumbnailUrl = atlases
+                ? `/thumbnails/400/${hash[0]}/${hash[1]}/${hash[2]}/${hash.substring(3)}.${atlases.format}`
+                : `/thumbnails/${hash[0]}/${hash[1]}/${hash[2]}/${hash.substring(3)}.jpg`;
 
             // Only update src if it's different to avoid flickering
             if (this.thumbnailImage.src !== thumbnailUrl) {
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
 import json
 from tqdm import tqdm
 import requests
@@ -7,8 +9,18 @@ import sys
 import shutil
 import time
 import os
+from prompt_layout import PromptLayout
+from tagged_store import open_tagged_store
+from tag_schema import TagResponseError, TagSchema, decode_response, parse_available_tags
 
-tagged_data = {}
+# Results log (tagged_store.py) and the keys in it that already have tags
+tagged_store = None
+tagged_keys = set()
+token_stats = {"requests": 0, "prompt_tokens": 0, "tagged": 0, "fallbacks": 0, "estimated": False}
+# Responses (or packed sub-results) that came back but didn't validate, and the
+# tokens spent on them; appended to PATH_TAGGING_RUNS at the end of each run
+output_stats = {"results": 0, "failed": 0, "trimmed": 0, "unknown_tags": 0,
+                "wasted_prompt_tokens": 0, "wasted_output_tokens": 0}
 
 if not os.path.exists('backup'):
     os.makedirs('backup')
@@ -16,18 +28,34 @@ if not os.path.exists('backup'):
 PATH_CAPTIONED = os.path.join('data', 'images_captioned.json')
 PATH_CAPTIONED_BACKUP = os.path.join('backup', 'images_captioned.json')
 PATH_CAPTIONED_TAGGED = os.path.join('data', 'images_captioned_tagged.json')
+PATH_CAPTIONED_TAGGED_DB = os.path.join('data', 'images_captioned_tagged.db')
 PATH_CAPTIONED_TAGGED_BACKUP = os.path.join('backup', 'images_captioned_tagged_backup.json')
 PATH_PROMPT_TEMPLATE = 'tagging_prompt_template.txt'
+PATH_PACKED_PROMPT_TEMPLATE = 'tagging_packed_prompt_template.txt'
+PATH_TAGGING_RUNS = os.path.join('data', 'tagging_runs.jsonl')
+# Captions in a packed request are keyed by this many leading hash characters
+PACKED_ID_LENGTH = 12
+# Used when the server can't count tokens (KoboldCpp's /api/extra/tokencount)
+CHARS_PER_TOKEN_ESTIMATE = 4
 SERVER = 'bestiary:5000'
 INSTRUCTION = "You're a captioning bot that takes a short summary of an image and must generate a JSON array of around 15 tags. The tags should fully describe the content of the image and break it out into easily searchable categories. Special attention must be paid to the political, social, cultural, race, sex, gender, or controversial content in the captions. A list of tags is provided and you should use those, though in extreme circumstances you may choose to generate additional tag(s) if it's especially relevant. The tags should be of the form `{\"tag name\": n}` where n is a value 0.0-1.0 that corresponds to how relevant the tag is. After the tags you must append a spiciness rating based on your judgment of the caption, in the form of spicy: `{\"spicy\": n}`, where n is 0.0-1.0. 0.0 would be e.g., a photo of a happy cat. 1.0 would be, e.g., Hitler dancing on the twin towers on 9/11."
 AVAILABLE_TAGS = ""
 with open('available_tags.txt', 'r') as f:
     AVAILABLE_TAGS = f.read()
+TAG_SCHEMA = TagSchema(parse_available_tags(AVAILABLE_TAGS))
+# Set by --grammar: send a GBNF grammar with each request and parse responses strictly
+USE_GRAMMAR = False
+
+# Rebuild the consolidated JSON served by the Node server from the results log
+def compact_tagged_data():
+    count = tagged_store.compact(PATH_CAPTIONED_TAGGED)
+    print(f'Wrote {count} items to {PATH_CAPTIONED_TAGGED}')
 
 def signal_handler(sig, frame):
-    print('Interrupted! Saving data...')
-    with open(PATH_CAPTIONED_TAGGED, 'w') as outfile:
-        json.dump(tagged_data, outfile, indent=2)
+    # Every result is already committed; compaction is left for the next run
+    # (or `python tagged_store.py compact`) so interrupting stays instant
+    print('Interrupted! Tagged items so far are saved in the results log.')
+    tagged_store.close()
     sys.exit(0)
 
 # Backs up both PATH_CAPTIONED and PATH_CAPTIONED_TAGGED if they exist
@@ -42,10 +70,12 @@ def backup_files():
             shutil.copy(PATH_CAPTIONED_TAGGED, PATH_CAPTIONED_TAGGED_BACKUP)
             print(f'Backup of {PATH_CAPTIONED_TAGGED} created')
 
-def load_prompt_template():
-    template = ""
-    with open(PATH_PROMPT_TEMPLATE, 'r') as f:
-        return f.read().replace('%INSTRUCTION%', INSTRUCTION).replace('%AVAILABLE_TAGS%', AVAILABLE_TAGS)
+# Everything before the caption placeholder is identical on every request, so
+# the server's prefix cache only has to evaluate the caption itself
+def load_prompt_template(path=PATH_PROMPT_TEMPLATE, placeholder='%CAPTION%'):
+    with open(path, 'r') as f:
+        template = f.read().replace('%INSTRUCTION%', INSTRUCTION).replace('%AVAILABLE_TAGS%', AVAILABLE_TAGS)
+    return PromptLayout(template, placeholder)
 
 def load_data():
     if os.path.exists(PATH_CAPTIONED):
@@ -55,119 +85,330 @@ def load_data():
         print(f'Error: Captioned images at {PATH_CAPTIONED} not found. Please caption_images.py first.')
         sys.exit(1)
 
-    if os.path.exists(PATH_CAPTIONED_TAGGED):
-        with open(PATH_CAPTIONED_TAGGED, 'r') as f:
-            tagged_data = json.load(f)
-    else:
-        tagged_data = {}
-    return data, tagged_data
+    store = open_tagged_store(PATH_CAPTIONED_TAGGED_DB, PATH_CAPTIONED_TAGGED)
+    return data, store
+
+
+def build_payload(prompt, items=1, ids=None):
+    payload = {
+        "n": 1,
+        "max_context_length": 128000,
+        "max_length": 500,
+        "rep_pen": 1.07,
+        "temperature": 0.7,
+        "top_p": 0.92,
+        "top_k": 100,
+        "top_a": 0,
+        "typical": 1,
+        "tfs": 1,
+        "rep_pen_range": 320,
+        "rep_pen_slope": 0.7,
+        "sampler_order": [6, 0, 1, 3, 4, 2, 5],
+        "memory": "",
+        "trim_stop": True,
+        "genkey": "KCPP8126",
+        "min_p": 0,
+        "dynatemp_range": 0,
+        "dynatemp_exponent": 1,
+        "smoothing_factor": 0,
+        "banned_tokens": [],
+        "render_special": False,
+        "presence_penalty": 0,
+        "logit_bias": {},
+        "prompt": prompt,
+        "quiet": True,
+        "stop_sequence": ["### Instruction:", "### Response:", "###Human:", "### Assistant:", "\n\n"],
+        "use_default_badwordsids": False,
+        "bypass_eos": False
+    }
+    if items > 1:
+        # A packed answer is one object per caption, possibly with blank lines between
+        payload["max_length"] = 500 * items
+        payload["stop_sequence"] = [stop for stop in payload["stop_sequence"] if stop != "\n\n"]
+    if USE_GRAMMAR:
+        # The grammar ends the object, and its whitespace may contain a blank
+        # line, so the blank-line stop would only cut off a valid answer
+        payload["stop_sequence"] = [stop for stop in payload["stop_sequence"] if stop != "\n\n"]
+        payload["grammar"] = TAG_SCHEMA.grammar(ids)
+        payload["grammar_retain_state"] = False
+    return payload
+
+def apply_tags(key, item, response_data):
+    try:
+        item['tags'], item['spicy'], unknown = TAG_SCHEMA.validate(response_data)
+    except TagResponseError as e:
+        print(f"Invalid result for item {key}: {e}")
+        return None
+    output_stats["unknown_tags"] += len(unknown)
+    print(f"Tags for item {key}: {item['tags']}")
+    print(f"Spiciness for item {key}: {item['spicy']}")
+    return item
+
+def decode(response_text, label):
+    try:
+        response_data, trimmed = decode_response(response_text, strict=USE_GRAMMAR)
+    except TagResponseError as e:
+        print(f"Could not parse response for {label}: {e}")
+        return None
+    output_stats["trimmed"] += trimmed
+    return response_data
 
+# Counts a response that produced `failed` of its `results` expected results and
+# charges that share of the request's tokens as wasted
+def note_results(response_text, prompt_tokens, results, failed):
+    output_stats["results"] += results
+    output_stats["failed"] += failed
+    if failed:
+        share = failed / results
+        output_stats["wasted_prompt_tokens"] += round(prompt_tokens * share)
+        output_stats["wasted_output_tokens"] += round(len(response_text) // CHARS_PER_TOKEN_ESTIMATE * share)
 
-def process_item(key, item, prompt_template):
+# Extracts tags and spiciness from the LLM text into item; None if it doesn't validate
+def parse_response(key, item, response_text, prompt_tokens=0):
+    response_data = decode(response_text, f"item {key}")
+    result = apply_tags(key, item, response_data) if response_data is not None else None
+    note_results(response_text, prompt_tokens, 1, int(result is None))
+    return result
+
+def packed_ids(batch):
+    ids = [key[:PACKED_ID_LENGTH] for key, _ in batch]
+    return ids if len(set(ids)) == len(ids) else [key for key, _ in batch]
+
+def build_packed_prompt(packed_template, batch):
+    lines = [f'{packed_id}: {json.dumps(item["description"])}' for packed_id, (_, item) in zip(packed_ids(batch), batch)]
+    return packed_template.render('\n'.join(lines))
+
+# Splits a packed response into tagged items and the (key, item) pairs that need a single-item retry
+def parse_packed_response(batch, response_text, prompt_tokens=0):
+    if response_text is None:
+        return [], list(batch)
+    response_data = decode(response_text, f"packed batch of {len(batch)}")
+    if not isinstance(response_data, dict):
+        note_results(response_text, prompt_tokens, len(batch), len(batch))
+        return [], list(batch)
+
+    tagged, failed = [], []
+    for packed_id, (key, item) in zip(packed_ids(batch), batch):
+        if packed_id in response_data and apply_tags(key, item, response_data[packed_id]):
+            tagged.append((key, item))
+        else:
+            failed.append((key, item))
+    note_results(response_text, prompt_tokens, len(batch), len(failed))
+    return tagged, failed
+
+def estimate_tokens(prompt):
+    token_stats["estimated"] = True
+    return len(prompt) // CHARS_PER_TOKEN_ESTIMATE
+
+def count_tokens(prompt):
     try:
-        caption = item['description']
-        prompt = prompt_template.replace('%CAPTION%', caption)
-
-        payload = {
-            "n": 1,
-            "max_context_length": 128000,
-            "max_length": 500,
-            "rep_pen": 1.07,
-            "temperature": 0.7,
-            "top_p": 0.92,
-            "top_k": 100,
-            "top_a": 0,
-            "typical": 1,
-            "tfs": 1,
-            "rep_pen_range": 320,
-            "rep_pen_slope": 0.7,
-            "sampler_order": [6, 0, 1, 3, 4, 2, 5],
-            "memory": "",
-            "trim_stop": True,
-            "genkey": "KCPP8126",
-            "min_p": 0,
-            "dynatemp_range": 0,
-            "dynatemp_exponent": 1,
-            "smoothing_factor": 0,
-            "banned_tokens": [],
-            "render_special": False,
-            "presence_penalty": 0,
-            "logit_bias": {},
-            "prompt": prompt,
-            "quiet": True,
-            "stop_sequence": ["### Instruction:", "### Response:", "###Human:", "### Assistant:", "\n\n"],
-            "use_default_badwordsids": False,
-            "bypass_eos": False
-        }
+        response = requests.post(f'http://{SERVER}/api/extra/tokencount', json={"prompt": prompt})
+        if response.status_code == 200:
+            return response.json()['value']
+    except Exception:
+        pass
+    return estimate_tokens(prompt)
+
+def note_request(prompt_tokens):
+    token_stats["requests"] += 1
+    token_stats["prompt_tokens"] += prompt_tokens
+    return prompt_tokens
 
+# Returns (response text or None, prompt tokens)
+def generate_sync(payload, label, count_prompt_tokens):
+    prompt_tokens = note_request(count_tokens(payload["prompt"]) if count_prompt_tokens else estimate_tokens(payload["prompt"]))
+    try:
         response = requests.post(
             f'http://{SERVER}/api/v1/generate',
             headers={'Content-Type': 'application/json'},
             json=payload,
         )
-
         if response.status_code != 200:
-            print(f"Error: Received status code {response.status_code} for item {key}")
-            return None
-
-        response_text = response.json()['results'][0]['text']
-
-        # Find the JSON object in the response.
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1  # Include the closing brace.
-        if json_start == -1 or json_end == -1:
-            print(f"Could not find JSON in response for item {key}")
-            return None
-
-        json_str = response_text[json_start:json_end]
-        try:
-            response_data = json.loads(json_str)
-            # Extract tags and spiciness.
-            item['tags'] = {tag['tag_name']: tag['relevance_score'] for tag in response_data['tags']}
-            item['spicy'] = response_data['spicy']['spicy']
-            print(f"Tags for item {key}: {item['tags']}")
-            print(f"Spiciness for item {key}: {item['spicy']}")
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error for item {key}: {e}")
-            return None
-
-        return item
-
+            print(f"Error: Received status code {response.status_code} for {label}")
+            return None, prompt_tokens
+        return response.json()['results'][0]['text'], prompt_tokens
     except Exception as e:
-        print(f"Exception occurred for item {key}: {e}")
+        print(f"Exception occurred for {label}: {e}")
+        return None, prompt_tokens
+
+def process_item(key, item, prompt_template, count_prompt_tokens=False):
+    prompt = prompt_template.render(item['description'])
+    response_text, prompt_tokens = generate_sync(build_payload(prompt), f"item {key}", count_prompt_tokens)
+    if response_text is None:
         return None
+    return parse_response(key, item, response_text, prompt_tokens)
+
+# Tags a batch with one packed request, retrying only the captions whose sub-result was bad
+def process_batch(batch, packed_template, prompt_template, count_prompt_tokens=False):
+    if len(batch) == 1:
+        key, item = batch[0]
+        return [(key, item)] if process_item(key, item, prompt_template, count_prompt_tokens) else []
+    prompt = build_packed_prompt(packed_template, batch)
+    payload = build_payload(prompt, len(batch), packed_ids(batch))
+    response_text, prompt_tokens = generate_sync(payload, f"packed batch of {len(batch)}", count_prompt_tokens)
+    tagged, failed = parse_packed_response(batch, response_text, prompt_tokens)
+    for key, item in failed:
+        token_stats["fallbacks"] += 1
+        if process_item(key, item, prompt_template, count_prompt_tokens):
+            tagged.append((key, item))
+    return tagged
+
+def pending_items(data, order='file'):
+    keys = (key for key in data if key not in tagged_keys)
+    if order == 'caption':
+        # Neighbouring captions often open the same way ("The image is a ..."),
+        # so consecutive prompts share more than the static prefix
+        keys = sorted(keys, key=lambda key: data[key].get('description') or '')
+    for key in keys:
+        yield key, data[key]
+
+def chunks(iterable, size):
+    chunk = []
+    for entry in iterable:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def record_item(key, item):
+    # Each result is committed as it completes; since resume skips any key
+    # that already has tags, completion order doesn't matter
+    tagged_store.put(key, item)
+    tagged_keys.add(key)
+    token_stats["tagged"] += 1
+
+def count_remaining(data):
+    return sum(1 for key in data if key not in tagged_keys)
+
+def run_sync(data, prompt_template, packed_template, pack, count_prompt_tokens, order):
+    progress_bar = tqdm(total=count_remaining(data), desc='Processing items', unit='captioned image')
+    for batch in chunks(pending_items(data, order), pack):
+        for key, item in process_batch(batch, packed_template, prompt_template, count_prompt_tokens):
+            record_item(key, item)
+        progress_bar.update(len(batch))
+    progress_bar.close()
+
+async def run_async(data, prompt_template, packed_template, pack, count_prompt_tokens, order, server, concurrency, rate):
+    # Imported here so the blocking mode works without aiohttp installed
+    from llm_client import LLMClient
+
+    pending = chunks(pending_items(data, order), pack)
+    progress_bar = tqdm(total=count_remaining(data), desc='Processing items', unit='captioned image')
+
+    async def generate(client, payload):
+        prompt_tokens = await client.count_tokens(payload["prompt"]) if count_prompt_tokens else None
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(payload["prompt"])
+        note_request(prompt_tokens)
+        return await client.generate(payload), prompt_tokens
+
+    async def tag_single(client, key, item):
+        prompt = prompt_template.render(item['description'])
+        response_text, prompt_tokens = await generate(client, build_payload(prompt))
+        return response_text is not None and parse_response(key, item, response_text, prompt_tokens) is not None
+
+    async def worker(client):
+        # Workers share one generator, so only `concurrency` requests are ever in flight
+        for batch in pending:
+            if len(batch) == 1:
+                tagged = [batch[0]] if await tag_single(client, *batch[0]) else []
+            else:
+                payload = build_payload(build_packed_prompt(packed_template, batch), len(batch), packed_ids(batch))
+                response_text, prompt_tokens = await generate(client, payload)
+                tagged, failed = parse_packed_response(batch, response_text, prompt_tokens)
+                for key, item in failed:
+                    token_stats["fallbacks"] += 1
+                    if await tag_single(client, key, item):
+                        tagged.append((key, item))
+            for key, item in tagged:
+                record_item(key, item)
+            progress_bar.update(len(batch))
+
+    async with LLMClient(server, concurrency=concurrency, rate=rate) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        print(f"LLM client: {client.stats()}")
+    progress_bar.close()
+
+def report_tokens():
+    if not token_stats["tagged"]:
+        return
+    estimate = " (estimated from characters)" if token_stats["estimated"] else ""
+    print(f"Prompt tokens: {token_stats['prompt_tokens']} over {token_stats['requests']} requests, "
+          f"{token_stats['prompt_tokens'] / token_stats['tagged']:.0f} per tagged image{estimate}; "
+          f"{token_stats['fallbacks']} single-item fallbacks")
+
+def report_output():
+    if not output_stats["results"]:
+        return
+    print(f"Responses: {output_stats['failed']} of {output_stats['results']} results failed validation "
+          f"({output_stats['failed'] / output_stats['results']:.1%}), wasting {output_stats['wasted_prompt_tokens']} "
+          f"prompt and ~{output_stats['wasted_output_tokens']} output tokens; {output_stats['trimmed']} needed trimming, "
+          f"{output_stats['unknown_tags']} tags not in available_tags.txt")
+
+# One JSON line per run, so failure rates can be compared across settings and models
+def record_run(args, elapsed):
+    run = {"time": time.strftime('%Y-%m-%dT%H:%M:%S'), "elapsed": round(elapsed, 1), "server": SERVER,
+           "async": args.use_async, "pack": args.pack, "grammar": args.grammar, "strict_tags": args.strict_tags,
+           **{key: token_stats[key] for key in ("requests", "prompt_tokens", "tagged", "fallbacks")},
+           **output_stats}
+    with open(PATH_TAGGING_RUNS, 'a') as f:
+        f.write(json.dumps(run) + '\n')
 
 def main():
-    global tagged_data
+    global tagged_store, tagged_keys, SERVER, USE_GRAMMAR
+    parser = argparse.ArgumentParser(description="Tag captioned images with an LLM")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Send requests concurrently with aiohttp")
+    parser.add_argument('--concurrency', type=int, default=4, help="Requests in flight in --async mode")
+    parser.add_argument('--rate', type=float, default=None, help="Max requests per second in --async mode")
+    parser.add_argument('--pack', type=int, default=1,
+                        help="Captions per request; above 1 uses the packed prompt template")
+    parser.add_argument('--count-tokens', action='store_true',
+                        help="Count prompt tokens with the server's tokencount endpoint instead of estimating")
+    parser.add_argument('--order', choices=['file', 'caption'], default='file',
+                        help="Tag in file order, or in caption order for more prompt prefix reuse")
+    parser.add_argument('--grammar', action='store_true',
+                        help="Constrain output with a GBNF grammar (KoboldCpp/llama.cpp) and parse responses strictly")
+    parser.add_argument('--strict-tags', action='store_true',
+                        help="Reject results with tags not in available_tags.txt (and leave them out of the grammar)")
+    parser.add_argument('--server', default=SERVER)
+    parser.add_argument('--compact-only', action='store_true',
+                        help=f"Only rewrite {PATH_CAPTIONED_TAGGED} from the results log")
+    args = parser.parse_args()
+    SERVER = args.server
+    USE_GRAMMAR = args.grammar
+    TAG_SCHEMA.allow_unknown = not args.strict_tags
+
+    if args.compact_only:
+        tagged_store = open_tagged_store(PATH_CAPTIONED_TAGGED_DB, PATH_CAPTIONED_TAGGED)
+        compact_tagged_data()
+        tagged_store.close()
+        return
+
     signal.signal(signal.SIGINT, signal_handler)
     backup_files()
     prompt_template = load_prompt_template()
-    data, tagged_data = load_data()
-    save_count = 0
-
-    progress_bar = tqdm(data.items(), total=len(data), desc='Processing items', unit='captioned image')
-    # for key, item in data.items():
-    for key, item in progress_bar:
-        if key in tagged_data and 'tags' in tagged_data[key]:
-            continue
-
-        processed_item = process_item(key, item, prompt_template)
-        if processed_item:
-            tagged_data[key] = processed_item
-            save_count += 1
-
-            if save_count % 10 == 0:
-                print(f"Saving data... {save_count} new items processed")
-                with open(PATH_CAPTIONED_TAGGED, 'w') as outfile:
-                    json.dump(tagged_data, outfile, indent=2)
-                save_count = 0
-        else:
-            continue
+    packed_template = load_prompt_template(PATH_PACKED_PROMPT_TEMPLATE, '%CAPTIONS%') if args.pack > 1 else None
+    pack = max(1, args.pack)
+    data, tagged_store = load_data()
+    tagged_keys = tagged_store.tagged_keys()
+
+    start = time.time()
+    if args.use_async:
+        asyncio.run(run_async(data, prompt_template, packed_template, pack, args.count_tokens, args.order,
+                              SERVER, args.concurrency, args.rate))
+    else:
+        run_sync(data, prompt_template, packed_template, pack, args.count_tokens, args.order)
 
-    # Save at the end
-    with open(PATH_CAPTIONED_TAGGED, 'w') as outfile:
-        json.dump(tagged_data, outfile, indent=2)
+    # Consolidate once at the end
+    compact_tagged_data()
+    tagged_store.close()
 
+    report_tokens()
+    report_output()
+    record_run(args, time.time() - start)
     print(f'Processing complete. Data saved to {PATH_CAPTIONED_TAGGED}')
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# tag_schema.py
+#
+# Output contract for the tagging LLM. TagSchema.grammar() builds a GBNF
+# grammar for the "grammar" field of KoboldCpp's and llama.cpp's generate
+# endpoints. It only admits the {"tags": [...], "spicy": {"spicy": n}} object
+# (or, for packed requests, one such object per caption id) with scores in
+# [0, 1], so a sampled response always parses. TagSchema.validate() is the
+# strict check every response goes through, grammar or not, including tag
+# names against available_tags.txt.
+#
+# Usage: python tag_schema.py [available_tags.txt] [--strict-tags] > tagging.gbnf
+
+import json
+import re
+
+AVAILABLE_TAGS_PATH = 'available_tags.txt'
+
+# Scores as the examples write them: 0, 0.5, 0.75, 1, 1.0
+SCORE_RULE = 'score ::= "0" ("." [0-9] [0-9]?)? | "1" (".0" "0"?)?'
+JSON_STRING_RULE = r'''string ::= "\"" ([^"\\\x00-\x1f] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F]))* "\""'''
+RESULT_RULES = [
+    r'''result ::= "{" ws "\"tags\":" ws "[" ws tag (ws "," ws tag)* ws "]" ws "," ws "\"spicy\":" ws "{" ws "\"spicy\":" ws score ws "}" ws "}"''',
+    r'''tag ::= "{" ws "\"tag_name\":" ws tag-name ws "," ws "\"relevance_score\":" ws score ws "}"''',
+    SCORE_RULE,
+    r'ws ::= [ \t\n]*',
+]
+
+
+class TagResponseError(ValueError):
+    pass
+
+
+def parse_available_tags(text):
+    """Tag names from available_tags.txt, which may be comma- or newline-separated."""
+    names = (name.strip() for name in re.split(r'[,\n]', text))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def load_available_tags(path=AVAILABLE_TAGS_PATH):
+    with open(path, 'r') as f:
+        return parse_available_tags(f.read())
+
+
+def gbnf_literal(text):
+    # The JSON encoding of text, quoted as a GBNF string literal
+    encoded = json.dumps(text, ensure_ascii=False)
+    return '"' + encoded.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def decode_response(text, strict=False):
+    """The JSON value in an LLM response. With strict, the whole response must be
+    that value (as under a grammar); otherwise the span from the first '{' to the
+    last '}' is tried as well. Returns (value, trimmed)."""
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as e:
+        if strict:
+            raise TagResponseError(f"response is not JSON: {e}")
+    json_start = text.find('{')
+    json_end = text.rfind('}') + 1  # Include the closing brace.
+    if json_start == -1 or json_end == 0:
+        raise TagResponseError("no JSON object in response")
+    try:
+        return json.loads(text[json_start:json_end]), True
+    except json.JSONDecodeError as e:
+        raise TagResponseError(f"response is not JSON: {e}")
+
+
+def check_score(value, what):
+    # bool is an int subclass, and true/false are valid JSON
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TagResponseError(f"{what} {value!r} is not a number")
+    if not 0.0 <= value <= 1.0:
+        raise TagResponseError(f"{what} {value!r} is outside 0.0-1.0")
+    return value
+
+
+class TagSchema:
+    def __init__(self, tag_names, allow_unknown=True):
+        self.tag_names = frozenset(tag_names)
+        self.allow_unknown = allow_unknown
+        # The alternation over every tag name is the bulk of the grammar; build it once
+        self.names_rule = 'known-tag ::= ' + (' | '.join(gbnf_literal(name) for name in sorted(self.tag_names))
+                                               if self.tag_names else '"\\"\\""')
+
+    def grammar(self, ids=None):
+        """GBNF for one result, or for an object of results keyed by the given caption ids."""
+        if ids is None:
+            rules = ['root ::= ws result ws']
+        else:
+            rules = ['root ::= ws "{" ws entry (ws "," ws entry)* ws "}" ws',
+                     'entry ::= caption-id ws ":" ws result',
+                     'caption-id ::= ' + ' | '.join(gbnf_literal(caption_id) for caption_id in ids)]
+        rules += RESULT_RULES
+        if self.allow_unknown:
+            rules += ['tag-name ::= known-tag | string', self.names_rule, JSON_STRING_RULE]
+        else:
+            rules += ['tag-name ::= known-tag', self.names_rule]
+        return '\n'.join(rules) + '\n'
+
+    def validate(self, data):
+        """Checks one {"tags": [...], "spicy": {"spicy": n}} result.
+        Returns (tags, spicy, unknown) where unknown lists names not in the available tags."""
+        if not isinstance(data, dict):
+            raise TagResponseError(f"result is {type(data).__name__}, not an object")
+        tag_list, spicy = data.get('tags'), data.get('spicy')
+        if not isinstance(tag_list, list):
+            raise TagResponseError('"tags" is missing or not a list')
+        if not isinstance(spicy, dict) or 'spicy' not in spicy:
+            raise TagResponseError('"spicy" is missing or not {"spicy": n}')
+        tags, unknown = {}, []
+        for tag in tag_list:
+            if not isinstance(tag, dict):
+                raise TagResponseError(f"tag {tag!r} is not an object")
+            name = tag.get('tag_name')
+            if not isinstance(name, str) or not name:
+                raise TagResponseError(f"tag name {name!r} is not a string")
+            if name not in self.tag_names:
+                if not self.allow_unknown:
+                    raise TagResponseError(f"tag {name!r} is not in the available tags")
+                unknown.append(name)
+            tags[name] = check_score(tag.get('relevance_score'), f"relevance score for {name!r}")
+        return tags, check_score(spicy['spicy'], "spiciness"), unknown
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print the GBNF grammar for single-caption tagging responses")
+    parser.add_argument('tags_path', nargs='?', default=AVAILABLE_TAGS_PATH)
+    parser.add_argument('--strict-tags', action='store_true', help="Only allow tag names from the tags file")
+    args = parser.parse_args()
+    print(TagSchema(load_available_tags(args.tags_path), allow_unknown=not args.strict_tags).grammar(), end='')
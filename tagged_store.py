@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# tagged_store.py
+#
+# Results log for tag_caption_output.py. Each tagged item is committed to
+# SQLite as it completes, so a checkpoint costs one row rather than a rewrite
+# of the whole tagged JSON, and resuming only reads the set of tagged keys.
+# compact() produces data/images_captioned_tagged.json, the file the Node
+# server's /data endpoint serves, by streaming the rows out.
+#
+# Usage: python tagged_store.py compact [data/images_captioned_tagged.json] [--db data/images_captioned_tagged.db]
+
+import json
+import os
+import sqlite3
+import sys
+
+TAGGED_STORE_PATH = os.path.join('data', 'images_captioned_tagged.db')
+TAGGED_JSON_PATH = os.path.join('data', 'images_captioned_tagged.json')
+
+
+class TaggedStore:
+    def __init__(self, path=TAGGED_STORE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tagged_items (
+                hash TEXT PRIMARY KEY,
+                tagged INTEGER NOT NULL,
+                item TEXT NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM tagged_items').fetchone()[0]
+
+    def tagged_keys(self):
+        """Keys that already have tags; the only thing a resumed run needs to read."""
+        return {row[0] for row in self.conn.execute('SELECT hash FROM tagged_items WHERE tagged=1')}
+
+    def put(self, hash_value, item):
+        self.conn.execute('INSERT OR REPLACE INTO tagged_items (hash, tagged, item) VALUES (?, ?, ?)',
+                          (hash_value, int('tags' in item), json.dumps(item)))
+        self.conn.commit()
+
+    def import_json(self, json_path):
+        """Loads an existing tagged JSON file. Returns the entry count."""
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        self.conn.executemany('INSERT OR REPLACE INTO tagged_items (hash, tagged, item) VALUES (?, ?, ?)',
+                              ((hash_value, int('tags' in item), json.dumps(item)) for hash_value, item in data.items()))
+        self.conn.commit()
+        return len(data)
+
+    def compact(self, json_path=TAGGED_JSON_PATH):
+        """Writes every item as one JSON object (the json.dump indent=2 layout). Returns the entry count."""
+        tmp_path = json_path + '.tmp'
+        count = 0
+        with open(tmp_path, 'w') as f:
+            f.write('{')
+            for hash_value, item in self.conn.execute('SELECT hash, item FROM tagged_items ORDER BY rowid'):
+                body = json.dumps(json.loads(item), indent=2).replace('\n', '\n  ')
+                f.write(f'{"," if count else ""}\n  {json.dumps(hash_value)}: {body}')
+                count += 1
+            f.write('\n}' if count else '}')
+        os.replace(tmp_path, json_path)
+        return count
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_tagged_store(path=TAGGED_STORE_PATH, legacy_json_path=TAGGED_JSON_PATH):
+    """Opens the store, importing the tagged JSON the first time so earlier results aren't redone."""
+    is_new = not os.path.exists(path)
+    store = TaggedStore(path)
+    if is_new and os.path.exists(legacy_json_path):
+        count = store.import_json(legacy_json_path)
+        print(f"Imported {count} tagged items from {legacy_json_path}.")
+    return store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write the tagged JSON served by /data from the results log")
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("json_path", nargs="?", default=TAGGED_JSON_PATH)
+    parser.add_argument("--db", default=TAGGED_STORE_PATH)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Error: {args.db} does not exist.")
+        sys.exit(1)
+    store = TaggedStore(args.db)
+    count = store.compact(args.json_path)
+    store.close()
+    print(f"Wrote {count} tagged items to {args.json_path}.")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# thumbnail_atlas.py
+#
+# Packs the small thumbnails from make_thumbnails.py --pyramid-format webp (or
+# avif) into sprite sheets, one set per spicy slice, so the 3D spicy view loads
+# a whole slice in a few requests instead of one per image. Items are grouped
+# into slices the way spicyCore.js does (spicy rounded to one decimal) and laid
+# out on a grid of square cells, each thumbnail centred in its cell.
+#
+# Writes public/atlases/<size>/slice-<level>-<n>.<format> and
+# public/atlases/manifest.json:
+#
+#   {"format": "webp", "sizes": {"64": {
+#       "sheets": [{"url": "/atlases/64/slice-0.3-0.webp", "width": 2048, "height": 1024}],
+#       "slices": {"0.3": [0]},
+#       "items": {"<hash>": [sheet, u0, v0, u1, v1]}}}}
+#
+# UVs are 0-1 with the origin at the sheet's top-left corner.
+#
+# Usage: python thumbnail_atlas.py [--sizes 64 128] [--format webp] [--sheet-size 2048]
+
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, features
+
+from make_thumbnails import PYRAMID_FORMATS, PYRAMID_SIZES, pyramid_path
+
+TAGGED_PATH = os.path.join('data', 'images_captioned_tagged.json')
+ATLAS_DIR = os.path.join('public', 'atlases')
+ATLAS_SIZES = (64, 128)
+SHEET_SIZE = 2048
+
+# JavaScript's Math.round(spicy * 10) / 10, which rounds halves up rather than to even
+def slice_level(spicy):
+    return math.floor(spicy * 10 + 0.5) / 10
+
+def group_by_slice(data):
+    slices = {}
+    for hash_key, item in data.items():
+        if isinstance(item.get('spicy'), (int, float)):
+            slices.setdefault(f"{slice_level(item['spicy']):.1f}", []).append(hash_key)
+    return slices
+
+# Splits a slice's hashes into sheets of at most sheet_size x sheet_size pixels;
+# a slice that doesn't fill a sheet gets a smaller one
+def sheet_layouts(hashes, cell, sheet_size):
+    per_row = sheet_size // cell
+    per_sheet = per_row * per_row
+    for start in range(0, len(hashes), per_sheet):
+        chunk = hashes[start:start + per_sheet]
+        columns = min(per_row, len(chunk))
+        yield chunk, columns, -(-len(chunk) // columns)
+
+# Builds one sheet; runs in a worker process. Returns (path, width, height,
+# {hash: (u0, v0, u1, v1)}, missing hashes)
+def build_sheet(task):
+    output_path, hashes, columns, rows, cell, image_format = task
+    width, height = columns * cell, rows * cell
+    sheet = Image.new('RGB', (width, height))
+    uvs, missing = {}, []
+    for index, hash_key in enumerate(hashes):
+        try:
+            with Image.open(pyramid_path(hash_key, cell, image_format)) as img:
+                img = img.convert('RGB')
+        except OSError:
+            missing.append(hash_key)
+            continue
+        x = (index % columns) * cell + (cell - img.size[0]) // 2
+        y = (index // columns) * cell + (cell - img.size[1]) // 2
+        sheet.paste(img, (x, y))
+        uvs[hash_key] = (x / width, y / height, (x + img.size[0]) / width, (y + img.size[1]) / height)
+
+    format, params = PYRAMID_FORMATS[image_format]
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    sheet.save(tmp_path, format=format, **params)
+    os.replace(tmp_path, output_path)
+    return output_path, width, height, uvs, missing
+
+def plan(slices, sizes, image_format, sheet_size):
+    tasks = []
+    for size in sizes:
+        for level, hashes in sorted(slices.items()):
+            for n, (chunk, columns, rows) in enumerate(sheet_layouts(sorted(hashes), size, sheet_size)):
+                output_path = os.path.join(ATLAS_DIR, str(size), f"slice-{level}-{n}.{image_format}")
+                tasks.append((size, level, (output_path, chunk, columns, rows, size, image_format)))
+    return tasks
+
+def main(sizes=ATLAS_SIZES, image_format='webp', sheet_size=SHEET_SIZE, workers=None):
+    if not features.check(image_format):
+        print(f"Error: this Pillow build can't write {image_format}.")
+        return
+    if set(sizes) - set(PYRAMID_SIZES):
+        print(f"Error: make_thumbnails.py only writes {', '.join(map(str, PYRAMID_SIZES))}px copies.")
+        return
+    if max(sizes) > sheet_size:
+        print(f"Error: sheets of {sheet_size}px can't hold {max(sizes)}px cells.")
+        return
+
+    start = time.perf_counter()
+    with open(TAGGED_PATH, 'r') as f:
+        slices = group_by_slice(json.load(f))
+    tasks = plan(slices, sizes, image_format, sheet_size)
+
+    # Start from an empty directory so sheets of slices that shrank don't linger
+    shutil.rmtree(ATLAS_DIR, ignore_errors=True)
+    manifest = {"format": image_format,
+                "sizes": {str(size): {"sheets": [], "slices": {}, "items": {}} for size in sizes}}
+    missing = set()
+    total_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(build_sheet, [task for _, _, task in tasks])
+        for (size, level, _), (output_path, width, height, uvs, sheet_missing) in zip(tasks, results):
+            entry = manifest["sizes"][str(size)]
+            sheet_index = len(entry["sheets"])
+            url = '/' + os.path.relpath(output_path, 'public').replace(os.sep, '/')
+            entry["sheets"].append({"url": url, "width": width, "height": height})
+            entry["slices"].setdefault(level, []).append(sheet_index)
+            for hash_key, uv in uvs.items():
+                entry["items"][hash_key] = [sheet_index, *(round(value, 6) for value in uv)]
+            missing.update(sheet_missing)
+            total_bytes += os.path.getsize(output_path)
+
+    os.makedirs(ATLAS_DIR, exist_ok=True)
+    with open(os.path.join(ATLAS_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    total_bytes += os.path.getsize(os.path.join(ATLAS_DIR, 'manifest.json'))
+
+    items = sum(len(hashes) for hashes in slices.values())
+    print(f"{len(tasks)} sheets for {items} items in {len(slices)} slices, "
+          f"{total_bytes / 2**20:.1f} MB in total, built in {time.perf_counter() - start:.1f}s")
+    if missing:
+        print(f"{len(missing)} items have no {image_format} thumbnail yet; run make_thumbnails.py first")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack small thumbnails into per-slice sprite sheets under public/atlases")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(ATLAS_SIZES),
+                        help="Thumbnail sizes to pack; each must be one make_thumbnails.py writes")
+    parser.add_argument('--format', choices=list(PYRAMID_FORMATS), default='webp')
+    parser.add_argument('--sheet-size', type=int, default=SHEET_SIZE, help="Largest sheet width and height in pixels")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    main(args.sizes, args.format, args.sheet_size, args.workers)
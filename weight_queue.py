@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# weight_queue.py
+#
+# Work queue for assign_weights.py. The pending tag pairs are computed once,
+# when the queue is seeded from data/tag_pairs.json and the weights already in
+# data/tag_pairs_with_weights.json; after that each batch is claimed and
+# completed in O(batch) SQLite statements instead of a rescan of every pair
+# and a rewrite of the whole weights JSON.
+#
+# Claims happen in one write transaction, so several assign_weights.py
+# processes can drain the same queue without weighing a pair twice. A claim
+# not completed within CLAIM_TIMEOUT (a worker that died) goes back to pending.
+# export() merges the finished weights into the weights JSON.
+#
+# Usage: python weight_queue.py {status,export} [--tag-pairs data/tag_pairs.json]
+
+import json
+import os
+import sqlite3
+import time
+
+TAG_PAIRS_PATH = os.path.join('data', 'tag_pairs.json')
+WEIGHTS_PATH = os.path.join('data', 'tag_pairs_with_weights.json')
+# Seconds before a claimed batch is handed to another worker
+CLAIM_TIMEOUT = 600
+
+PENDING, CLAIMED, DONE, GIVEN_UP = 0, 1, 2, 3
+
+
+def queue_path_for(tag_pairs_path):
+    # One queue per pairs file, so refining a subset doesn't mix with the full run
+    return os.path.splitext(tag_pairs_path)[0] + '.queue.db'
+
+
+def has_weight(tag1, tag2, weighted_pairs):
+    return (tag1 in weighted_pairs and tag2 in weighted_pairs[tag1]) or (tag2 in weighted_pairs and tag1 in weighted_pairs[tag2])
+
+
+class WeightQueue:
+    def __init__(self, path):
+        self.path = path
+        # isolation_level=None: transactions are explicit, so a claim is one BEGIN IMMEDIATE ... COMMIT
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pairs (
+                tag1 TEXT NOT NULL,
+                tag2 TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                weight REAL,
+                claimed_by TEXT,
+                claimed_at REAL,
+                PRIMARY KEY (tag1, tag2)
+            ) WITHOUT ROWID
+        ''')
+        # Claims take pending pairs in (tag1, tag2) order, which this index serves directly
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pairs_status ON pairs (status, tag1, tag2)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def seeded_from(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key='source'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def seed(self, tag_pairs_path, weights_path):
+        """Adds the pairs in tag_pairs_path, marking those already weighted as done.
+        Skipped if this version of the file was already seeded. Returns the number of pairs added."""
+        source = {"path": os.path.abspath(tag_pairs_path), "mtime_ns": os.stat(tag_pairs_path).st_mtime_ns}
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Checked inside the write lock, so concurrent workers seed only once
+            if self.seeded_from() == source:
+                self.conn.execute('COMMIT')
+                return 0
+            with open(tag_pairs_path, 'r') as f:
+                tag_pairs = json.load(f)
+            weighted = {}
+            if os.path.exists(weights_path):
+                with open(weights_path, 'r') as f:
+                    weighted = json.load(f)
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO pairs (tag1, tag2, status) VALUES (?, ?, ?)',
+                ((tag1, tag2, DONE if has_weight(tag1, tag2, weighted) else PENDING)
+                 for tag1, pairs in tag_pairs.items() for tag2 in pairs))
+            added = self.conn.total_changes - before
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (json.dumps(source),))
+            self.conn.execute('COMMIT')
+            return added
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def retry_given_up(self):
+        """Puts pairs given up on by an earlier run back in the queue."""
+        self.conn.execute('UPDATE pairs SET status=?, attempts=0 WHERE status=?', (PENDING, GIVEN_UP))
+
+    def claim(self, worker, size):
+        """Claims up to size pending pairs, in sorted order. Returns [(tag1, tag2), ...]."""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute('UPDATE pairs SET status=? WHERE status=? AND claimed_at < ?',
+                              (PENDING, CLAIMED, now - CLAIM_TIMEOUT))
+            pairs = self.conn.execute('SELECT tag1, tag2 FROM pairs WHERE status=? ORDER BY tag1, tag2 LIMIT ?',
+                                      (PENDING, size)).fetchall()
+            self.conn.executemany('UPDATE pairs SET status=?, claimed_by=?, claimed_at=? WHERE tag1=? AND tag2=?',
+                                  ((CLAIMED, worker, now, tag1, tag2) for tag1, tag2 in pairs))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return pairs
+
+    def complete(self, claimed, weights, max_attempts):
+        """Records weights [(tag1, tag2, weight), ...] for a claimed batch, in either tag order.
+        Claimed pairs left without a weight go back to pending, or are given up on after
+        max_attempts. Returns the number of pairs weighted."""
+        found = {}
+        for tag1, tag2, weight in weights:
+            found[(tag1, tag2)] = found[(tag2, tag1)] = weight
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            weighted = 0
+            for tag1, tag2 in claimed:
+                if (tag1, tag2) in found:
+                    self.conn.execute('UPDATE pairs SET status=?, weight=?, claimed_by=NULL WHERE tag1=? AND tag2=?',
+                                      (DONE, found[(tag1, tag2)], tag1, tag2))
+                    weighted += 1
+                else:
+                    self.conn.execute('''
+                        UPDATE pairs SET attempts=attempts + 1, claimed_by=NULL,
+                            status=CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END
+                        WHERE tag1=? AND tag2=?
+                    ''', (max_attempts, GIVEN_UP, PENDING, tag1, tag2))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return weighted
+
+    def release(self, claimed):
+        """Hands a claimed batch back without counting an attempt (the worker is stopping)."""
+        self.conn.executemany('UPDATE pairs SET status=?, claimed_by=NULL WHERE status=? AND tag1=? AND tag2=?',
+                              ((PENDING, CLAIMED, tag1, tag2) for tag1, tag2 in claimed))
+
+    def counts(self):
+        names = {PENDING: 'pending', CLAIMED: 'claimed', DONE: 'done', GIVEN_UP: 'given_up'}
+        counts = dict.fromkeys(names.values(), 0)
+        for status, count in self.conn.execute('SELECT status, COUNT(*) FROM pairs GROUP BY status'):
+            counts[names[status]] = count
+        return counts
+
+    def export(self, weights_path=WEIGHTS_PATH):
+        """Merges the weights recorded here into weights_path (nested {tag1: {tag2: weight}}),
+        keeping any weights already there. Returns the number of weights written from the queue."""
+        weighted = {}
+        if os.path.exists(weights_path):
+            with open(weights_path, 'r') as f:
+                weighted = json.load(f)
+        count = 0
+        for tag1, tag2, weight in self.conn.execute('SELECT tag1, tag2, weight FROM pairs WHERE weight IS NOT NULL'):
+            weighted.setdefault(tag1, {})[tag2] = weight
+            count += 1
+        # Per-process temp name: several workers may export at the end of their runs
+        tmp_path = f'{weights_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(weighted, f, indent=2)
+        os.replace(tmp_path, weights_path)
+        return count
+
+    def close(self):
+        self.conn.close()
+
+
+def open_weight_queue(tag_pairs_path=TAG_PAIRS_PATH, weights_path=WEIGHTS_PATH):
+    """Opens the queue for tag_pairs_path, seeding it the first time and whenever the pairs file changes."""
+    queue = WeightQueue(queue_path_for(tag_pairs_path))
+    added = queue.seed(tag_pairs_path, weights_path)
+    if added:
+        print(f"Queued {added} tag pairs from {tag_pairs_path}.")
+    return queue
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Inspect the assign_weights.py work queue or export its weights")
+    parser.add_argument("command", choices=["status", "export"])
+    parser.add_argument("--tag-pairs", default=TAG_PAIRS_PATH)
+    parser.add_argument("--weights", default=WEIGHTS_PATH)
+    args = parser.parse_args()
+
+    path = queue_path_for(args.tag_pairs)
+    if not os.path.exists(path):
+        print(f"Error: {path} does not exist.")
+        sys.exit(1)
+    queue = WeightQueue(path)
+    if args.command == "status":
+        print(queue.counts())
+    else:
+        print(f"Merged {queue.export(args.weights)} weights into {args.weights}.")
+    queue.close()